@@ -0,0 +1,517 @@
+import os
+import re
+import sys
+from collections import Counter
+from copy import deepcopy
+from glob import glob
+from pathlib import Path
+from time import time
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Callable, Optional
+
+import elementpath
+from lxml import etree
+from lxml.etree import _Element
+from rich.pretty import pprint
+
+from . import blaze
+from .codelists import CODE_LISTS
+from .native import NativeSchematron
+from .parser import Parser
+from .schematron_lxml_const import GNSMAP, PATH_ROOT_MAP, SCHEMATRON_CEN_PATH, get_file_and_schematron_paths
+
+if TYPE_CHECKING:
+    from . import old
+
+# Micro-benchmarks of the hot `u:` functions of `blaze.py`, each against the implementation it replaced.
+# Usage: python -m <package>.bench <benchmark> [<size> ...]
+
+
+def _best_of(func: Callable, repeat: int = 3) -> float:
+    """Best wall time of `repeat` calls of `func`, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        tt = time()
+        func()
+        best = min(best, time() - tt)
+    return best
+
+
+################################################################################
+# SCH-EUSR-40
+################################################################################
+
+
+def _legacy_id_sch_eusr_40(ctx):
+    """`xpath_u_id_sch_eusr_40` before the single pass rewrite: one XPath query per key of each subset, per key."""
+    subset_nodes = ctx.context_node.xpath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
+
+    if not subset_nodes:
+        return True
+
+    for subset_node in subset_nodes:
+        key_nodes = subset_node.xpath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
+        if not key_nodes:
+            continue
+
+        for key_node in key_nodes:
+            key_value = key_node.text
+            count = 0
+            other_subset_nodes = ctx.context_node.xpath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
+            for other_subset_node in other_subset_nodes:
+                other_key_nodes = other_subset_node.xpath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
+                for other_key_node in other_key_nodes:
+                    if other_key_node.text == key_value:
+                        count += 1
+            if count != 1:
+                return False
+
+    return True
+
+
+def _eusr_report(subset_count: int) -> _Element:
+    """End user statistics report with `subset_count` PerEUC subsets, each with its own (fake) country."""
+    eusr = GNSMAP["eusr"]
+    report = etree.Element(f"{{{eusr}}}EndUserStatisticsReport", nsmap={None: eusr})
+    for index in range(subset_count):
+        subset = etree.SubElement(report, f"{{{eusr}}}Subset", type="PerEUC")
+        key = etree.SubElement(subset, f"{{{eusr}}}Key", metaSchemeID="CC", schemeID="EndUserCountry")
+        key.text = f"C{index}"
+        etree.SubElement(subset, f"{{{eusr}}}SendingEndUsers").text = "1"
+    return report
+
+
+def bench_eusr_40(sizes: list[int]):
+    """
+    SCH-EUSR-40 on reports with thousands of subsets. The legacy version builds a node-set of all the subsets
+    per subset and per key, so it is skipped above 200 subsets.
+    """
+    for size in sizes or [50, 200, 2000, 10000]:
+        ctx = SimpleNamespace(context_node=_eusr_report(size))
+        result = blaze.xpath_u_id_sch_eusr_40(ctx)
+        timings = {"subsets": size, "result": result, "single_pass": _best_of(lambda: blaze.xpath_u_id_sch_eusr_40(ctx))}
+        if size <= 200:
+            assert _legacy_id_sch_eusr_40(ctx) == result
+            timings["legacy"] = _best_of(lambda: _legacy_id_sch_eusr_40(ctx), repeat=1)
+        pprint(timings)
+
+
+################################################################################
+# u:castable
+################################################################################
+
+
+def _legacy_castable(value: str, cast_type: str) -> bool:
+    """`xpath_u_castable` before the native rewrite: a new XPath2 expression parsed by elementpath on each call."""
+    return elementpath.select(blaze.dummy_xml, f"'{value}' castable as xs:{cast_type}")
+
+
+def _test_file_dates() -> list[str]:
+    """Text of every `*Date` element of the test files."""
+    dates = []
+    for file_path in glob(str(Path(__file__).parent / "test_files" / "**" / "*.xml"), recursive=True):
+        try:
+            doc = etree.parse(file_path)
+        except etree.XMLSyntaxError:
+            continue
+        dates += [node.text or "" for node in doc.iter(etree.Element) if etree.QName(node).localname.endswith("Date")]
+    return dates
+
+
+def bench_castable(sizes: list[int]):
+    """u:castable(..., 'date') over the dates of the test files, repeated to `sizes` calls."""
+    dates = _test_file_dates()
+    for size in sizes or [1000, 10000]:
+        values = (dates * (size // len(dates) + 1))[:size]
+        assert [_legacy_castable(value, "date") for value in values[:200]] == [blaze._castable(value, "date") for value in values[:200]]
+        blaze._castable.cache_clear()
+        timings = {
+            "calls": size,
+            "distinct_values": len(set(values)),
+            "native_uncached": _best_of(lambda: [blaze._castable.__wrapped__(value, "date") for value in values]),
+            "native_cached": _best_of(lambda: [blaze._castable(value, "date") for value in values]),
+            "legacy": _best_of(lambda: [_legacy_castable(value, "date") for value in values], repeat=1),
+        }
+        pprint(timings)
+
+
+################################################################################
+# Checksums
+################################################################################
+
+
+def _legacy_gln(val: str):
+    weighted_sum = sum(num * (1 + (((index + 1) % 2) * 2)) for index, num in enumerate([ord(c) - 48 for c in val[:-1]][::-1]))
+    return (10 - (weighted_sum % 10)) % 10 == int(val[-1])
+
+
+def _legacy_mod11(val: str):
+    weighted_sum = sum(num * ((index % 6) + 2) for index, num in enumerate([ord(c) - 48 for c in val[:-1]][::-1]))
+    return int(val) > 0 and (11 - (weighted_sum % 11)) % 11 == int(val[-1])
+
+
+def _legacy_mod97_0208(val: str):
+    val = val[2:]
+    return int(val[-2:]) == 97 - (int(val[:-2]) % 97)
+
+
+def _legacy_add_piva(arg: str, pari: bool):
+    if not arg.isnumeric():
+        return 0
+    if pari:
+        return int("0246813579"[int(arg[0])]) + _legacy_add_piva(arg[1:], not pari)
+    return int(arg[0]) + _legacy_add_piva(arg[1:], not pari)
+
+
+def _legacy_check_piva(val: str):
+    if not val.isnumeric():
+        return 1
+    return _legacy_add_piva(val, False) % 10
+
+
+def _legacy_abn(val: str):
+    subtractors = [49] + [48] * 10
+    multipliers = [10, 1, 3, 5, 7, 9, 11, 13, 15, 17, 19]
+    return bool(sum((ord(character) - subtractors[index]) * multipliers[index] for index, character in enumerate(val)) % 89 == 0)
+
+
+def _legacy_tin_verification(val: str):
+    val = "".join([ch for ch in val if ch.isnumeric()])
+    return sum(int(character) * (2 ** (index + 1)) for index, character in enumerate(val[:8][::-1])) % 11 % 10 == int(val[-1])
+
+
+def _legacy_check_se_orgnr(number: str):
+    if not re.match(r"^\d+$", number):
+        return False
+    main_part = number[:9]
+    sum_digits = 0
+    for pos in range(1, 10):
+        digit = int(main_part[len(main_part) - pos])
+        if pos % 2 == 1:
+            doubled = digit * 2
+            sum_digits += (doubled % 10) + (doubled // 10)
+        else:
+            sum_digits += digit
+    return (10 - sum_digits % 10) % 10 == int(number[9:])
+
+
+def _legacy_xrechnung_verify_iban(value: str):
+    return int("".join(str(ord(ch) - 55 if ord(ch) > 64 else ord(ch) - 48) for ch in value)) % 97 == 1
+
+
+# `u:` function: (legacy implementation, cached checksum of `blaze.py`)
+_CHECKSUMS: dict[str, tuple[Callable, Callable]] = {
+    "gln": (_legacy_gln, blaze._gln_checksum),
+    "mod11": (_legacy_mod11, blaze._mod11_checksum),
+    "mod97-0208": (_legacy_mod97_0208, blaze._mod97_0208_checksum),
+    "checkPIVA": (_legacy_check_piva, lambda val: blaze.xpath_u_checkPIVA(None, val)),
+    "abn": (_legacy_abn, blaze._abn_checksum),
+    "TinVerification": (_legacy_tin_verification, blaze._tin_checksum),
+    "checkSEOrgnr": (_legacy_check_se_orgnr, blaze._se_orgnr_checksum),
+    "xrechnung_verify_iban": (_legacy_xrechnung_verify_iban, blaze._iban_checksum),
+}
+# Electronic address and party identifier schemes checked by the Peppol rules, with the `u:` function checking them
+_SCHEME_CHECKSUMS = {"0088": "gln", "0192": "mod11", "0208": "mod97-0208", "0151": "abn", "0007": "checkSEOrgnr", "9933": "TinVerification"}
+# VAT numbers checked by the Peppol national rules: `u:` function, and the part of the VAT number it checks
+_VAT_CHECKSUMS = {"NO": ("mod11", slice(2, 11)), "SE": ("checkSEOrgnr", slice(2, 12)), "EL": ("TinVerification", slice(2, None)), "IT": ("checkPIVA", slice(2, None))}
+
+
+def _test_file_identifiers() -> dict[str, list[str]]:
+    """Identifiers of the test files, by the `u:` function checking them, as the schematron passes them."""
+    identifiers: dict[str, list[str]] = {name: [] for name in _CHECKSUMS}
+    for file_path in glob(str(Path(__file__).parent / "test_files" / "**" / "*.xml"), recursive=True):
+        try:
+            doc = etree.parse(file_path)
+        except etree.XMLSyntaxError:
+            continue
+        for node in doc.iter(etree.Element):
+            text = " ".join((node.text or "").split())
+            localname = etree.QName(node).localname
+            if node.get("schemeID") in _SCHEME_CHECKSUMS:
+                identifiers[_SCHEME_CHECKSUMS[node.get("schemeID")]].append(text)
+            elif localname == "CompanyID" and text[:2] in _VAT_CHECKSUMS:
+                name, part = _VAT_CHECKSUMS[text[:2]]
+                identifiers[name].append(text[part])
+            elif localname == "ID" and etree.QName(node.getparent()).localname == "PayeeFinancialAccount":
+                iban = text.replace(" ", "")
+                identifiers["xrechnung_verify_iban"].append(iban[4:] + iban[:2].upper() + iban[2:4])
+    return identifiers
+
+
+def _checksum_results(func: Callable, values: list[str]) -> list:
+    """Result of `func` on each value, or the type of the exception it raised (an XPath error)"""
+    results = []
+    for value in values:
+        try:
+            results.append(func(value))
+        except Exception as err:
+            results.append(type(err))
+    return results
+
+
+def bench_checksums(sizes: list[int]):
+    """
+    Identifier checksums over the identifiers of the test files, repeated to `sizes` calls per function, as when the
+    same parties come back on every line and every document of a sender.
+    """
+    identifiers = _test_file_identifiers()
+    for size in sizes or [10000]:
+        for name, (legacy, checksum) in _CHECKSUMS.items():
+            if not identifiers[name]:
+                continue
+            values = (identifiers[name] * (size // len(identifiers[name]) + 1))[:size]
+            assert _checksum_results(legacy, values) == _checksum_results(checksum, values), name
+            uncached = getattr(checksum, "__wrapped__", checksum)
+            blaze._piva_sum.cache_clear()
+            timings = {
+                "function": name,
+                "calls": size,
+                "distinct_values": len(set(values)),
+                "legacy": _best_of(lambda: _checksum_results(legacy, values)),
+                "uncached": _best_of(lambda: _checksum_results(uncached, values)),
+                "cached": _best_of(lambda: _checksum_results(checksum, values)),
+            }
+            pprint(timings)
+
+
+################################################################################
+# XPath 2.0 Lexer
+################################################################################
+
+
+def _schematron_asserts() -> list[str]:
+    """Test of every assert of `validation/schematron/*.sch`."""
+    tests = []
+    for file_path in sorted(glob(str(Path(__file__).parent / "validation" / "schematron" / "*.sch"))):
+        tests += [node.get("test") for node in etree.parse(file_path).iter("{*}assert")]
+    return tests
+
+
+def _elementpath_parse(parser: elementpath.XPath2Parser, tests: list[str]) -> int:
+    """Number of tests elementpath parses (the others use functions or types it doesn't know)."""
+    parsed = 0
+    for test in tests:
+        try:
+            parser.parse(test)
+            parsed += 1
+        except elementpath.ElementPathError:
+            pass
+    return parsed
+
+
+def bench_lexer(sizes: list[int]):
+    """
+    `Parser.parse` over every assert of the schematrons, repeated `sizes` times, against elementpath:
+    its tokenizer regex alone (which only splits the text, the token kinds being found while parsing),
+    and its whole parse.
+    """
+    tests = _schematron_asserts()
+    lexer = Parser()
+    elementpath_parser = elementpath.XPath2Parser(namespaces=GNSMAP)
+    for size in sizes or [1, 10]:
+        repeated = tests * size
+        timings = {
+            "asserts": len(repeated),
+            "tokens": sum(len(lexer.parse(test)) for test in repeated),
+            "lexer": _best_of(lambda: [lexer.parse(test) for test in repeated]),
+            "elementpath_tokenizer": _best_of(lambda: [list(elementpath_parser.tokenizer.finditer(test)) for test in repeated]),
+            "elementpath_parsed": _elementpath_parse(elementpath_parser, repeated),
+            "elementpath_parse": _best_of(lambda: _elementpath_parse(elementpath_parser, repeated), repeat=1),
+        }
+        pprint(timings)
+
+
+################################################################################
+# Native XPath 2.0 Evaluator
+################################################################################
+
+# Folder of `test_files`: key of the schematrons validating its files in `SPECIAL_FILE_SCHEMATRON`
+_TEST_FOLDERS = {
+    "cen_peppol": "peppol",
+    "cen_peppolsb": "peppol",
+    "cen_siubl": "nlcius",
+    "cen_xrechnung": "xrechnung",
+    "eusr": "eusr",
+    "tsr": "tsr",
+    "pintcommon_pintaunz": "aunz",
+}
+
+
+def _old_fatal(schematrons: dict[str, Optional["old.Schematron"]], schematron_path: str, doc: _Element) -> Optional[list[str]]:
+    """
+    Fatal messages of `old.py`, or `None` when elementpath can't compile or run the schematron,
+    which is then left out for the next files.
+    `old` is only imported here: it registers its functions on the parser class shared by all the elementpath users,
+    which then breaks the parsing of the other benchmarks (see `bench_lexer`).
+    """
+    from . import old
+
+    try:
+        if schematron_path not in schematrons:
+            schematrons[schematron_path] = old.Schematron.from_sch(etree.parse(schematron_path).getroot())
+        schematron = schematrons[schematron_path]
+        return None if schematron is None else schematron.run(doc)[1]
+    except Exception:
+        schematrons[schematron_path] = None
+        return None
+
+
+def bench_native(sizes: list[int]):
+    """
+    The schematrons of the test files compiled by `native.py`, against `blaze.py` (XPath1 rewrites run by lxml) and
+    `old.py` (elementpath), each run `sizes` times per file. Run from the package directory, like the validators.
+    The fatal assertions of native are compared with blaze's, whose rewrites don't always match the schematron.
+    """
+    repeat = (sizes or [1])[0]
+    natives: dict[str, NativeSchematron] = {}
+    compile_times: dict[str, float] = {}
+    olds: dict[str, Optional["old.Schematron"]] = {}
+    for folder, key in _TEST_FOLDERS.items():
+        timings = {"folder": folder, "files": 0, "native": 0.0, "blaze": 0.0, "old": 0.0, "old_unsupported": set(), "same_fatal": 0, "different_fatal": []}
+        for file_name in sorted(os.listdir(Path("test_files") / folder)):
+            test_file_path, schematron_paths = get_file_and_schematron_paths([f"{folder}/{file_name}", key])
+            doc = etree.parse(test_file_path).getroot()
+            timings["files"] += 1
+            native_fatal, blaze_fatal = [], []
+            for schematron_path in schematron_paths:
+                if schematron_path not in natives:
+                    tt = time()
+                    natives[schematron_path] = NativeSchematron.from_sch(etree.parse(schematron_path).getroot(), PATH_ROOT_MAP[schematron_path])
+                    compile_times[PATH_ROOT_MAP[schematron_path]] = time() - tt
+                native = natives[schematron_path]
+                timings["native"] += _best_of(lambda: native.run(doc), repeat)
+                native_fatal += native.run(doc)[1]
+
+                root_name = PATH_ROOT_MAP[schematron_path]
+                timings["blaze"] += _best_of(lambda: blaze.SchematronRegistry.validate(doc, [root_name]), repeat)
+                blaze_fatal += blaze.SchematronRegistry.validate(doc, [root_name])[root_name]["fatal"]
+
+                tt = time()
+                if _old_fatal(olds, schematron_path, doc) is None:
+                    timings["old_unsupported"].add(root_name)
+                else:
+                    timings["old"] += time() - tt
+            if Counter(native_fatal) == Counter(blaze_fatal):
+                timings["same_fatal"] += 1
+            else:
+                timings["different_fatal"].append(file_name)
+        pprint(timings)
+    pprint({"native_compile": compile_times})
+
+
+################################################################################
+# u:for_every
+################################################################################
+
+
+def _legacy_for_every(ctx, item_list, condition_var: str):
+    """`xpath_u_for_every` before its conditions were cached: the condition is compiled again for every item."""
+    for item in item_list:
+        res = ctx.context_node.xpath(condition_var, namespaces=GNSMAP, VAR=item)
+        if not res:
+            return False
+
+    return True
+
+
+# Tax categories of the synthetic tax subtotals, whose BR-*-08 asserts all go through u:for_every
+_TAX_CATEGORIES = ("S", "Z", "E", "AE", "K", "G", "L", "M")
+
+
+def _tax_subtotal_invoice(subtotal_count: int) -> _Element:
+    """Peppol BIS 3 test invoice whose tax total has `subtotal_count` subtotals, over the categories and rates."""
+    doc = etree.parse("test_files/cen_peppol/correct_bis3_invoice.xml").getroot()
+    tax_total = doc.find("cac:TaxTotal", namespaces=GNSMAP)
+    template = tax_total.find("cac:TaxSubtotal", namespaces=GNSMAP)
+    tax_total.remove(template)
+    for index in range(subtotal_count):
+        subtotal = deepcopy(template)
+        subtotal.find("cac:TaxCategory/cbc:ID", namespaces=GNSMAP).text = _TAX_CATEGORIES[index % len(_TAX_CATEGORIES)]
+        subtotal.find("cac:TaxCategory/cbc:Percent", namespaces=GNSMAP).text = f"{index // len(_TAX_CATEGORIES) % 25}.0"
+        tax_total.append(subtotal)
+    return doc
+
+
+# Condition of SCH-EUSR-36 in `ASSERT_REPLACE_MAP`, on each subset of an end user statistics report
+_EUSR_36_CONDITION = "number($VAR/eusr:SendingOrReceivingEndUsers) > 0"
+
+
+def bench_for_every(sizes: list[int]):
+    """
+    The CEN schematron on invoices with `sizes` tax subtotals, with u:for_every compiling its condition once (blaze),
+    or once per item (legacy), and the `every ... satisfies` asserts compiled by `native.py`.
+    The BR-*-08 conditions sum the lines of the whole document for a single item, so the compilation only shows
+    with many items per call: the SCH-EUSR-36 condition over reports with as many subsets is timed too.
+    Run from the package directory, like the validators.
+    """
+    native = NativeSchematron.from_sch(etree.parse(SCHEMATRON_CEN_PATH).getroot(), "CEN")
+    for size in sizes or [10, 100, 1000]:
+        doc = _tax_subtotal_invoice(size)
+        result = blaze.SchematronRegistry.validate(doc, ["CEN"])["CEN"]
+        timings = {"subtotals": size, "fatal": len(result["fatal"]), "errors": len(result["errors"])}
+        timings["cen_cached"] = _best_of(lambda: blaze.SchematronRegistry.validate(doc, ["CEN"]))
+        blaze.utils_ns["for_every"] = _legacy_for_every
+        try:
+            assert blaze.SchematronRegistry.validate(doc, ["CEN"])["CEN"] == result
+            timings["cen_legacy"] = _best_of(lambda: blaze.SchematronRegistry.validate(doc, ["CEN"]), repeat=1)
+        finally:
+            blaze.utils_ns["for_every"] = blaze.xpath_u_for_every
+        timings["cen_native"] = _best_of(lambda: native.run(doc))
+
+        report = _eusr_report(size)
+        for subset in report:
+            etree.SubElement(subset, f"{{{GNSMAP['eusr']}}}SendingOrReceivingEndUsers").text = "1"
+        ctx = SimpleNamespace(context_node=report)
+        subsets = list(report)
+        assert blaze.xpath_u_for_every(ctx, subsets, _EUSR_36_CONDITION) == _legacy_for_every(ctx, subsets, _EUSR_36_CONDITION)
+        timings["eusr_36_cached"] = _best_of(lambda: blaze.xpath_u_for_every(ctx, subsets, _EUSR_36_CONDITION))
+        timings["eusr_36_legacy"] = _best_of(lambda: _legacy_for_every(ctx, subsets, _EUSR_36_CONDITION))
+        pprint(timings)
+
+
+################################################################################
+# Code Lists
+################################################################################
+
+
+def _legacy_codelist_query(name: str, value: str) -> str:
+    """Check of `value` in the code list `name` as it was rewritten before `u:in_codelist`: a ``contains()``."""
+    return f"contains(' {' '.join(sorted(CODE_LISTS[name]))} ', concat(' ', {value}, ' '))"
+
+
+def bench_codelists(sizes: list[int]):
+    """PEPPOL-EN16931-CL007 on `sizes` amounts, cycling over the currencies, as a u:in_codelist lookup and as a contains()."""
+    currencies = sorted(CODE_LISTS["ISO4217"]) + ["HRK", "XYZ", ""]
+    query = etree.XPath("u:in_codelist('PEPPOL-EN16931-UBL.sch#ISO4217', @currencyID)", namespaces=GNSMAP)
+    legacy_query = etree.XPath(_legacy_codelist_query("ISO4217", "@currencyID"), namespaces=GNSMAP)
+    for size in sizes or [1000, 10000]:
+        amounts = [etree.Element(f"{{{GNSMAP['cbc']}}}Amount", currencyID=currencies[index % len(currencies)]) for index in range(size)]
+        assert [query(amount) for amount in amounts] == [legacy_query(amount) for amount in amounts]
+        timings = {
+            "amounts": size,
+            "in_codelist": _best_of(lambda: [query(amount) for amount in amounts]),
+            "contains": _best_of(lambda: [legacy_query(amount) for amount in amounts]),
+        }
+        pprint(timings)
+
+
+BENCHMARKS: dict[str, Callable[[list[int]], None]] = {
+    "eusr40": bench_eusr_40,
+    "castable": bench_castable,
+    "checksums": bench_checksums,
+    "lexer": bench_lexer,
+    "native": bench_native,
+    "for_every": bench_for_every,
+    "codelists": bench_codelists,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: python -m <package>.bench <{'|'.join(BENCHMARKS)}> [<size> ...]")
+        return
+    BENCHMARKS[sys.argv[1]]([int(size) for size in sys.argv[2:]])
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
+import abc
+import hashlib
+import json
 import logging
+import os
 import re
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager
+from decimal import ROUND_HALF_DOWN, ROUND_HALF_UP, Decimal
+from functools import lru_cache
 from os import listdir
 from time import time
-from typing import Generic, List, Optional, Tuple, TypeVar
+from typing import Generic, Iterable, Iterator, List, Optional, Tuple, TypeVar
 
 import elementpath
 import ipdb
@@ -11,6 +20,9 @@ from lxml import etree
 from lxml.etree import _Element
 from rich.pretty import pprint
 
+
+from . import schematron_lxml_const
+from .codelists import CODE_LISTS
 from .schematron_lxml_const import (
     ASSERT_REPLACE_MAP,
     GNSMAP,
@@ -19,6 +31,7 @@ from .schematron_lxml_const import (
     VARIABLE_REPLACE_MAP,
     VARIABLE_TO_IGNORE,
     get_file_and_schematron_paths,
+    profile_schematron_paths,
 )
 
 XPathList = list[_Element]
@@ -28,8 +41,9 @@ T = TypeVar("T", bound="Element")
 to_handle_map: dict[str, str] = {}
 dummy_xml = etree.Element("unused")
 
+# The `u` prefix is not registered globally on `utils_ns`: compiled `etree.XPath` objects lose track of global
+# prefixes once they are evaluated on another document. Every query must map `u` in its own namespaces instead.
 utils_ns = etree.FunctionNamespace("utils")
-utils_ns.prefix = "u"
 
 _logger = logging.getLogger(__name__)
 
@@ -40,36 +54,86 @@ _logger = logging.getLogger(__name__)
 ################################################################################
 
 
-def try_xpath(xml: _Element, path: str, namespaces: dict, variables: dict, schematron_vals: dict) -> XPathObject:
+def _xpath_error_detail(err: Exception, error_type: str, key: str, path: str) -> str:
+    return "\n".join(
+        (
+            f"Error: {err}",
+            f"Type: {error_type}",
+            f"Key: {key}",
+            "-----",
+            path,
+            "-----",
+        )
+    )
+
+
+class XPathCompileError:
+    """
+    Stands for a query that failed to compile. `try_xpath` evaluates it as `False` and reports its error on each
+    evaluation, so a broken query is only reported on the documents where its rule runs, like any other error.
+    """
+
+    __slots__ = ("path", "error_detail")
+
+    def __init__(self, path: str, error_detail: str):
+        self.path = path
+        self.error_detail = error_detail
+
+
+def compile_xpath(
+    path: str, namespaces: dict, compile_errors: list[str], error_type: str, key: str
+) -> etree.XPath | XPathCompileError:
+    """
+    Compile an XPath1 query once, so that it can be evaluated on every document without being parsed again.
+    The absolute ``//prefix:Name`` steps are answered from the document index (see `_xpath_index_query`), and
+    upper-case comparisons of ASCII values by libxml2 alone (see `_xpath_upper_case_query`).
+    On error, an error message is logged once, here, and an `XPathCompileError` is returned (see `try_xpath`).
+    :param path: the XPath1 query to compile
+    :param namespaces: the namespaces (including the `u` and `re` extension prefixes) used by the query
+    :param compile_errors: a list reference to be filled with the error details
+    :param error_type: the kind of query (rule context, rule assertion, ...), for the error details
+    :param key: the assert id or the variable name of the query, for the error details
+    """
+    try:
+        return etree.XPath(_xpath_index_query(_xpath_upper_case_query(path), namespaces), namespaces=namespaces)
+    except etree.XPathSyntaxError as err:
+        error_detail = _xpath_error_detail(err, error_type, key, path)
+        _logger.error("Schematron XPath failed to compile.\n%s", error_detail)
+        compile_errors.append(error_detail)
+        return XPathCompileError(path, error_detail)
+
+
+def try_xpath(xml: _Element, xpath: etree.XPath | XPathCompileError, variables: dict, schematron_vals: dict) -> XPathObject:
     """
-    Run an XPath1 query on the XML and returns the result.
+    Run a compiled XPath1 query on the XML and returns the result.
     On error, an error message will be logged for further investigation.
-    :param xml: the XML _Element to run `xpath` on
-    :param path: the XPath1 query to run
-    :param namespaces: the namespaces to add into the `xpath` method
-    :param variables: the additional variables to add into the `xpath` method
+    Queries that failed to compile are already logged by `compile_xpath`: they evaluate to `False`, with their
+    compile error added to the errors of the document.
+    :param xml: the XML _Element to run the query on
+    :param xpath: the compiled XPath1 query to run
+    :param variables: the additional variables to add into the query
     :param schematron_vals: a dictionary reference with minimal format of {'errors`: <list>},
                             to be filled with the error details.
     """
+    if isinstance(xpath, XPathCompileError):
+        schematron_vals["errors"].append(xpath.error_detail)
+        return False
+
     try:
-        val = xml.xpath(path, namespaces=namespaces, **variables)
-        return val
+        return xpath(xml, **variables)
     except Exception as err:
-        error_detail = "\n".join(
-            (
-                f"Error: {err}",
-                f"Type: {schematron_vals['current']['type']}",
-                f"Key: {schematron_vals['current']['key']}",
-                "-----",
-                path,
-                "-----",
-            )
-        )
+        error_detail = _xpath_error_detail(err, schematron_vals["current"]["type"], schematron_vals["current"]["key"], xpath.path)
         _logger.error("Schematron XPath failed.\n%s", error_detail)
         schematron_vals["errors"].append(error_detail)
         return False
 
 
+# Conversions of a node done by libxml2 itself, for the `u:` functions needing exactly the values XPath1 would see
+_xpath_number = etree.XPath("number(.)")
+_xpath_string = etree.XPath("string(.)")
+_xpath_normalized = etree.XPath("normalize-space(.)")
+
+
 def _xpath_clean_value(xpath_object: XPathObject) -> str:
     val = ""
     if not xpath_object:
@@ -91,38 +155,187 @@ def _xpath_normalize_query(path: str) -> str:
     """
     Strip and replace all multiple spaces with a single space
     """
-    clean_path_list = []
-    for i in range(len(path)):
-        if i + 1 < len(path) and path[i] == path[i + 1] == " ":
+    return _XPATH_SPACES_RE.sub(" ", path).strip()
+
+
+_XPATH_SPACES_RE = re.compile(r" {2,}")
+# Tokens of an XPath2 query, as far as `_xpath_transform_query` needs to tell them apart: anything which is neither
+# a string literal nor a name is a single character (the whitespace is skipped, as an unnamed group)
+_XPATH2_TOKEN_RE = re.compile(r"""(?P<literal>"[^"]*"|'[^']*')|(?P<name>[A-Za-z_][\w.\-]*(?::[A-Za-z_][\w.\-]*)?)|(?P<other>\S)|\s+""")
+# XPath2 functions: XPath1 function (see the `u:` functions below) replacing them
+_XPATH2_FUNCTIONS = {
+    "matches": "re:match",
+    "exists": "u:exists",
+    "xs:decimal": "number",
+    "xs:integer": "number",
+    "upper-case": "u:upper_case",
+    "tokenize": "u:tokenize",
+    "string-join": "u:string_join",
+}
+# Elements compared to `true()` or `false()`, meaning their text in XPath2 (but their existence in XPath1)
+_XPATH2_BOOLEAN_ELEMENTS = {"cbc:ChargeIndicator"}
+
+
+@lru_cache(maxsize=None)
+def _xpath_transform_query(query: str) -> str:
+    """
+    Transform simple XPath 2.0 syntax with custom function, in a single pass over the tokens of the query:
+    the calls of `_XPATH2_FUNCTIONS` are renamed, and ``cbc:ChargeIndicator = true()`` compares the text instead.
+    String literals, variables, attributes and element names are left alone, even when they contain a function name.
+    The text between the replaced tokens is kept as is.
+    """
+    tokens = [(match.lastgroup, match.group(), match.start()) for match in _XPATH2_TOKEN_RE.finditer(query) if match.lastgroup]
+    parts = []
+    position = 0
+    for i, (kind, value, start) in enumerate(tokens):
+        if kind != "name" or (i and tokens[i - 1][1] in ("$", "@")):
             continue
-        clean_path_list.append(path[i])
-    return "".join(clean_path_list).strip()
+        following = [token[1] for token in tokens[i + 1 : i + 3]]
+        if value in _XPATH2_FUNCTIONS and following[:1] == ["("]:
+            replacement, end = _XPATH2_FUNCTIONS[value], start + len(value)
+        elif (
+            value in ("true", "false")
+            and following == ["(", ")"]
+            and i >= 2
+            and tokens[i - 1][1] == "="
+            and tokens[i - 2][1] in _XPATH2_BOOLEAN_ELEMENTS
+        ):
+            replacement, end = f"'{value}'", tokens[i + 2][2] + 1
+        else:
+            continue
+        parts += [query[position:start], replacement]
+        position = end
+    parts.append(query[position:])
+    return "".join(parts)
 
 
-def _xpath_transform_query(query: str) -> str:
+def _xpath_context_query(context: str) -> str:
+    """
+    Rewrite a rule context into the XPath1 query to compile.
+    The received `context` string here is in the format of a " | "-separated context items, and
+    each context item will be in the format of "OrphanedNode/AdditionalPathToNode" or "/RootNode/PathToNode".
+    In the first case, we want to prepend them with "//" to explicitly indicate to the Selector
+    that we need to do a find query to that node, because it doesn't start from the root.
     """
-    Transform simple XPath 2.0 syntax with custom function
-    """
-    if "matches" in query:
-        query = re.sub(r"matches", "re:match", query)
-    if "exists" in query:
-        query = re.sub(r"exists", "u:exists", query)
-    if "xs:decimal" in query:
-        query = re.sub(r"xs:decimal", "number", query)
-    if "upper-case" in query:
-        query = re.sub(r"upper-case", "u:upper_case", query)
-    if "xs:integer" in query:
-        query = re.sub(r"xs:integer", "number", query)
-    if "tokenize" in query:
-        query = re.sub(r"tokenize", "u:tokenize", query)
-    if "string-join" in query:
-        query = re.sub(r"string-join", "u:string_join", query)
-    if "cbc:ChargeIndicator = false()" in query:
-        query = re.sub(r"cbc:ChargeIndicator = false\(\)", "cbc:ChargeIndicator = 'false'", query)
-    if "cbc:ChargeIndicator = true()" in query:
-        query = re.sub(r"cbc:ChargeIndicator = true\(\)", "cbc:ChargeIndicator = 'true'", query)
+    split_context = context.split("|")
+    for i, or_context in enumerate(split_context):
+        or_context = or_context.strip()
+        if not or_context.startswith("/"):
+            split_context[i] = f"//{or_context}"
+    context = " | ".join(split_context)
+    context = _xpath_normalize_query(context)
+    return QUERY_REPLACE_MAP.get(context, _xpath_transform_query(context))
+
+
+def _xpath_variable_query(name: str, path: str) -> str:
+    """Rewrite a `let` value into the XPath1 query to compile."""
+    query = _xpath_normalize_query(path)
+    return VARIABLE_REPLACE_MAP.get(name, QUERY_REPLACE_MAP.get(query, _xpath_transform_query(query)))
+
+
+def _xpath_assert_query(assert_id: str, test: str) -> str:
+    """Rewrite an assert test into the XPath1 query to compile."""
+    query = _xpath_normalize_query(test)
+    return ASSERT_REPLACE_MAP.get(assert_id, _xpath_transform_query(query))
+
+
+# Tokens of an XPath1 query, as far as `_xpath_depends_on_context` needs to tell them apart
+_XPATH_TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<literal>"[^"]*"|'[^']*')
+        |(?P<number>\d+(?:\.\d*)?|\.\d+)
+        |(?P<variable>\$[A-Za-z_][\w.\-]*(?::[A-Za-z_][\w.\-]*)?)
+        |(?P<axis>[A-Za-z_][\w.\-]*::)
+        |(?P<name>(?:[A-Za-z_][\w.\-]*:)?(?:[A-Za-z_][\w.\-]*|\*)|\*)
+        |(?P<operator>//|/|\.\.|\.|@|\(|\)|\[|\]|,|\||!=|<=|>=|=|<|>|\+|-)
+    )""",
+    re.VERBOSE,
+)
+# Node tests, which always start a relative location path
+_XPATH_NODE_TESTS = {"text", "node", "comment", "processing-instruction"}
+# Functions reading the context node (or position) whatever their arguments are
+_XPATH_CONTEXT_FUNCTIONS = {"position", "last", "current", "lang", "u:for_every", "u:id_SCH_EUSR_40"}
+# Functions defaulting to the context node when called without argument
+_XPATH_CONTEXT_DEFAULT_FUNCTIONS = {"normalize-space", "string", "string-length", "number", "name", "local-name", "namespace-uri"}
+
+
+def _xpath_tokenize(query: str) -> Optional[List[Tuple[str, str, int]]]:
+    """Split an XPath1 query into (kind, value, offset) tokens, or return `None` if the query can't be tokenized."""
+    tokens = []
+    pos, end = 0, len(query.rstrip())
+    while pos < end:
+        match = _XPATH_TOKEN_RE.match(query, pos)
+        if not match or match.end() == pos:
+            return None
+        kind = match.lastgroup or ""
+        tokens.append((kind, match.group(kind), match.start(kind)))
+        pos = match.end()
+    return tokens
+
+
+def _xpath_walk(tokens: List[Tuple[str, str, int]]) -> Iterator[Tuple[int, str, int]]:
+    """
+    Yield (index, state, predicate depth) for every token, where the state tells what the token stands for:
+    `start` where an operand is expected, `step` right after ``/``, ``//``, ``@`` or an axis,
+    and `end` right after an operand (so a name is an operator like ``and``, ``div``, or the multiplication ``*``).
+    """
+    state = "start"
+    depth = 0
+    for i, (kind, value, _offset) in enumerate(tokens):
+        yield i, state, depth
+        if kind in ("variable", "literal", "number"):
+            state = "end"
+        elif kind == "axis":
+            state = "step"
+        elif kind == "name":
+            is_function = state != "end" and i + 1 < len(tokens) and tokens[i + 1][1] == "("
+            state = "start" if state == "end" or is_function else "end"
+        elif value in ("/", "//", "@"):
+            state = "step"
+        elif value in (".", ".."):
+            state = "end"
+        elif value == "[":
+            depth += 1
+            state = "start"
+        elif value == "]":
+            depth -= 1
+            state = "end"
+        elif value == ")":
+            state = "end"
+        else:
+            state = "start"
 
-    return query
+
+def _xpath_depends_on_context(query: str, context_variables: set[str]) -> bool:
+    """
+    Statically check whether the result of an XPath1 query may depend on the node it is evaluated on.
+    It doesn't if every location path outside predicates is absolute (or starts from a variable), no function reads
+    the context node, and no variable from `context_variables` is used. Such a query gives the same result on every
+    context node of a rule, so it only needs to be evaluated once per document.
+    Anything that can't be analyzed is reported as context dependent.
+    """
+    tokens = _xpath_tokenize(query)
+    if tokens is None:
+        return True
+
+    for i, state, depth in _xpath_walk(tokens):
+        kind, value, _offset = tokens[i]
+        if kind == "variable" and value[1:] in context_variables:
+            return True
+        if state != "start" or depth:
+            continue
+
+        if kind == "axis" or value in ("@", ".", ".."):
+            return True
+        if kind == "name":
+            next_value = tokens[i + 1][1] if i + 1 < len(tokens) else ""
+            if next_value != "(" or value in _XPATH_NODE_TESTS or value in _XPATH_CONTEXT_FUNCTIONS:
+                return True
+            if value in _XPATH_CONTEXT_DEFAULT_FUNCTIONS and i + 2 < len(tokens) and tokens[i + 2][1] == ")":
+                return True
+
+    values = [value for _kind, value, _offset in tokens]
+    return values.count("[") != values.count("]")
 
 
 def _make_xpath_list(list_var: list[str]) -> XPathList:
@@ -143,6 +356,126 @@ def _destructure_xpath_list(xpath_list_var: XPathList) -> list[str]:
     return [(t.text or "") for t in xpath_list_var]
 
 
+################################################################################
+# Checksums
+################################################################################
+
+# The same party identifiers come back on every line of a document, and on every document of the same sender, so
+# the checksums are cached per worker, across documents. Their arguments must be plain `str` (see `_plain_str`).
+_CHECKSUM_CACHE_SIZE = 8192
+_GLN_WEIGHTS = (3, 1)
+_ABN_WEIGHTS = (10, 1, 3, 5, 7, 9, 11, 13, 15, 17, 19)
+# Digit sum of twice each digit, for the Luhn-style checks (Partita IVA, Swedish organisation number)
+_DOUBLED_DIGIT_SUMS = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+_IBAN_LETTER_NUMBERS = str.maketrans({letter: str(ord(letter) - 55) for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"})
+
+
+def _plain_str(value):
+    """
+    Strings returned by lxml keep a reference to their element: cache them as plain `str`, so that the cache doesn't
+    keep their document alive. Anything else is left as is, and fails the checksum like it always did.
+    """
+    return str(value) if isinstance(value, str) else value
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _gln_checksum(val: str) -> bool:
+    """GS1 check digit: weights 3 and 1 alternating from the right, excluding the check digit"""
+    weighted_sum = 0
+    for index in range(len(val) - 1):
+        weighted_sum += (ord(val[-2 - index]) - 48) * _GLN_WEIGHTS[index % 2]
+    return (10 - (weighted_sum % 10)) % 10 == int(val[-1])
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _mod11_checksum(val: str) -> bool:
+    """Norwegian organisation number: weights 2 to 7 cycling from the right, excluding the check digit"""
+    if int(val) <= 0:
+        return False
+    weighted_sum = 0
+    for index in range(len(val) - 1):
+        weighted_sum += (ord(val[-2 - index]) - 48) * (index % 6 + 2)
+    return (11 - (weighted_sum % 11)) % 11 == int(val[-1])
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _mod97_0208_checksum(val: str) -> bool:
+    """Belgian enterprise number: the last 2 digits are 97 minus the rest (after the first 2 digits) modulo 97"""
+    val = val[2:]
+    return int(val[-2:]) == 97 - (int(val[:-2]) % 97)
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _piva_sum(arg: str, pari: bool) -> int:
+    """
+    Sum of the digits of `arg`, replacing every other digit (starting with the first one when `pari`) by the digit
+    sum of its double. Like the recursive XSLT it comes from, anything that isn't all digits sums to 0.
+    """
+    if not arg.isnumeric():
+        return 0
+    total = 0
+    for character in arg:
+        digit = int(character)
+        total += _DOUBLED_DIGIT_SUMS[digit] if pari else digit
+        pari = not pari
+    return total
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _abn_checksum(val: str) -> bool:
+    """Australian Business Number: subtract 1 from the first digit, then the weighted sum must be a multiple of 89"""
+    weighted_sum = 0
+    for index, character in enumerate(val):
+        weighted_sum += (ord(character) - 48 - (index == 0)) * _ABN_WEIGHTS[index]
+    return weighted_sum % 89 == 0
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _tin_checksum(val: str) -> bool:
+    """
+    Greek TIN: the first 8 digits weighted by descending powers of 2 (the 8th by 2), modulo 11 then 10, must be the
+    last digit. Non digits are ignored.
+    """
+    weighted_sum = 0
+    digit_count = 0
+    last_digit = ""
+    for character in val:
+        if not character.isnumeric():
+            continue
+        if digit_count < 8:
+            weighted_sum = (weighted_sum + int(character)) * 2
+            digit_count += 1
+        last_digit = character
+    return weighted_sum % 11 % 10 == int(last_digit)
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _se_orgnr_checksum(number: str) -> bool:
+    """Swedish organisation number: Luhn check digit of the first 9 digits, as the 10th digit"""
+    if not re.match(r"^\d+$", number):
+        return False  # Not all digits
+
+    main_length = min(len(number), 9)
+    sum_digits = 0
+    for pos in range(1, 10):
+        digit = int(number[main_length - pos])  # Right to left, wrapping around like the original for short numbers
+        sum_digits += _DOUBLED_DIGIT_SUMS[digit] if pos % 2 == 1 else digit
+
+    return (10 - sum_digits % 10) % 10 == int(number[9:])
+
+
+@lru_cache(maxsize=_CHECKSUM_CACHE_SIZE)
+def _iban_checksum(value: str) -> bool:
+    """
+    ISO 7064 MOD 97-10 of an IBAN already rearranged (country code and check digits moved to the end): letters count
+    as 10 to 35 (42 to 67 in lower case), and the resulting number modulo 97 must be 1.
+    """
+    if value.isascii() and value.isalnum():
+        return int(value.translate(_IBAN_LETTER_NUMBERS)) % 97 == 1
+    # Not an IBAN: concatenate the numbers of all the codepoints like the XPath2 query does, which mostly fails
+    return int("".join(str(ord(ch) - 55 if ord(ch) > 64 else ord(ch) - 48) for ch in value)) % 97 == 1
+
+
 ################################################################################
 # LXML XPath Utility Methods required for the Peppol Schematron
 ################################################################################
@@ -150,25 +483,27 @@ def _destructure_xpath_list(xpath_list_var: XPathList) -> list[str]:
 
 @utils_ns("gln")
 def xpath_u_gln(_, val: str):
-    weighted_sum = sum(num * (1 + (((index + 1) % 2) * 2)) for index, num in enumerate([ord(c) - 48 for c in val[:-1]][::-1]))
-    return (10 - (weighted_sum % 10)) % 10 == int(val[-1])
+    return _gln_checksum(_plain_str(val))
 
 
 @utils_ns("slack")
-def xpath_u_slack(_, exp: float, val: float, slack: float):
-    return (exp + slack) >= val and (exp - slack) <= val
+def xpath_u_slack(_, exp: XPathObject, val: XPathObject, slack: XPathObject):
+    """Whether `val` is within `slack` of `exp`, compared as decimals (see `_xpath_decimal`)."""
+    difference = abs(_xpath_decimal(exp) - _xpath_decimal(val))
+    slack_value = _xpath_decimal(slack)
+    if difference.is_nan() or slack_value.is_nan():
+        return False
+    return difference <= slack_value
 
 
 @utils_ns("mod11")
 def xpath_u_mod11(_, val: str):
-    weighted_sum = sum(num * ((index % 6) + 2) for index, num in enumerate([ord(c) - 48 for c in val[:-1]][::-1]))
-    return int(val) > 0 and (11 - (weighted_sum % 11)) % 11 == int(val[-1])
+    return _mod11_checksum(_plain_str(val))
 
 
 @utils_ns("mod97-0208")
 def xpath_u_mod97_0208(_, val: str):
-    val = val[2:]
-    return int(val[-2:]) == 97 - (int(val[:-2]) % 97)
+    return _mod97_0208_checksum(_plain_str(val))
 
 
 @utils_ns("checkCodiceIPA")
@@ -191,15 +526,8 @@ def xpath_u_checkCF(_, val: str):
 
 
 def _xpath_u_addPIVA(arg: str, pari: bool):
-    # Because of the way the xpath substr function works, the base case is arg as an empty string
-    # pari is used to alterate, such that the CHECK_NO ("0246813579") is indexed every other character
-    if not arg.isnumeric():
-        return 0
-    else:
-        if pari:
-            return int("0246813579"[int(arg[0])]) + _xpath_u_addPIVA(arg[1:], not pari)
-        else:
-            return int(arg[0]) + _xpath_u_addPIVA(arg[1:], not pari)
+    # pari is used to alternate, such that the CHECK_NO ("0246813579") is indexed every other character
+    return _piva_sum(_plain_str(arg), pari)
 
 
 @utils_ns("checkPIVA")
@@ -224,38 +552,17 @@ def xpath_u_checkPIVAseIT(_, val: str):
 
 @utils_ns("abn")
 def xpath_u_abn(_, val: str):
-    subtractors = [49] + [48] * 10
-    multipliers = [10, 1, 3, 5, 7, 9, 11, 13, 15, 17, 19]
-    return bool(sum((ord(character) - subtractors[index]) * multipliers[index] for index, character in enumerate(val)) % 89 == 0)
+    return _abn_checksum(_plain_str(val))
 
 
 @utils_ns("TinVerification")
 def xpath_u_TinVerification(_, val: XPathObject):
-    val = _xpath_clean_value(val)
-    val = "".join([ch for ch in val if ch.isnumeric()])
-    return sum(int(character) * (2 ** (index + 1)) for index, character in enumerate(val[:8][::-1])) % 11 % 10 == int(val[-1])
+    return _tin_checksum(_xpath_clean_value(val))
 
 
 @utils_ns("checkSEOrgnr")
 def xpath_u_checkSEOrgnr(_, number: str):
-    if not re.match(r"^\d+$", number):
-        return False  # Not all digits
-
-    main_part = number[:9]  # First 9 digits
-    check_digit = number[9:]  # Last digit
-
-    sum_digits = 0
-    for pos in range(1, 10):
-        digit = int(main_part[len(main_part) - pos])  # Get digit from right to left
-        if pos % 2 == 1:  # Odd position (from right)
-            doubled = digit * 2
-            sum_digits += (doubled % 10) + (doubled // 10)  # Sum digits of doubled value
-        else:  # Even position
-            sum_digits += digit
-
-    calculated_check_digit = (10 - sum_digits % 10) % 10
-
-    return calculated_check_digit == int(check_digit)
+    return _se_orgnr_checksum(_plain_str(number))
 
 
 ################################################################################
@@ -263,6 +570,15 @@ def xpath_u_checkSEOrgnr(_, number: str):
 ################################################################################
 
 
+@lru_cache(maxsize=None)
+def _for_every_condition(condition: str) -> etree.XPath:
+    """
+    Compiled condition of `u:for_every`. The conditions are the literals of `schematron_lxml_const.py`,
+    so each of them is only compiled once, rather than once per item of each call.
+    """
+    return etree.XPath(condition, namespaces=GNSMAP)
+
+
 @utils_ns("for_every")
 def xpath_u_for_every(ctx, item_list: XPathList, condition_var: str):
     """
@@ -272,8 +588,9 @@ def xpath_u_for_every(ctx, item_list: XPathList, condition_var: str):
     XPath2: every $varname in $listname satisfies $varname = 42
     XPath1: u:for_every($listname, "$VAR = 42")
     """
+    condition = _for_every_condition(_plain_str(condition_var))
     for item in item_list:
-        res = ctx.context_node.xpath(condition_var, namespaces=GNSMAP, VAR=item)
+        res = condition(ctx.context_node, VAR=item)
         if not res:
             return False
 
@@ -294,15 +611,68 @@ def xpath_u_if_else(_, condition, then_clause, else_clause):
         return else_clause
 
 
+# XSD lexical spaces of the types the schematrons cast to, the ranges being checked by `_castable`
+_XSD_TIMEZONE = r"(?:Z|[+-](?P<tz_hour>\d\d):(?P<tz_minute>\d\d))?"
+_XSD_DATE = r"(?P<year>-?(?:[1-9]\d{3,}|0\d{3}))-(?P<month>\d\d)-(?P<day>\d\d)"
+_XSD_TIME = r"(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d(?:\.\d+)?)"
+_XSD_LEXICAL_PATTERNS = {
+    "date": re.compile(_XSD_DATE + _XSD_TIMEZONE),
+    "dateTime": re.compile(_XSD_DATE + "T" + _XSD_TIME + _XSD_TIMEZONE),
+    "time": re.compile(_XSD_TIME + _XSD_TIMEZONE),
+    "decimal": re.compile(r"[+-]?(?:\d+(?:\.\d*)?|\.\d+)"),
+    "integer": re.compile(r"[+-]?\d+"),
+}
+_XML_WHITESPACE = " \t\r\n"
+
+
+def _xsd_days_in_month(year: int, month: int) -> int:
+    if month == 2:
+        return 29 if (year % 4 == 0 and year % 100 != 0) or year % 400 == 0 else 28
+    return 30 if month in (4, 6, 9, 11) else 31
+
+
+@lru_cache(maxsize=4096)
+def _castable(value: str, cast_type: str) -> bool:
+    """
+    Whether the XPath2 ``$value castable as xs:<cast_type>`` is true, checked natively for the types used by the
+    schematrons (the lexical pattern, and then the ranges of the date and time fields).
+    Other types are still left to elementpath.
+    """
+    if cast_type == "string":
+        return True
+    pattern = _XSD_LEXICAL_PATTERNS.get(cast_type)
+    if pattern is None:
+        return bool(elementpath.select(dummy_xml, f"$value castable as xs:{cast_type}", variables={"value": value}))
+
+    match = pattern.fullmatch(value.strip(_XML_WHITESPACE))
+    if not match:
+        return False
+
+    fields = match.groupdict()
+    if fields.get("year") is not None:
+        year, month, day = int(fields["year"]), int(fields["month"]), int(fields["day"])
+        if year == 0 or not 1 <= month <= 12 or not 1 <= day <= _xsd_days_in_month(year, month):
+            return False
+    if fields.get("hour") is not None:
+        hour, minute, second = int(fields["hour"]), int(fields["minute"]), float(fields["second"])
+        if minute > 59 or second >= 60 or (hour > 23 and not (hour == 24 and minute == 0 and second == 0)):
+            return False
+    if fields.get("tz_hour") is not None:
+        tz_hour, tz_minute = int(fields["tz_hour"]), int(fields["tz_minute"])
+        if tz_minute > 59 or tz_hour > 14 or (tz_hour == 14 and tz_minute != 0):
+            return False
+    return True
+
+
 @utils_ns("castable")
-def xpath_u_castable(_, value: str, cast_type: str):
+def xpath_u_castable(_, value: XPathObject, cast_type: str):
     """
     Handles translating the complex ``castable`` type check query in XPath2.
     For example:
     XPath2: $str castable as xs:date
     XPath1: u:castable($str, 'date')
     """
-    return elementpath.select(dummy_xml, f"'{value}' castable as xs:{cast_type}")
+    return _castable(_plain_str(value) if isinstance(value, str) else _xpath_clean_value(value), _plain_str(cast_type))
 
 
 @utils_ns("exists")
@@ -311,17 +681,40 @@ def xpath_u_exists(_, value):
     return bool(value)
 
 
+@utils_ns("in_codelist")
+def xpath_u_in_codelist(_, name: str, value: XPathObject) -> bool:
+    """
+    Handles translating the code list checks of XPath2 with a lookup in the frozensets of `codelists.py`,
+    the code list being named after the schematron file and its ``let``. For a node-set, any of its values can match.
+    For example:
+    XPath2: some $code in $ISO4217 satisfies @currencyID = $code
+    XPath1: u:in_codelist('PEPPOL-EN16931-UBL.sch#ISO4217', @currencyID)
+    """
+    codes = CODE_LISTS.get(name)
+    if codes is None:
+        raise ValueError(f"Unknown code list: {name}")
+    if isinstance(value, list):
+        return any((node.text or "" if isinstance(node, _Element) else node) in codes for node in value)
+    return value in codes
+
+
 @utils_ns("round")
-def xpath_u_round(_, value: float, precision: float):
+def xpath_u_round(_, value: XPathObject, precision: float):
     """
     Handles translating the complex round to 2 digit query in XPath2.
+    The rounding is done on decimals (see `_xpath_decimal`), with the XPath2 rounding of halves towards positive
+    infinity, where the float `round` would round ``0.125`` to ``0.12``.
     For example:
     XPath2: (round($num * 10 * 10) div 100)
     XPath1: u:round($num, 2)
     """
     if not value:
         return 0
-    return round(value, int(precision))
+    decimal_value = _xpath_decimal(value)
+    if not decimal_value.is_finite():
+        return float(decimal_value)
+    rounding = ROUND_HALF_UP if decimal_value >= 0 else ROUND_HALF_DOWN
+    return float(decimal_value.quantize(Decimal(1).scaleb(-int(precision)), rounding=rounding))
 
 
 @utils_ns("upper_case")
@@ -420,6 +813,10 @@ def xpath_u_replace(_, value: XPathObject, pattern: str, replacement: str) -> st
 ################################################################################
 
 
+_eusr_per_euc_subsets = etree.XPath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
+_eusr_end_user_countries = etree.XPath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
+
+
 @utils_ns("id_SCH_EUSR_40")
 def xpath_u_id_sch_eusr_40(ctx):
     """
@@ -431,30 +828,18 @@ def xpath_u_id_sch_eusr_40(ctx):
                 every $euc in (eusr:Key[normalize-space(@schemeID) = 'EndUserCountry'])
                 satisfies normalize-space($euc) = normalize-space($steuc)
             ]) = 1
+    The subsets are visited once: a subset satisfies the inner ``every`` for a country if all its keys are that
+    country, or for any country if it has no key at all. So the count is looked up in a counter, instead of
+    visiting all the subsets again for each key.
     """
-    subset_nodes = ctx.context_node.xpath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
+    subset_countries = [
+        {_xpath_normalized(key_node) for key_node in _eusr_end_user_countries(subset_node)}
+        for subset_node in _eusr_per_euc_subsets(ctx.context_node)
+    ]
+    matching_subsets = Counter(next(iter(countries)) for countries in subset_countries if len(countries) == 1)
+    keyless_subsets = sum(1 for countries in subset_countries if not countries)
 
-    if not subset_nodes:
-        return True
-
-    for subset_node in subset_nodes:
-        key_nodes = subset_node.xpath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
-        if not key_nodes:
-            continue
-
-        for key_node in key_nodes:
-            key_value = key_node.text
-            count = 0
-            other_subset_nodes = ctx.context_node.xpath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
-            for other_subset_node in other_subset_nodes:
-                other_key_nodes = other_subset_node.xpath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
-                for other_key_node in other_key_nodes:
-                    if other_key_node.text == key_value:
-                        count += 1
-            if count != 1:
-                return False
-
-    return True
+    return all(matching_subsets[country] + keyless_subsets == 1 for countries in subset_countries for country in countries)
 
 
 @utils_ns("xrechnung_verify_iban")
@@ -470,16 +855,356 @@ def xpath_u_xrechnung_verify_iban(_, value: str) -> bool:
             )
         ) mod 97 = 1
     """
-    codepoints = [ord(ch) for ch in value]
-    res_str_list: list[str] = []
-    for codepoint in codepoints:
-        if codepoint > 64:
-            res_str_list.append(str(codepoint - 55))
-        else:
-            res_str_list.append(str(codepoint - 48))
+    return _iban_checksum(_plain_str(value))
+
+
+################################################################################
+# Document Index
+################################################################################
+
+# Per document caches, keyed by the `id` of the root element, and alive for the duration of `indexed_document`.
+# `index` holds the elements by tag (in document order), read by `u:indexed`. The other caches are filled lazily
+# by the `u:` functions using them.
+_document_caches: dict[int, dict] = {}
+# Functions whose result is a boolean, so that a predicate calling them can't be a positional one
+_XPATH_BOOLEAN_FUNCTIONS = {"not", "boolean", "true", "false", "contains", "starts-with", "u:exists", "re:test"}
+
+
+@contextmanager
+def indexed_document(xml: _Element):
+    """
+    Index all the elements of the document of `xml` in a single pass, for as long as the context is open.
+    Nested contexts on the same document reuse the outer index.
+    """
+    root = xml.getroottree().getroot()
+    key = id(root)
+    if key in _document_caches:
+        yield
+        return
+
+    index: dict[str, XPathList] = {}
+    for node in root.iter(etree.Element):
+        index.setdefault(node.tag, []).append(node)
+
+    _document_caches[key] = {"index": index}
+    try:
+        yield
+    finally:
+        del _document_caches[key]
+
+
+def _document_cache(node: _Element) -> Optional[dict]:
+    """Return the caches of the document of `node`, or `None` if it isn't within `indexed_document`."""
+    return _document_caches.get(id(node.getroottree().getroot()))
+
+
+@utils_ns("indexed")
+def xpath_u_indexed(ctx, tag: str) -> XPathList:
+    """
+    Same result as the absolute ``//prefix:Name`` step, but answered from the document index when there is one.
+    `_xpath_index_query` does the rewrite, with the clark notation of the tag.
+    For example:
+    XPath: //cac:TaxCategory
+    Rewrite: u:indexed('{urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2}TaxCategory')
+    """
+    cache = _document_cache(ctx.context_node)
+    if cache is None:
+        return list(ctx.context_node.getroottree().getroot().iter(tag))
+    return cache["index"].get(tag, [])
+
+
+def _xpath_is_positional_predicate(tokens: List[Tuple[str, str, int]]) -> bool:
+    """
+    Check whether the tokens of a predicate (without the brackets) may select by position, like ``[1]`` or ``[last()]``.
+    Those select relative to each parent in ``//cac:X[1]``, but relative to the whole node-set in ``u:indexed(...)[1]``.
+    Anything that isn't clearly a boolean or a node-set is reported as positional.
+    """
+    level = 0
+    top_values = []
+    for kind, value, _offset in tokens:
+        if value in (")", "]"):
+            level -= 1
+        elif level == 0:
+            top_values.append((kind, value))
+        if value in ("(", "["):
+            level += 1
+
+    values = [value for _kind, value in top_values]
+    if not values or {"position", "last", "+", "-", "div", "mod"} & set(values):
+        return True
+    if {"=", "!=", "<", ">", "<=", ">=", "and", "or"} & set(values):
+        return False
+
+    kind, value = top_values[0]
+    if kind == "name":
+        is_function = len(values) > 1 and values[1] == "("
+        return is_function and value not in _XPATH_BOOLEAN_FUNCTIONS
+    return not (kind == "axis" or value in ("@", ".", "..", "/", "//"))
+
+
+def _xpath_index_query(query: str, namespaces: dict[str, str]) -> str:
+    """
+    Rewrite the absolute ``//prefix:Name`` steps of an XPath1 query into ``u:indexed('{uri}Name')``, so that
+    they are answered from the document index (see `indexed_document`) instead of walking the whole tree each time.
+    Steps followed by a positional predicate are kept as they are, and so is any query that can't be tokenized.
+    """
+    tokens = _xpath_tokenize(query)
+    if tokens is None or "u" not in namespaces:
+        return query
+
+    replacements = []
+    for i, state, _depth in _xpath_walk(tokens):
+        if tokens[i][1] != "//" or state != "start" or i + 1 >= len(tokens):
+            continue
+        kind, name, offset = tokens[i + 1]
+        prefix, _, local = name.rpartition(":")
+        if kind != "name" or local == "*" or (prefix and prefix not in namespaces):
+            continue
+
+        # Check the predicates following the step, if any
+        j = i + 2
+        if j < len(tokens) and tokens[j][1] == "(":
+            continue
+        positional = False
+        while j < len(tokens) and tokens[j][1] == "[":
+            level, k = 0, j
+            for k in range(j, len(tokens)):
+                if tokens[k][1] == "[":
+                    level += 1
+                elif tokens[k][1] == "]":
+                    level -= 1
+                    if level == 0:
+                        break
+            positional = positional or _xpath_is_positional_predicate(tokens[j + 1 : k])
+            j = k + 1
+        if positional:
+            continue
 
-    res_int = int("".join(res_str_list))
-    return res_int % 97 == 1
+        tag = f"{{{namespaces[prefix]}}}{local}" if prefix else local
+        replacements.append((tokens[i][2], offset + len(name), f"u:indexed('{tag}')"))
+
+    for start, end, replacement in reversed(replacements):
+        query = query[:start] + replacement + query[end:]
+    return query
+
+
+################################################################################
+# Upper-case Comparisons
+################################################################################
+
+_XPATH_LOWER_CASE = "abcdefghijklmnopqrstuvwxyz"
+_XPATH_UPPER_CASE = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+# Characters `u:upper_case` and ``translate(., _XPATH_LOWER_CASE, _XPATH_UPPER_CASE)`` surely agree on
+_XPATH_UPPER_CASE_SAFE = _XPATH_LOWER_CASE + _XPATH_UPPER_CASE + "0123456789 "
+# Tokens around a ``u:upper_case(...) = 'literal'`` comparison that bind looser than the comparison itself
+_XPATH_LOOSE_BEFORE = {"", "(", "[", ",", "and", "or"}
+_XPATH_LOOSE_AFTER = {"", ")", "]", ",", "and", "or"}
+
+
+def _xpath_closing_parenthesis(tokens: List[Tuple[str, str, int]], i: int) -> Optional[int]:
+    """Index of the ``)`` closing the ``(`` at index `i`, if any."""
+    level = 0
+    for j in range(i, len(tokens)):
+        if tokens[j][1] == "(":
+            level += 1
+        elif tokens[j][1] == ")":
+            level -= 1
+            if level == 0:
+                return j
+    return None
+
+
+def _xpath_upper_case_query(query: str) -> str:
+    """
+    Rewrite the ``u:upper_case(...) = 'literal'`` comparisons (optionally wrapped in ``normalize-space``), such as
+    ``cac:TaxScheme[normalize-space(u:upper_case(cbc:ID)) = 'VAT']``, so that libxml2 answers them with ``translate``
+    instead of calling back into Python for every node. The callback is only left for values that don't match and
+    have characters out of `_XPATH_UPPER_CASE_SAFE`, where Python may upper-case differently (``ß``, ``ſ``, ...):
+    XPath: u:upper_case(X) = 'VAT'
+    Rewrite: (translate(X, <lower>, <upper>) = 'VAT' or (translate(X, <safe>, '') != '' and u:upper_case(X) = 'VAT'))
+    ``!=`` comparisons are rewritten as the negation of the ``=`` one.
+    """
+    tokens = _xpath_tokenize(query)
+    if tokens is None or "u:upper_case" not in query:
+        return query
+
+    replacements = []
+    for i, state, _depth in _xpath_walk(tokens):
+        if tokens[i][1] != "u:upper_case" or state != "start" or i + 1 >= len(tokens) or tokens[i + 1][1] != "(":
+            continue
+        closing = _xpath_closing_parenthesis(tokens, i + 1)
+        if closing is None or closing == i + 2 or any(value == "u:upper_case" for _kind, value, _offset in tokens[i + 2 : closing]):
+            continue
+
+        # The compared value, either the upper-case call itself or the normalize-space wrapping it
+        first, last = i, closing
+        if i >= 2 and tokens[i - 2][1] == "normalize-space" and tokens[i - 1][1] == "(" and closing + 1 < len(tokens) and tokens[closing + 1][1] == ")":
+            first, last = i - 2, closing + 1
+        if last + 2 >= len(tokens) or tokens[last + 1][1] not in ("=", "!=") or tokens[last + 2][0] != "literal":
+            continue
+        # A non ASCII literal could be equal to a value `translate` left alone, but that Python upper-cases
+        operator, literal = tokens[last + 1][1], tokens[last + 2][1]
+        before = tokens[first - 1][1] if first else ""
+        after = tokens[last + 3][1] if last + 3 < len(tokens) else ""
+        if not literal.isascii() or before not in _XPATH_LOOSE_BEFORE or after not in _XPATH_LOOSE_AFTER:
+            continue
+
+        argument = query[tokens[i + 2][2] : tokens[closing][2]].strip()
+        value = query[tokens[first][2] : tokens[last + 1][2]].strip()
+        upper_case = f"translate({argument}, '{_XPATH_LOWER_CASE}', '{_XPATH_UPPER_CASE}')"
+        native = (query[tokens[first][2] : tokens[i][2]] + upper_case + query[tokens[closing][2] + 1 : tokens[last + 1][2]]).strip()
+        equal = f"({native} = {literal} or (translate({argument}, '{_XPATH_UPPER_CASE_SAFE}', '') != '' and {value} = {literal}))"
+        start, end = tokens[first][2], tokens[last + 2][2] + len(literal)
+        replacements.append((start, end, equal if operator == "=" else f"not{equal}"))
+
+    for start, end, replacement in reversed(replacements):
+        query = query[:start] + replacement + query[end:]
+    return query
+
+
+################################################################################
+# Tax Category Totals
+################################################################################
+
+_TAX_LINE_TAGS = {f"{{{GNSMAP['cac']}}}InvoiceLine": "InvoiceLine", f"{{{GNSMAP['cac']}}}CreditNoteLine": "CreditNoteLine"}
+_TAX_ALLOWANCE_CHARGE_TAG = f"{{{GNSMAP['cac']}}}AllowanceCharge"
+# `cbc:ChargeIndicator` value to the key used in the totals
+_TAX_CHARGE_INDICATORS = {"true": "charge", "false": "allowance"}
+
+
+def _tax_category_totals(parent: _Element) -> dict[tuple, Decimal]:
+    """
+    Sum, in a single pass over the lines and the document level charges/allowances of `parent` (the invoice or
+    credit note), the amounts grouped by tax category ID, with and without the tax category percent.
+    The keys are (kind, code) and (kind, code, percent), kind being InvoiceLine, CreditNoteLine, charge or allowance.
+    The grouping follows exactly the predicates of `schematron_lxml_const._get_br_code_08_sum_str`: the lines are
+    matched on the numeric value of their first percent, the charges/allowances on the string value of any of them.
+    The amounts are added as decimals (see `_amount_decimal`).
+    """
+    totals: dict[tuple, Decimal] = {}
+
+    def add(keys: list[tuple], amounts: XPathList):
+        for amount in amounts:
+            value = _amount_decimal(amount)
+            for key in keys:
+                totals[key] = totals.get(key, Decimal(0)) + value
+
+    for child in parent.iterchildren(etree.Element):
+        if child.tag in _TAX_LINE_TAGS:
+            kind = _TAX_LINE_TAGS[child.tag]
+            if child.find("cac:Item/cac:ClassifiedTaxCategory", GNSMAP) is None:
+                continue
+            category_id = child.find("cac:Item/cac:ClassifiedTaxCategory/cbc:ID", GNSMAP)
+            code = _xpath_normalized(category_id) if category_id is not None else ""
+            keys = [(kind, code)]
+            percent = child.find("cac:Item/cac:ClassifiedTaxCategory/cbc:Percent", GNSMAP)
+            if percent is not None:
+                keys.append((kind, code, _xpath_number(percent)))
+            add(keys, child.findall("cbc:LineExtensionAmount", GNSMAP))
+
+        elif child.tag == _TAX_ALLOWANCE_CHARGE_TAG:
+            if child.find("cac:TaxCategory", GNSMAP) is None:
+                continue
+            category_id = child.find("cac:TaxCategory/cbc:ID", GNSMAP)
+            code = _xpath_normalized(category_id) if category_id is not None else ""
+            percents = {_xpath_string(percent) for percent in child.findall("cac:TaxCategory/cbc:Percent", GNSMAP)}
+            indicators = {_xpath_string(indicator) for indicator in child.findall("cbc:ChargeIndicator", GNSMAP)}
+            for indicator in indicators & _TAX_CHARGE_INDICATORS.keys():
+                kind = _TAX_CHARGE_INDICATORS[indicator]
+                add([(kind, code)] + [(kind, code, percent) for percent in percents], child.findall("cbc:Amount", GNSMAP))
+
+    return totals
+
+
+@utils_ns("tax_category_total")
+def xpath_u_tax_category_total(_, parent: XPathList, line_element: str, code: str, percent: Optional[XPathList] = None) -> float:
+    """
+    Handles the sums of the ``BR-*-08`` asserts (see `schematron_lxml_const._get_br_code_08_sum_str`):
+        sum(../../../cac:InvoiceLine[<category is code (and percent is $VAR)>]/cbc:LineExtensionAmount)
+        + sum(../../../cac:AllowanceCharge[<charge, category is code (and percent is $VAR)>]/cbc:Amount)
+        - sum(../../../cac:AllowanceCharge[<allowance, category is code (and percent is $VAR)>]/cbc:Amount)
+    XPath1: u:tax_category_total(../../.., 'InvoiceLine', 'S', $VAR)
+    The totals are computed once per document (see `_tax_category_totals`), instead of once per category and percent.
+    """
+    # Sums over empty node-sets, or nothing can be equal to an empty `$VAR`
+    if not parent or (percent is not None and not percent):
+        return 0.0
+
+    cache = _document_cache(parent[0])
+    if cache is None:
+        totals = _tax_category_totals(parent[0])
+    else:
+        parent_totals = cache.setdefault("tax_totals", {})
+        if parent[0] not in parent_totals:
+            parent_totals[parent[0]] = _tax_category_totals(parent[0])
+        totals = parent_totals[parent[0]]
+
+    if percent is None:
+        keys = [(line_element, code), ("charge", code), ("allowance", code)]
+    else:
+        # `number($VAR)` for the lines, and the string value of `$VAR` for the charges/allowances
+        percent_str = _xpath_string(percent[0])
+        keys = [(line_element, code, _xpath_number(percent[0])), ("charge", code, percent_str), ("allowance", code, percent_str)]
+
+    line_total, charge_total, allowance_total = (totals.get(key, Decimal(0)) for key in keys)
+    return float(line_total + charge_total - allowance_total)
+
+
+################################################################################
+# Decimal Amounts
+################################################################################
+
+# What XPath1 `number` accepts, the rest being NaN
+_XPATH_NUMBER_RE = re.compile(r"[ \t\r\n]*(-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)[ \t\r\n]*")
+_DECIMAL_NAN = Decimal("NaN")
+
+
+def _decimal_from_text(text: str) -> Decimal:
+    match = _XPATH_NUMBER_RE.fullmatch(text)
+    return Decimal(match.group(1)) if match else _DECIMAL_NAN
+
+
+def _amount_decimal(node: _Element) -> Decimal:
+    """The exact value of an amount element, parsed only once per document (see `indexed_document`)."""
+    cache = _document_cache(node)
+    if cache is None:
+        return _decimal_from_text(_xpath_string(node))
+
+    decimals = cache.setdefault("decimals", {})
+    if node not in decimals:
+        decimals[node] = _decimal_from_text(_xpath_string(node))
+    return decimals[node]
+
+
+def _xpath_decimal(value: XPathObject) -> Decimal:
+    """
+    Convert an XPath value into a `Decimal`, like XPath1 `number` would.
+    A float is taken by its shortest representation (``repr``), rather than by its exact binary value: ``0.1`` becomes
+    ``Decimal('0.1')``, not ``Decimal('0.1000000000000000055511151231257827...')``. This doesn't undo the error of a
+    previous float operation: ``0.1 + 0.2`` still becomes ``Decimal('0.30000000000000004')``.
+    """
+    if isinstance(value, list):
+        if not value:
+            return _DECIMAL_NAN
+        value = value[0]
+        return _amount_decimal(value) if isinstance(value, _Element) else _decimal_from_text(str(value))
+    if isinstance(value, bool):
+        return Decimal(int(value))
+    if isinstance(value, float | int):
+        return Decimal(repr(value))
+    return _decimal_from_text(str(value))
+
+
+@utils_ns("amount_sum")
+def xpath_u_amount_sum(_, nodes: XPathList) -> float:
+    """
+    Exact drop-in replacement for ``sum`` over amounts: the values are added as decimals, so that summing
+    many 2 digit amounts doesn't drift, and only the total is converted to a float.
+    For example:
+    XPath1: sum(//cac:InvoiceLine/cbc:LineExtensionAmount)
+    Rewrite: u:amount_sum(//cac:InvoiceLine/cbc:LineExtensionAmount)
+    """
+    return float(sum((_amount_decimal(node) for node in nodes if isinstance(node, _Element)), Decimal(0)))
 
 
 ################################################################################
@@ -488,17 +1213,27 @@ def xpath_u_xrechnung_verify_iban(_, value: str) -> bool:
 
 
 class Element(Generic[T]):
+    variable_type = "element variable"
+
     def __init__(self, namespaces: dict[str, str], parent: Optional["Element"] = None):
         self.namespaces = namespaces
         self.children: List[T] = []
-        self._variables: List[Tuple[str, str]] = []
+        # List of 4 element tuples, consisting of name, query, compiled query, and whether it depends on the context node
+        self._variables: List[Tuple[str, str, etree.XPath | XPathCompileError, bool]] = []
         self.parent: Optional[Element] = parent
         self.root_name: str = parent.root_name if parent else ""
+        # Shared by the whole Element tree, filled while compiling the queries in `ElementSchematron.from_sch`
+        self.compile_errors: List[str] = parent.compile_errors if parent else []
+
+    def add_variable(self, name: str, query: str):
+        """Compile and add an already rewritten (see `_xpath_variable_query`) XPath1 variable query."""
+        xpath = compile_xpath(query, self.namespaces, self.compile_errors, self.variable_type, name)
+        self._variables.append((name, query, xpath, _xpath_depends_on_context(query, self.context_variables)))
 
-    def add_variable(self, name: str, path: str):
-        query = _xpath_normalize_query(path)
-        query = VARIABLE_REPLACE_MAP.get(name, QUERY_REPLACE_MAP.get(query, _xpath_transform_query(query)))
-        self._variables.append((name, query))
+    @property
+    def context_variables(self) -> set[str]:
+        """Names of the variables at the current level whose value depends on the context node."""
+        return {name for name, _query, _xpath, context_dependent in self._variables if context_dependent}
 
     @property
     def variables(self):
@@ -507,22 +1242,30 @@ class Element(Generic[T]):
         else:
             return self._variables
 
-    def run(self, xml: _Element, variables: dict, schematron_vals: dict) -> Tuple[List[str], List[str]]:
-        """Evaluate the variables at the current level, and then run the children."""
+    def evaluate_variables(self, xml: _Element, variables: dict, schematron_vals: dict) -> dict:
+        """Return a copy of `variables` updated with the variables at the current level."""
         element_variables = variables.copy()
 
-        for name, query in self._variables:
+        for name, _query, xpath, _context_dependent in self._variables:
             if name in VARIABLE_TO_IGNORE:
                 continue
 
-            schematron_vals["current"] = {"key": name, "type": "element variable"}
-            element_variables[name] = try_xpath(xml, query, self.namespaces, element_variables, schematron_vals)
+            schematron_vals["current"] = {"key": name, "type": self.variable_type}
+            element_variables[name] = try_xpath(xml, xpath, element_variables, schematron_vals)
+
+        return element_variables
+
+    def run(self, xml: _Element, variables: dict, schematron_vals: dict) -> Tuple[List[str], List[str]]:
+        """Evaluate the variables at the current level, and then run the children."""
+        element_variables = self.evaluate_variables(xml, variables, schematron_vals)
 
         warning, fatal = [], []
         for child in self.children:
             res_warning, res_fatal = child.run(xml, element_variables, schematron_vals)
             warning += res_warning
             fatal += res_fatal
+            if schematron_vals.get("fail_fast") and schematron_vals.get("fatal_count"):
+                break
 
         return warning, fatal
 
@@ -536,6 +1279,7 @@ class ElementSchematron(Element):
     def from_sch(cls, sch: _Element, root_name: str):
         """
         Construct the Element tree by traversing the schematron and appending all necessary child elements to their own `children`.
+        Every context, variable and assert query is compiled once here, and any compile error is kept in `compile_errors`.
         The Element tree will then look like this:
 
         ElementSchematron
@@ -550,13 +1294,14 @@ class ElementSchematron(Element):
             Updates the given element object with the variables local to the particular node it corresponds to.
             """
             for var in node.findall("./let", namespaces=sch_namespace):
-                element.add_variable(var.get("name") or "", var.get("value") or "")
+                name = var.get("name") or ""
+                element.add_variable(name, _xpath_variable_query(name, var.get("value") or ""))
 
         # This is the namespace used to interpret the sch file
         sch_namespace = {"": "http://purl.oclc.org/dsdl/schematron"}
 
         # Generate the namespaces used to interpet the documents to be validated
-        namespace_dict: dict[str, str] = {"re": "http://exslt.org/regular-expressions"}
+        namespace_dict: dict[str, str] = {"re": "http://exslt.org/regular-expressions", "u": "utils"}
         for ns in sch.findall("./ns", namespaces=sch_namespace):
             namespace_dict.update({ns.get("prefix") or "": ns.get("uri") or ""})
 
@@ -569,17 +1314,108 @@ class ElementSchematron(Element):
             add_all_variable(pattern, pattern_node)
 
             for rule_node in pattern_node.findall("./rule", namespaces=sch_namespace):
-                rule = pattern.add_element_rule(rule_node.get("context") or "")
+                rule = pattern.add_element_rule(_xpath_context_query(rule_node.get("context") or ""))
                 add_all_variable(rule, rule_node)
                 for assertion in rule_node.findall("./assert", namespaces=sch_namespace):
+                    assert_id = assertion.get("id") or ""
                     rule.add_assert(
-                        assertion.get("id") or "",
+                        assert_id,
                         assertion.get("flag") or "",
-                        assertion.get("test") or "",
+                        _xpath_assert_query(assert_id, assertion.get("test") or ""),
                         assertion.text or "",
                     )
         return schematron
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        """
+        Construct the Element tree from the output of `to_dict`.
+        The queries are already rewritten to XPath1, so they only need to be compiled again.
+        """
+        schematron = cls(namespaces=data["namespaces"], parent=None)
+        schematron.root_name = data["root_name"]
+        for name, query in data["variables"]:
+            schematron.add_variable(name, query)
+
+        for pattern_data in data["patterns"]:
+            pattern = schematron.add_element_pattern(pattern_data["pattern_id"])
+            for name, query in pattern_data["variables"]:
+                pattern.add_variable(name, query)
+
+            for rule_data in pattern_data["rules"]:
+                rule = pattern.add_element_rule(rule_data["context"])
+                for name, query in rule_data["variables"]:
+                    rule.add_variable(name, query)
+                for assert_id, flag, query, message in rule_data["assertions"]:
+                    rule.add_assert(assert_id, flag, query, message)
+        return schematron
+
+    def to_dict(self) -> dict:
+        """
+        Serialize the Element tree into JSON compatible data: the rewritten XPath1 queries, flags, messages,
+        variable scopes and namespaces. Use `from_dict` to construct the Element tree back.
+        """
+
+        def dump_variables(element: Element) -> list[list[str]]:
+            return [[name, query] for name, query, *_ in element._variables]
+
+        return {
+            "root_name": self.root_name,
+            "namespaces": self.namespaces,
+            "variables": dump_variables(self),
+            "patterns": [
+                {
+                    "pattern_id": pattern.pattern_id,
+                    "variables": dump_variables(pattern),
+                    "rules": [
+                        {
+                            "context": rule.context_path,
+                            "variables": dump_variables(rule),
+                            "assertions": [[assert_id, flag, query, message] for assert_id, flag, query, _xpath, message, _context_dependent in rule._assertions],
+                        }
+                        for rule in pattern.children
+                    ],
+                }
+                for pattern in self.children
+            ],
+        }
+
+    def run(
+        self,
+        xml: _Element,
+        variables: dict,
+        schematron_vals: dict,
+        fail_fast: bool = False,
+        order_by_failures: bool = False,
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Same as `Element.run`, with the document indexed once for the whole run (see `indexed_document`).
+        The patterns run one after the other: evaluating them in a thread pool on the shared document was slower
+        (the `u:` functions are Python callbacks holding the GIL), so only processes scale (see `validate_many`).
+        :param fail_fast: stop as soon as a fatal assertion fails, for callers only needing a pass/fail answer.
+                          The messages gathered until then are returned, so `fatal` holds at least one message
+                          if and only if the document is rejected.
+        :param order_by_failures: run first the patterns that failed most often in the previous runs of this process
+                                  (see `ElementPattern.failure_rate`), so that a rejected document fails fast sooner.
+        """
+        schematron_vals["fail_fast"] = fail_fast
+        patterns = self.children
+        if order_by_failures:
+            patterns = sorted(patterns, key=lambda pattern: pattern.failure_rate, reverse=True)
+
+        with indexed_document(xml):
+            element_variables = self.evaluate_variables(xml, variables, schematron_vals)
+
+            warning, fatal = [], []
+            for pattern in patterns:
+                res_warning, res_fatal = pattern.run(xml, element_variables, schematron_vals)
+                warning += res_warning
+                fatal += res_fatal
+                if schematron_vals["fail_fast"] and schematron_vals.get("fatal_count"):
+                    break
+
+            return warning, fatal
+
     def add_element_pattern(self, pattern_id="") -> "ElementPattern":
         self.children.append(ElementPattern(pattern_id, self.namespaces, self))
         return self.children[-1]
@@ -590,99 +1426,1191 @@ class ElementPattern(Element):
         super().__init__(namespaces=namespaces, parent=parent)
         self.children: List[ElementRule] = []
         self.pattern_id = pattern_id
+        # Statistics of the runs in this process, see `failure_rate`
+        self.run_count = 0
+        self.fatal_count = 0
 
-    def add_element_rule(self, context: str) -> "ElementRule":
-        self.children.append(ElementRule(context, namespaces=self.namespaces, parent=self))
+    @property
+    def failure_rate(self) -> float:
+        """Share of the runs of this pattern that had at least one failed fatal assertion."""
+        return self.fatal_count / self.run_count if self.run_count else 0.0
+
+    def run(self, xml: _Element, variables: dict, schematron_vals: dict) -> Tuple[List[str], List[str]]:
+        fatal_count = schematron_vals.get("fatal_count", 0)
+        warning, fatal = super().run(xml, variables, schematron_vals)
+        self.run_count += 1
+        if schematron_vals.get("fatal_count", 0) > fatal_count:
+            self.fatal_count += 1
+        return warning, fatal
+
+    def add_element_rule(self, context_path: str) -> "ElementRule":
+        self.children.append(ElementRule(context_path, namespaces=self.namespaces, parent=self))
         return self.children[-1]
 
 
 class ElementRule(Element):
-    def __init__(self, context: str, namespaces: dict, parent: ElementPattern):
+    variable_type = "rule variable"
+
+    def __init__(self, context_path: str, namespaces: dict, parent: ElementPattern):
+        """:param context_path: the already rewritten (see `_xpath_context_query`) XPath1 context query"""
         super().__init__(namespaces=namespaces, parent=parent)
+        self.context_path = context_path
+        self.context_xpath = compile_xpath(context_path, self.namespaces, self.compile_errors, "rule context", "<context>")
+
+        # List of 6 element tuples, consisting of assert_id, flag, query, compiled query, message,
+        # and whether it depends on the context node
+        self._assertions: List[Tuple[str, str, str, etree.XPath | XPathCompileError, str, bool]] = []
 
-        # The received `context` string here is in the format of a " | "-separated context items, and
-        # each context item will be in the format of "OrphanedNode/AdditionalPathToNode" or "/RootNode/PathToNode".
-        # In the first case, we want to prepend them with "//" to explicitly indicate to the Selector
-        # that we need to do a find query to that node, because it doesn't start from the root.
-        split_context = context.split("|")
-        for i, or_context in enumerate(split_context):
-            or_context = or_context.strip()
-            if not or_context.startswith("/"):
-                split_context[i] = f"//{or_context}"
-        context = " | ".join(split_context)
-        context = _xpath_normalize_query(context)
-        self.context_path = QUERY_REPLACE_MAP.get(context, _xpath_transform_query(context))
-
-        # List of 4 element tuples, consisting of assert_id, flag, query, message
-        self._assertions: List[Tuple[str, str, str, str]] = []
-
-    def add_assert(self, assert_id: str, flag: str, test: str, message: str):
-        query = _xpath_normalize_query(test)
-        query = ASSERT_REPLACE_MAP.get(assert_id, _xpath_transform_query(query))
-        self._assertions.append((assert_id, flag, query, message))
+    def add_assert(self, assert_id: str, flag: str, query: str, message: str):
+        """Compile and add an already rewritten (see `_xpath_assert_query`) XPath1 assert query."""
+        xpath = compile_xpath(query, self.namespaces, self.compile_errors, "rule assertion", assert_id)
+        context_dependent = _xpath_depends_on_context(query, self.context_variables)
+        self._assertions.append((assert_id, flag, query, xpath, message, context_dependent))
+
+    def assert_message(self, assert_id: str, message: str) -> str:
+        """Message reported for a failed assertion."""
+        return f"[{assert_id}]-{message}" if self.root_name == "PEPPOL" else message
 
     def run(self, xml: _Element, variables: dict, schematron_vals: dict):
         """
         This method overrides Element.run function because ElementRule is at the bottom of the Element tree,
         and it does not have any children.
 
-        Here, we evaluate through all the gathered assertions and variables, and evaluate the XML with some
-        strategies to combat the severe performance issues from running elementpath.Selector.select multiple times.
+        Here, we evaluate through all the gathered assertions and variables, using the XPath objects compiled
+        in `ElementSchematron.from_sch`, so no query is parsed again while running.
+        Variables and assertions that don't depend on the context node are only evaluated on the first context node:
+        the variables are reused for the other nodes, and a failed assertion is reported once.
         """
-        element_variables = variables.copy()
         schematron_vals["current"] = {"key": "<context>", "type": "rule context"}
-        context_nodes = try_xpath(xml, self.context_path, self.namespaces, element_variables, schematron_vals)
-        warning, fatal = [], []
-
+        context_nodes = try_xpath(xml, self.context_xpath, variables, schematron_vals)
         if not isinstance(context_nodes, list):
-            return warning, fatal
+            return [], []
+
+        return self.run_context_nodes(context_nodes, variables, schematron_vals, {})
 
+    def run_context_nodes(
+        self, context_nodes: XPathList, variables: dict, schematron_vals: dict, rule_state: dict
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Evaluate the variables and assertions on already selected context nodes (see `run`).
+        `rule_state` keeps the context independent variables once evaluated: passing the same dictionary for several
+        batches of context nodes of one document (as `SchematronRegistry.validate_stream` does) evaluates them,
+        and reports their failed assertions, only once.
+        """
+        warning, fatal = [], []
+        document_variables: dict[str, XPathObject] = rule_state.setdefault("document_variables", {})
         for context_node in context_nodes:
             if not isinstance(context_node, _Element):
                 continue
+            first_node = rule_state.setdefault("first_node", True)
 
             # If the rule has additional variable, we evaluate them here.
-            rule_variables: dict[str, XPathObject] = element_variables.copy()
-            if self._variables:
-                for name, query in self._variables:
-                    schematron_vals["current"] = {"key": "name", "type": "rule variable"}
-                    rule_variables[name] = try_xpath(context_node, query, self.namespaces, rule_variables, schematron_vals)
-
-            for assert_id, flag, query, message in self._assertions:
+            rule_variables: dict[str, XPathObject] = variables.copy()
+            for name, _query, xpath, context_dependent in self._variables:
+                if not context_dependent and not first_node:
+                    rule_variables[name] = document_variables[name]
+                    continue
+                schematron_vals["current"] = {"key": name, "type": self.variable_type}
+                rule_variables[name] = try_xpath(context_node, xpath, rule_variables, schematron_vals)
+                if not context_dependent:
+                    document_variables[name] = rule_variables[name]
+
+            for assert_id, flag, query, xpath, message, context_dependent in self._assertions:
+                if not context_dependent and not first_node:
+                    continue
                 schematron_vals["current"] = {"key": assert_id, "type": "rule assertion"}
-                res = try_xpath(context_node, query, self.namespaces, rule_variables, schematron_vals)
-                if not res:
-                    assert_message = f"[{assert_id}]-{message}" if self.root_name == "PEPPOL" else message
-                    if flag == "warning":
-                        warning.append(assert_message)
-                    elif flag == "fatal":
-                        fatal.append(assert_message)
+                res = try_xpath(context_node, xpath, rule_variables, schematron_vals)
+                if res:
+                    continue
+                if flag == "fatal":
+                    schematron_vals["fatal_count"] = schematron_vals.get("fatal_count", 0) + 1
+                sink: Optional[ResultSink] = schematron_vals.get("sink")
+                if sink is not None:
+                    sink.add(self, assert_id, flag, query, context_node, message)
+                elif flag == "warning":
+                    warning.append(self.assert_message(assert_id, message))
+                elif flag == "fatal":
+                    fatal.append(self.assert_message(assert_id, message))
+                if flag == "fatal" and schematron_vals.get("fail_fast"):
+                    return warning, fatal
+            rule_state["first_node"] = False
 
         return warning, fatal
 
 
+################################################################################
+# Compiled Schematron Cache
+################################################################################
+
+SCHEMATRON_CACHE_DIR = ".schematron_cache"
+# The cache key hashes this file, so a change of `ElementSchematron.to_dict` or of the rewrite functions
+# (`_xpath_transform_query` and its helpers) invalidates the cache by itself. Bump this only for a change made
+# elsewhere that alters the cached queries (e.g. a new version of lxml with another XPath dialect).
+SCHEMATRON_CACHE_VERSION = 2
+
+
+def _schematron_cache_key(schematron_path: str) -> str:
+    """
+    Hash of the schematron file, of the rewrite maps in `schematron_lxml_const.py` and of the rewrite functions in
+    this file, so that a cached Element tree is invalidated as soon as one of them changes.
+    """
+    digest = hashlib.sha256(str(SCHEMATRON_CACHE_VERSION).encode())
+    for path in (schematron_path, schematron_lxml_const.__file__, __file__):
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def load_schematron(schematron_path: str, cache_dir: str = SCHEMATRON_CACHE_DIR) -> ElementSchematron:
+    """
+    Return the Element tree of a schematron, skipping the .sch parsing and the query rewriting when possible.
+    On a cache miss, the Element tree is built with `ElementSchematron.from_sch` and written to `cache_dir`,
+    replacing any stale cache file of the same schematron.
+    """
+    root_name = PATH_ROOT_MAP[schematron_path]
+    cache_name = f"{root_name}-{_schematron_cache_key(schematron_path)}.json"
+    cache_path = os.path.join(cache_dir, cache_name)
+
+    try:
+        with open(cache_path, encoding="utf-8") as file:
+            return ElementSchematron.from_dict(json.load(file))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as err:
+        _logger.warning("Ignoring unreadable schematron cache %s: %s", cache_path, err)
+
+    schematron = ElementSchematron.from_sch(etree.parse(schematron_path).getroot(), root_name)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first, so that concurrent workers never read a partially written cache
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(schematron.to_dict(), file)
+        os.replace(tmp_path, cache_path)
+        for file_name in os.listdir(cache_dir):
+            if file_name.startswith(f"{root_name}-") and file_name.endswith(".json") and file_name != cache_name:
+                os.remove(os.path.join(cache_dir, file_name))
+    except OSError as err:
+        _logger.warning("Could not write schematron cache %s: %s", cache_path, err)
+
+    return schematron
+
+
+################################################################################
+# Streaming Validation
+################################################################################
+
+# Children of the document root validated one at a time, as soon as they are parsed (see `validate_stream`)
+STREAM_LINE_TAGS = {
+    f"{{{GNSMAP['cac']}}}InvoiceLine",
+    f"{{{GNSMAP['cac']}}}CreditNoteLine",
+    f"{{{GNSMAP['eusr']}}}Subset",
+    f"{{{GNSMAP['tsr']}}}Subtotal",
+}
+# Lines validated together by `validate_stream`, as an XPath variable of the line rule contexts
+STREAM_LINES_VARIABLE = "stream_lines"
+STREAM_BATCH_SIZE = 256
+# Functions reading anywhere in the document, whatever their arguments are
+_XPATH_DOCUMENT_FUNCTIONS = {"id", "u:indexed", "u:tax_category_total", "u:for_every", "u:id_SCH_EUSR_40"}
+# Axes keeping the depth of the context node, the others going one level down
+_XPATH_LEVEL_AXES = {"self::", "descendant-or-self::", "preceding-sibling::", "following-sibling::"}
+# Functions reading the root element when the query is, that are only given to test whether it exists
+_XPATH_EXISTENCE_FUNCTIONS = {"boolean", "not", "count", "u:exists", "u:if_else"}
+
+
+def _xpath_tag(name: str, namespaces: dict[str, str]) -> Optional[str]:
+    """Clark notation of a name test, or `None` for a wildcard or an unknown prefix."""
+    prefix, _, local = name.rpartition(":")
+    if local == "*" or (prefix and prefix not in namespaces):
+        return None
+    return f"{{{namespaces[prefix]}}}{local}" if prefix else local
+
+
+def _xpath_line_local_variables(
+    query: str, namespaces: dict[str, str], from_root: bool, context_depth: int = 0
+) -> Optional[set[str]]:
+    """
+    Statically check that an XPath1 query reads nothing of the lines (see `STREAM_LINE_TAGS`) but the one of its
+    context node, which is at least `context_depth` levels below the line, or, when `from_root`, that it is evaluated
+    on the document root and reads nothing of the lines.
+    Absolute paths may read the rest of the document (the header), as long as they don't step into a line.
+    Ancestors are only reached by ``..`` (as deep as the context allows), or by name in the `cac` or `cbc` namespaces,
+    which are never the root.
+    Return the names of the variables used by the query, or `None` if the query may read other lines.
+    """
+    tokens = _xpath_tokenize(query)
+    if tokens is None:
+        return None
+    ancestor_namespaces = {namespaces.get("cac"), namespaces.get("cbc")} - {None}
+
+    variables = set()
+    # Least depth below the line of the nodes selected so far by the current location path, `None` if unknown
+    level: Optional[int] = None
+    predicate_levels: List[Optional[int]] = []
+    for i, state, depth in _xpath_walk(tokens):
+        kind, value, _offset = tokens[i]
+        previous_value = tokens[i - 1][1] if i else ""
+        next_value = tokens[i + 1][1] if i + 1 < len(tokens) else ""
+        if state == "start":
+            level = predicate_levels[-1] if predicate_levels else (None if from_root else context_depth)
+
+        if kind == "variable":
+            variables.add(value[1:])
+            level = None
+        elif value in _XPATH_DOCUMENT_FUNCTIONS or value in ("preceding::", "following::"):
+            return None
+        elif value in ("..", "parent::"):
+            if level is None or level < 1:
+                return None
+            level -= 1
+        elif value in ("ancestor::", "ancestor-or-self::"):
+            tag = _xpath_tag(next_value, namespaces)
+            if tag is None or tag[1:].partition("}")[0] not in ancestor_namespaces:
+                return None
+            level = 0
+        elif value in ("preceding-sibling::", "following-sibling::") and (level is None or level < 1):
+            return None
+        elif value == "//" and state == "start":
+            return None
+        elif value == "/" and state == "start":
+            # The root element step, then either a child step that isn't a line, or nothing but an existence test
+            if i + 1 >= len(tokens) or tokens[i + 1][0] != "name" or next_value == "(":
+                return None
+            after_root = tokens[i + 2][1] if i + 2 < len(tokens) else ""
+            if after_root == "/":
+                if i + 3 >= len(tokens) or tokens[i + 3][0] != "name" or _xpath_tag(tokens[i + 3][1], namespaces) in STREAM_LINE_TAGS | {None}:
+                    return None
+            elif not (after_root == "]" or (after_root in (")", ",") and tokens[i - 2][1] in _XPATH_EXISTENCE_FUNCTIONS)):
+                return None
+            level = None
+        elif value == "[":
+            predicate_levels.append(level)
+        elif value == "]":
+            level = predicate_levels.pop() if predicate_levels else None
+        elif value == ")":
+            level = None
+        elif kind == "name" and state != "end" and (next_value != "(" or value in _XPATH_NODE_TESTS):
+            # A node test, one level below unless its axis says otherwise
+            if previous_value in ("ancestor::", "ancestor-or-self::"):
+                pass
+            elif level is not None and previous_value not in _XPATH_LEVEL_AXES:
+                level += 1
+            if from_root and state == "start" and not depth and _xpath_tag(value, namespaces) in STREAM_LINE_TAGS | {None}:
+                return None
+        elif from_root and state == "start" and not depth:
+            # Any other relative path from the document root
+            if kind == "axis" or value in (".", "@"):
+                return None
+            if value in _XPATH_CONTEXT_DEFAULT_FUNCTIONS and i + 2 < len(tokens) and tokens[i + 2][1] == ")":
+                return None
+    return variables
+
+
+def _xpath_line_context(context: str, namespaces: dict[str, str]) -> Optional[Tuple[List[str], int, bool]]:
+    """
+    Rewrite a rule context into the same selection within one line, or return `None` if it can't be done.
+    Return the rewritten members of the union, the least depth of the selected nodes below the line, and whether the context
+    may also select nodes outside of the lines. Each member of the union is rewritten on its own:
+    - ``//cac:InvoiceLine/cac:Item`` (or ``/*/cac:InvoiceLine/cac:Item``) into ``self::cac:InvoiceLine/cac:Item``
+    - ``//cac:Item/cbc:Name`` into ``descendant::cac:Item/cbc:Name``, the `cac` and `cbc` elements never being the root
+    - ``//*[...]`` into ``descendant-or-self::*[...]``
+    """
+    tokens = _xpath_tokenize(context)
+    if tokens is None:
+        return None
+    ancestor_namespaces = {namespaces.get("cac"), namespaces.get("cbc")} - {None}
+
+    members, start, depth = [], 0, 0
+    context_depth: Optional[int] = None
+    split = False
+    for i, (_kind, value, _offset) in enumerate(tokens + [("operator", "|", len(context))]):
+        depth += value in ("(", "[")
+        depth -= value in (")", "]")
+        if value != "|" or depth:
+            continue
+        member = tokens[start:i]
+        start = i + 1
+
+        root_check = ""
+        if len(member) > 1 and member[0][1] == "//":
+            step_index = 1
+        elif len(member) > 3 and member[0][1] == "/" and member[1][0] == "name" and member[2][1] == "/":
+            step_index = 3
+            root_check = "" if member[1][1] == "*" else f"[/{member[1][1]}]"
+        else:
+            return None
+        kind, name, offset = member[step_index]
+        tag = _xpath_tag(name, namespaces)
+        if kind != "name" or (step_index > 1 and tag not in STREAM_LINE_TAGS):
+            return None
+
+        # The predicates of the first step must not select by position, which is relative to another node-set
+        j = step_index + 1
+        while j < len(member) and member[j][1] == "[":
+            level, k = 0, j
+            for k in range(j, len(member)):
+                level += member[k][1] == "["
+                level -= member[k][1] == "]"
+                if level == 0:
+                    break
+            if _xpath_is_positional_predicate(member[j + 1 : k]):
+                return None
+            j = k + 1
+
+        # Each step after the first one is a level below it, outside of the predicates
+        level, member_depth = 0, 0
+        for _kind, value, _offset in member[j:]:
+            level += value == "["
+            level -= value == "]"
+            member_depth += value in ("/", "//") and not level
+
+        end = member[-1][2] + len(member[-1][1])
+        if tag in STREAM_LINE_TAGS:
+            members.append(f"self::{name}{root_check}{context[offset + len(name) : end]}")
+        elif tag is not None and tag[1:].partition("}")[0] in ancestor_namespaces:
+            members.append(f"descendant::{context[offset:end]}")
+            member_depth += 1
+            split = True
+        elif name == "*" and j == len(member):
+            members.append(f"descendant-or-self::{context[offset:end]}")
+            split = True
+        else:
+            return None
+        context_depth = member_depth if context_depth is None else min(context_depth, member_depth)
+
+    return members, context_depth or 0, split
+
+
+# Elements read by `u:` functions, besides the ones named in their arguments, from the node given to them
+_XPATH_FUNCTION_READS = {
+    "u:tax_category_total": " | ".join(
+        f"{path}/{name}"
+        for path in ["cac:InvoiceLine/cac:Item/cac:ClassifiedTaxCategory", "cac:CreditNoteLine/cac:Item/cac:ClassifiedTaxCategory", "cac:AllowanceCharge/cac:TaxCategory"]
+        for name in ["cbc:ID", "cbc:Percent"]
+    ) + " | cac:InvoiceLine/cbc:LineExtensionAmount | cac:CreditNoteLine/cbc:LineExtensionAmount"
+    + " | cac:AllowanceCharge/cbc:ChargeIndicator | cac:AllowanceCharge/cbc:Amount",
+    "u:id_SCH_EUSR_40": "eusr:Subset/eusr:Key",
+}
+# Axes going down to the children, and the axes reaching elements of any parent, which are kept by tag
+_XPATH_CHILD_AXES = ("", "child::")
+_XPATH_TAG_AXES = ("descendant::", "descendant-or-self::", "following-sibling::", "preceding-sibling::", "following::", "preceding::")
+# Tag of the root node, and of the root element when its tag is unknown, as parent tags of `_xpath_read_steps`
+STREAM_ROOT_NODE = "/"
+STREAM_ROOT_ELEMENT = "/*"
+
+
+def _xpath_step_end(tokens: List[Tuple[str, str, int]], i: int) -> int:
+    """Index of the token after the step at `i` (a name, a node test, ``.`` or ``..``) and its predicates."""
+    i += 3 if i + 1 < len(tokens) and tokens[i + 1][1] == "(" else 1
+    depth = 0
+    while i < len(tokens) and (depth or tokens[i][1] == "["):
+        depth += {"[": 1, "]": -1}.get(tokens[i][1], 0)
+        i += 1
+    return i
+
+
+def _xpath_step_is_last(tokens: List[Tuple[str, str, int]], i: int) -> bool:
+    """Check whether the step at `i` ends its location path."""
+    end = _xpath_step_end(tokens, i)
+    return end == len(tokens) or tokens[end][1] not in ("/", "//")
+
+
+def _xpath_is_existence_test(tokens: List[Tuple[str, str, int]], start: int, i: int) -> bool:
+    """
+    Check whether the location path from `start` to its last step at `i` is only tested for being empty or not:
+    a predicate, an operand of ``and`` / ``or``, or given to a function like `count`.
+    """
+    before = tokens[start - 1][1] if start else ""
+    end = _xpath_step_end(tokens, i)
+    after = tokens[end][1] if end < len(tokens) else ""
+    if before == "(":
+        return start > 1 and tokens[start - 2][1] in _XPATH_EXISTENCE_FUNCTIONS and after in (")", ",")
+    return before in ("[", "and", "or") and after in ("]", ")", "and", "or")
+
+
+def _xpath_is_function_node_argument(tokens: List[Tuple[str, str, int]], i: int) -> bool:
+    """Check whether the ``..`` token at `i` ends a path like ``../../..`` given as node-set to `u:tax_category_total`."""
+    while i and tokens[i - 1][1] in ("..", "/"):
+        i -= 1
+    return i > 1 and tokens[i - 1][1] == "(" and tokens[i - 2][1] == "u:tax_category_total"
+
+
+def _xpath_read_steps(
+    query: str, namespaces: dict[str, str], context_tags: Optional[set[str]]
+) -> Optional[Tuple[set, set, Optional[set[str]]]]:
+    """
+    Steps to the elements an XPath1 query evaluated on elements tagged `context_tags` (`None` for any element) may read,
+    as (parent tag, tag) pairs, ``*`` standing for any tag and a parent tag of `None` for any parent:
+    the steps it may go through, where the element only has to be there, the steps its paths end with, where the whole
+    element may be read, and the tags of the nodes it selects (`None` if unknown), for a rule context.
+    Return `None` if it can't tell.
+    """
+    tokens = _xpath_tokenize(query)
+    if tokens is None:
+        return None
+
+    through, read = set(), set()
+    selected: Optional[set[str]] = set()
+    # Tags of the nodes the path is at, and the steps which led to them (`None` if unknown),
+    # and the same for the steps owning the predicates the walk is in
+    current, steps = context_tags, set()
+    owners: List[Tuple[Optional[set[str]], Optional[set], int]] = []
+    path_start = 0
+    axis = ""
+    for i, state, depth in _xpath_walk(tokens):
+        kind, value, _offset = tokens[i]
+        next_value = tokens[i + 1][1] if i + 1 < len(tokens) else ""
+        if state == "start":
+            current, steps = owners[-1][:2] if owners else (context_tags, set())
+            path_start = i
+        # Whether the step ends a path outside of the predicates, the nodes it is at being known below
+        selects = (kind == "name" and state != "end" and next_value != "(") or value in (".", "..")
+        selects = selects and not depth and _xpath_step_is_last(tokens, i)
+
+        if kind == "axis":
+            axis = value
+            continue
+        if value == "@":
+            axis = "attribute::"
+            continue
+        if value in ("/", "//") and state == "start":
+            current, steps = ({STREAM_ROOT_NODE} if value == "/" else None), None
+        elif value == "//":
+            current = None
+        elif value == "[":
+            owners.append((current, steps, path_start))
+        elif value == "]":
+            current, steps, path_start = owners.pop()
+        elif value == ")" or kind == "variable":
+            # The nodes of a variable, or of an expression, are read by the paths they come from
+            current, steps = None, set()
+        elif value == "." and _xpath_step_is_last(tokens, i):
+            if steps is None:
+                return None
+            read |= steps
+        elif value == ".." or (value == "node" and axis == "parent::"):
+            # Unless given to a step, or to `u:tax_category_total`, it is the string value of an ancestor,
+            # which may have lost some of its children
+            if _xpath_step_is_last(tokens, i) and not _xpath_is_function_node_argument(tokens, i):
+                return None
+            current, steps = None, None
+        elif kind == "name" and state != "end" and next_value == "(":
+            if value in _XPATH_NODE_TESTS:
+                # The text of the pruned elements is kept, but not the other nodes
+                if value != "text" and not (value == "node" and axis == "self::"):
+                    return None
+            elif value == "id":
+                return None
+            elif value == "u:for_every" or value in _XPATH_FUNCTION_READS:
+                if value == "u:for_every":
+                    # The condition is a query of its own, on the context node
+                    close = _xpath_closing_parenthesis(tokens, i + 1)
+                    if close is None or tokens[close - 1][0] != "literal":
+                        return None
+                    function_steps = _xpath_read_steps(tokens[close - 1][1][1:-1], namespaces, context_tags)
+                else:
+                    function_steps = _xpath_read_steps(_XPATH_FUNCTION_READS[value], GNSMAP, None)
+                if function_steps is None:
+                    return None
+                through |= function_steps[0]
+                read |= function_steps[1]
+            elif value in _XPATH_CONTEXT_DEFAULT_FUNCTIONS and i + 2 < len(tokens) and tokens[i + 2][1] == ")":
+                if steps is None:
+                    return None
+                read |= steps
+        elif kind == "name" and state != "end":
+            tag = _xpath_tag(value, namespaces)
+            if tag is None and value != "*":
+                return None
+            if axis == "attribute::":
+                pass
+            elif axis in _XPATH_CHILD_AXES + _XPATH_TAG_AXES:
+                parents = current if axis in _XPATH_CHILD_AXES else None
+                if parents is None and tag is None:
+                    return None
+                name_steps = {(parent, tag or "*") for parent in parents} if parents is not None else {(None, tag)}
+                through |= name_steps
+                if _xpath_step_is_last(tokens, i) and not _xpath_is_existence_test(tokens, path_start, i):
+                    read |= name_steps
+                if tag is not None:
+                    current = {tag}
+                else:
+                    current = {STREAM_ROOT_ELEMENT} if parents == {STREAM_ROOT_NODE} else None
+                steps = name_steps
+            elif axis in ("parent::", "ancestor::", "ancestor-or-self::") and tag is not None:
+                # The ancestors of an element are kept, if not whole
+                if _xpath_step_is_last(tokens, i):
+                    read.add((None, tag))
+                current, steps = {tag}, {(None, tag)}
+            elif axis == "self::":
+                current = {tag} if tag is not None else current
+            else:
+                return None
+        else:
+            axis = ""
+            continue
+        axis = ""
+        if selects and selected is not None:
+            selected = None if current is None else selected | current
+    return through, read, selected
+
+
+def _xpath_reads_ancestors(query: str) -> bool:
+    """Check whether an XPath1 query may read the ancestors of its context node (or can't be tokenized)."""
+    tokens = _xpath_tokenize(query)
+    return tokens is None or any(value in ("..", "parent::", "ancestor::", "ancestor-or-self::") for _kind, value, _offset in tokens)
+
+
+class StreamPlan:
+    """
+    How `SchematronRegistry.validate_stream` runs a schematron: the rules whose context nodes are all within a line
+    and which read nothing of the other lines are run on each line as soon as it is parsed, and the other rules at the
+    end, on the header and what is left of the lines: the elements the queries of those other rules may read.
+    The rules whose context may also select nodes outside of the lines (like ``//cbc:Amount``, or ``//*[...]`` for the
+    empty elements or the amount decimals) are split: run on each line for its nodes, and at the end for the other
+    ones. Those other nodes are in the header, so only the root element, for a ``//*[...]`` context, may have pruned
+    descendants there, which the predicates of such contexts (testing the name or the children) don't see.
+    """
+
+    def __init__(self, schematron: ElementSchematron):
+        self.schematron = schematron
+        self.namespaces = schematron.namespaces
+        # Element -> names of the variables visible at its level that can be evaluated on the header, before the lines
+        self.header_variables: dict[Element, set[str]] = {}
+        header_variables: set[str] = set()
+        for element in [schematron, *schematron.children]:
+            element_variables = set(header_variables)
+            for name, query, _xpath, _context_dependent in element._variables:
+                used = _xpath_line_local_variables(query, self.namespaces, from_root=True)
+                # The ignored variables are never evaluated, so they are missing the same way from the header
+                if name in VARIABLE_TO_IGNORE or (used is not None and used <= element_variables):
+                    element_variables.add(name)
+                else:
+                    element_variables.discard(name)
+            self.header_variables[element] = element_variables
+            if element is schematron:
+                header_variables = element_variables
+
+        # Line rule -> its context query, compiled relative to the lines of `STREAM_LINES_VARIABLE`
+        self.line_contexts: dict[ElementRule, etree.XPath] = {}
+        # Line rules on any element, which are also run at the end on the nodes outside of the lines
+        self.split_rules: set[ElementRule] = set()
+        for pattern in schematron.children:
+            for rule in pattern.children:
+                line_context = self._line_context(rule)
+                if line_context is not None:
+                    self.line_contexts[rule] = line_context
+
+        # Steps to the line elements the other rules may read (see `_xpath_read_steps`), `None` meaning any element
+        self.kept_steps: Optional[Tuple[set, set]] = (set(), set())
+        queries = [(query, {STREAM_ROOT_NODE}) for element in [schematron, *schematron.children] for _name, query, *_variable in element._variables]
+        for pattern in schematron.children:
+            for rule in pattern.children:
+                rule_queries = [query for _name, query, *_variable in rule._variables]
+                rule_queries += [query for _assert_id, _flag, query, *_assertion in rule._assertions]
+                if rule not in self.line_contexts:
+                    context_steps = _xpath_read_steps(rule.context_path, self.namespaces, {STREAM_ROOT_NODE})
+                    context_tags = None if context_steps is None else context_steps[2]
+                    queries += [(rule.context_path, {STREAM_ROOT_NODE})] + [(query, context_tags) for query in rule_queries]
+                elif rule in self.split_rules:
+                    # Outside of the lines, only going up to the root can get into them (the context itself is filtered)
+                    queries += [(query, None) for query in rule_queries if _xpath_reads_ancestors(query)]
+        for query, context_tags in queries:
+            read_steps = _xpath_read_steps(query, self.namespaces, context_tags)
+            if read_steps is None:
+                self.kept_steps = None
+                break
+            self.kept_steps[0].update(read_steps[0])
+            self.kept_steps[1].update(read_steps[1])
+
+    def _line_context(self, rule: ElementRule) -> Optional[etree.XPath]:
+        """Compiled context of a rule that can be run line by line, or `None`."""
+        rewrite = _xpath_line_context(rule.context_path, self.namespaces)
+        if rewrite is None or isinstance(rule.context_xpath, XPathCompileError):
+            return None
+        members, context_depth, split = rewrite
+        if _xpath_line_local_variables(" | ".join(members), self.namespaces, from_root=False) is None:
+            return None
+
+        available = set(self.header_variables[rule.parent])
+        queries = [(name, query, context_dependent) for name, query, _xpath, context_dependent in rule._variables]
+        queries += [(None, query, context_dependent) for _assert_id, _flag, query, _xpath, _message, context_dependent in rule._assertions]
+        for name, query, context_dependent in queries:
+            if split and not context_dependent:
+                # Only asserts, evaluated on the root by `_run_split_rule`, so reading only the header
+                if name is not None or _xpath_line_local_variables(query, self.namespaces, from_root=True) is None:
+                    return None
+            used = _xpath_line_local_variables(query, self.namespaces, from_root=False, context_depth=context_depth)
+            if used is None or not used <= available:
+                return None
+            if name is not None:
+                available.add(name)
+        if split:
+            self.split_rules.add(rule)
+        # Evaluated on a batch of lines at once (see `run_lines`)
+        line_context = " | ".join(f"${STREAM_LINES_VARIABLE}/{member}" for member in members)
+        xpath = compile_xpath(line_context, self.namespaces, [], "rule context", "<line context>")
+        return None if isinstance(xpath, XPathCompileError) else xpath
+
+    def evaluate_header_variables(self, xml: _Element) -> dict[Element, dict]:
+        """
+        Evaluate the variables of `header_variables` on the root of a document parsed up to its first line,
+        by pattern (and for the schematron itself). Their errors are dropped, because they are evaluated again,
+        with the other variables, in `run_document`.
+        """
+        schematron_vals: dict = {"current": {"type": "", "key": ""}, "errors": []}
+        values: dict[Element, dict] = {}
+        for element in [self.schematron, *self.schematron.children]:
+            element_values = dict(values.get(self.schematron, {}))
+            for name, _query, xpath, _context_dependent in element._variables:
+                if name in VARIABLE_TO_IGNORE:
+                    continue
+                if name in self.header_variables[element]:
+                    element_values[name] = try_xpath(xml, xpath, element_values, schematron_vals)
+                else:
+                    element_values.pop(name, None)
+            values[element] = element_values
+        return values
+
+    def run_lines(
+        self,
+        lines: List[_Element],
+        header_values: dict[Element, dict],
+        line_runs: dict,
+        fail_fast: bool = False,
+        sink: Optional["ResultSink"] = None,
+    ) -> set[_Element]:
+        """
+        Run the line rules on a batch of lines, accumulating in `line_runs` the messages and errors of each rule,
+        and the state it keeps across the lines (see `ElementRule.run_context_nodes`).
+        With a `sink`, the failed assertions of each rule are buffered, to be sent in order by `run_document`.
+        :return: the lines of the batch with a buffered failed assertion, which must not be pruned, so that the
+                 sink still finds their context node where it was
+        """
+        failed_lines: set[_Element] = set()
+        for rule, line_context in self.line_contexts.items():
+            if rule not in line_runs:
+                line_runs[rule] = {
+                    # The context independent asserts of a split rule are reported by `_run_split_rule`
+                    "state": {"first_node": rule not in self.split_rules},
+                    "vals": {
+                        "current": {"type": "", "key": ""},
+                        "errors": [],
+                        "fail_fast": fail_fast,
+                        "sink": BufferSink() if sink is not None else None,
+                    },
+                    "warning": [],
+                    "fatal": [],
+                    "context_nodes": 0,
+                    "context_error": None,
+                }
+            line_run = line_runs[rule]
+            if line_run["context_error"] is not None or (fail_fast and line_run["vals"].get("fatal_count")):
+                continue
+            variables = header_values[rule.parent]
+            try:
+                context_nodes = line_context(lines[0], **variables, **{STREAM_LINES_VARIABLE: lines})
+            except Exception as err:
+                # Reported by `run_document` on the whole context, where `ElementRule.run` would have stopped
+                line_run["context_error"] = err
+                continue
+            if not isinstance(context_nodes, list):
+                continue
+            buffer: Optional["BufferSink"] = line_run["vals"]["sink"]
+            buffered = len(buffer.failures) if buffer is not None else 0
+            res_warning, res_fatal = rule.run_context_nodes(context_nodes, variables, line_run["vals"], line_run["state"])
+            line_run["warning"] += res_warning
+            line_run["fatal"] += res_fatal
+            line_run["context_nodes"] += len(context_nodes)
+            if buffer is not None:
+                failed_lines.update(_line_of(failure[4]) for failure in buffer.failures[buffered:])
+        return failed_lines
+
+    @staticmethod
+    def _run_split_rule(
+        rule: ElementRule, xml: _Element, variables: dict, schematron_vals: dict, line_run: dict
+    ) -> Tuple[List[str], List[str]]:
+        """
+        Same as `ElementRule.run` on a split rule, for its context nodes outside of the lines (which come first in
+        document order), and then its context independent asserts, on the root, if its first context node is in a line.
+        """
+        schematron_vals["current"] = {"key": "<context>", "type": "rule context"}
+        context_nodes = try_xpath(xml, rule.context_xpath, variables, schematron_vals)
+        if not isinstance(context_nodes, list):
+            return [], []
+        context_nodes = [node for node in context_nodes if isinstance(node, _Element) and not _in_line(node)]
+        warning, fatal = rule.run_context_nodes(context_nodes, variables, schematron_vals, {})
+        if context_nodes or not line_run["context_nodes"]:
+            return warning, fatal
+
+        for assert_id, flag, _query, xpath, message, context_dependent in rule._assertions:
+            if context_dependent:
+                continue
+            schematron_vals["current"] = {"key": assert_id, "type": "rule assertion"}
+            if not try_xpath(xml, xpath, variables, schematron_vals):
+                if flag == "warning":
+                    warning.append(rule.assert_message(assert_id, message))
+                elif flag == "fatal":
+                    fatal.append(rule.assert_message(assert_id, message))
+        return warning, fatal
+
+    def _report_context_error(self, rule: ElementRule, xml: _Element, variables: dict, schematron_vals: dict, err: Exception):
+        """
+        Report the error of a line rule context the way `try_xpath` does on the whole context,
+        unless it is a split rule whose context already fails outside of the lines.
+        """
+        schematron_vals["current"] = {"key": "<context>", "type": "rule context"}
+        if rule in self.split_rules and try_xpath(xml, rule.context_xpath, variables, schematron_vals) is False:
+            return
+        error_detail = _xpath_error_detail(err, "rule context", "<context>", rule.context_xpath.path)
+        _logger.error("Schematron XPath failed.\n%s", error_detail)
+        schematron_vals["errors"].append(error_detail)
+
+    def run_document(self, xml: _Element, line_runs: dict, schematron_vals: dict) -> Tuple[List[str], List[str]]:
+        """
+        Same as `ElementSchematron.run`, on the header and the pruned lines, taking the results of the line rules
+        from `line_runs` (see `run_lines`), so that the messages, the errors and the failures sent to the sink
+        come in the same order. Stops after the first pattern with a failed fatal assertion with `fail_fast`.
+        """
+        schematron_variables = self.schematron.evaluate_variables(xml, {}, schematron_vals)
+        no_line_run = {"vals": {"errors": [], "sink": None}, "warning": [], "fatal": [], "context_nodes": 0}
+        warning, fatal = [], []
+        for pattern in self.schematron.children:
+            fatal_count = schematron_vals.get("fatal_count", 0)
+            pattern_variables = pattern.evaluate_variables(xml, schematron_variables, schematron_vals)
+            pattern_warning, pattern_fatal = [], []
+            for rule in pattern.children:
+                line_run = line_runs.get(rule, no_line_run)
+                if rule not in self.line_contexts:
+                    res_warning, res_fatal = rule.run(xml, pattern_variables, schematron_vals)
+                    pattern_warning += res_warning
+                    pattern_fatal += res_fatal
+                elif line_run.get("context_error") is not None:
+                    self._report_context_error(rule, xml, pattern_variables, schematron_vals, line_run["context_error"])
+                else:
+                    if rule in self.split_rules:
+                        res_warning, res_fatal = self._run_split_rule(rule, xml, pattern_variables, schematron_vals, line_run)
+                        pattern_warning += res_warning
+                        pattern_fatal += res_fatal
+                    pattern_warning += line_run["warning"]
+                    pattern_fatal += line_run["fatal"]
+                    self._merge_line_run(line_run, schematron_vals)
+                if schematron_vals.get("fail_fast") and schematron_vals.get("fatal_count"):
+                    break
+            pattern.run_count += 1
+            if schematron_vals.get("fatal_count", 0) > fatal_count:
+                pattern.fatal_count += 1
+            warning += pattern_warning
+            fatal += pattern_fatal
+            if schematron_vals.get("fail_fast") and schematron_vals.get("fatal_count"):
+                break
+        return warning, fatal
+
+    def run_line_results(self, line_runs: dict, schematron_vals: dict) -> Tuple[List[str], List[str]]:
+        """
+        Results of the line rules alone, in the order of `run_document`, for `validate_stream` stopping with
+        `fail_fast` at the first batch of lines with a failed fatal assertion, before the rest of the document is parsed.
+        """
+        warning, fatal = [], []
+        for pattern in self.schematron.children:
+            for rule in pattern.children:
+                if rule in line_runs:
+                    warning += line_runs[rule]["warning"]
+                    fatal += line_runs[rule]["fatal"]
+                    self._merge_line_run(line_runs[rule], schematron_vals)
+        return warning, fatal
+
+    @staticmethod
+    def _merge_line_run(line_run: dict, schematron_vals: dict):
+        """Add the errors, the count of failed fatal assertions and the buffered failures of a line rule to the document ones."""
+        schematron_vals["errors"] += line_run["vals"]["errors"]
+        schematron_vals["fatal_count"] = schematron_vals.get("fatal_count", 0) + line_run["vals"].get("fatal_count", 0)
+        if line_run["vals"]["sink"] is not None:
+            line_run["vals"]["sink"].replay(schematron_vals["sink"])
+
+
+def _in_line(node: _Element) -> bool:
+    """Check whether `node` is within a line (see `STREAM_LINE_TAGS`), lines being children of the root."""
+    return _line_of(node) is not None
+
+
+def _line_of(node: _Element) -> Optional[_Element]:
+    """Line (see `STREAM_LINE_TAGS`) that `node` is within, lines being children of the root, or `None`."""
+    ancestors = [node, *node.iterancestors()]
+    return ancestors[-2] if len(ancestors) > 1 and ancestors[-2].tag in STREAM_LINE_TAGS else None
+
+
+def _prune_line(element: _Element, kept_steps: Optional[Tuple[set, set]]):
+    """
+    Drop the descendants of a validated line that no query left to run may read (see `StreamPlan.kept_steps`).
+    The elements at the end of a kept step are kept whole, and the ones on the way, or above a kept element,
+    without their other children.
+    """
+    if kept_steps is None:
+        return
+    through, read = kept_steps
+    for child in list(element):
+        if not isinstance(child.tag, str):
+            element.remove(child)
+            continue
+        steps = ((element.tag, child.tag), (None, child.tag), (element.tag, "*"))
+        if any(step in read for step in steps):
+            continue
+        _prune_line(child, kept_steps)
+        if not len(child) and not any(step in through for step in steps):
+            element.remove(child)
+
+
+################################################################################
+# Result Sinks
+################################################################################
+
+
+class ResultSink(abc.ABC):
+    """
+    Receives the failed assertions as they happen, instead of the warning and fatal message lists
+    (see `SchematronRegistry.validate`), with where they failed. Subclasses write them somewhere, or count them.
+    """
+
+    def start(self, root_name: str):
+        """Called before running a schematron on a document."""
+
+    @abc.abstractmethod
+    def add(self, rule: "ElementRule", assert_id: str, flag: str, test: str, context_node: _Element, message: str):
+        """Called for every failed assertion, `test` being its XPath1 query."""
+
+    def end(self, root_name: str, errors: List[str]):
+        """Called once the schematron is done, with its XPath errors."""
+
+    @staticmethod
+    def location(context_node: _Element) -> str:
+        """XPath of a context node, using the prefixes of the document (``/*/cac:InvoiceLine[3]/cbc:ID``)."""
+        return context_node.getroottree().getpath(context_node)
+
+
+class BufferSink(ResultSink):
+    """Keeps the failures of the line rules of a streamed document (see `StreamPlan.run_lines`), to replay them in order."""
+
+    def __init__(self):
+        self.failures: List[tuple] = []
+
+    def add(self, rule: "ElementRule", assert_id: str, flag: str, test: str, context_node: _Element, message: str):
+        self.failures.append((rule, assert_id, flag, test, context_node, message))
+
+    def replay(self, sink: ResultSink):
+        for failure in self.failures:
+            sink.add(*failure)
+        self.failures.clear()
+
+
+class CountSink(ResultSink):
+    """Only counts the failed assertions: by (root_name, flag), and by (root_name, assert_id)."""
+
+    def __init__(self):
+        self.root_name = ""
+        self.flags: Counter[tuple[str, str]] = Counter()
+        self.asserts: Counter[tuple[str, str]] = Counter()
+        self.errors: Counter[str] = Counter()
+
+    def start(self, root_name: str):
+        self.root_name = root_name
+
+    def add(self, rule: "ElementRule", assert_id: str, flag: str, test: str, context_node: _Element, message: str):
+        self.flags[self.root_name, flag] += 1
+        self.asserts[self.root_name, assert_id] += 1
+
+    def end(self, root_name: str, errors: List[str]):
+        self.errors[root_name] += len(errors)
+
+
+class JsonLinesSink(ResultSink):
+    """Writes a JSON object per failed assertion, and per XPath error, to a text file."""
+
+    def __init__(self, file):
+        self.file = file
+        self.root_name = ""
+
+    def start(self, root_name: str):
+        self.root_name = root_name
+
+    def add(self, rule: "ElementRule", assert_id: str, flag: str, test: str, context_node: _Element, message: str):
+        failure = {
+            "schematron": self.root_name,
+            "id": assert_id,
+            "flag": flag,
+            "location": self.location(context_node),
+            "message": message,
+        }
+        self.file.write(json.dumps(failure) + "\n")
+
+    def end(self, root_name: str, errors: List[str]):
+        for error in errors:
+            self.file.write(json.dumps({"schematron": root_name, "error": error}) + "\n")
+
+
+SVRL_NS = "http://purl.oclc.org/dsdl/svrl"
+
+
+class SvrlSink(ResultSink):
+    """
+    Writes an SVRL report per schematron, to `path_template` formatted with the root_name, written as the failures come
+    (with `etree.xmlfile`). Only the patterns and rules with a failed assertion are reported as active and fired,
+    and the XPath errors aren't part of the report.
+    """
+
+    def __init__(self, path_template: str):
+        self.path_template = path_template
+        self._stack = ExitStack()
+        self._writer = None
+        self._pattern: Optional[ElementPattern] = None
+        self._rule: Optional[ElementRule] = None
+
+    def start(self, root_name: str):
+        self._writer = self._stack.enter_context(etree.xmlfile(self.path_template.format(root_name=root_name), encoding="utf-8"))
+        self._writer.write_declaration()
+        self._stack.enter_context(self._writer.element(f"{{{SVRL_NS}}}schematron-output", {"title": root_name}, nsmap={"svrl": SVRL_NS}))
+        self._pattern = self._rule = None
+
+    def add(self, rule: "ElementRule", assert_id: str, flag: str, test: str, context_node: _Element, message: str):
+        if rule.parent is not self._pattern:
+            self._pattern = rule.parent
+            self._writer.write(etree.Element(f"{{{SVRL_NS}}}active-pattern", {"id": rule.parent.pattern_id}, nsmap={"svrl": SVRL_NS}))
+        if rule is not self._rule:
+            self._rule = rule
+            self._writer.write(etree.Element(f"{{{SVRL_NS}}}fired-rule", {"context": rule.context_path}, nsmap={"svrl": SVRL_NS}))
+        failed_assert = etree.Element(
+            f"{{{SVRL_NS}}}failed-assert",
+            {"id": assert_id, "flag": flag, "location": self.location(context_node), "test": test},
+            nsmap={"svrl": SVRL_NS},
+        )
+        etree.SubElement(failed_assert, f"{{{SVRL_NS}}}text").text = message
+        self._writer.write(failed_assert)
+        self._writer.flush()
+
+    def end(self, root_name: str, errors: List[str]):
+        self._stack.close()
+        self._writer = None
+
+
+################################################################################
+# Schematron Registry
+################################################################################
+
+
+class SchematronRegistry:
+    """
+    Process-wide registry of the Element trees, keyed by the `PATH_ROOT_MAP` names (CEN, PEPPOL, ...).
+    Each schematron is loaded once on first use and kept warm, so validating a document only costs
+    the assertion evaluation itself.
+    """
+
+    _root_path_map: dict[str, str] = {root_name: path for path, root_name in PATH_ROOT_MAP.items()}
+    _schematrons: dict[str, ElementSchematron] = {}
+    _stream_plans: dict[str, StreamPlan] = {}
+
+    @classmethod
+    def get(cls, root_name: str) -> ElementSchematron:
+        if root_name not in cls._schematrons:
+            if root_name not in cls._root_path_map:
+                raise KeyError(f"Unknown schematron {root_name!r}, expected one of {sorted(cls._root_path_map)}")
+            cls._schematrons[root_name] = load_schematron(cls._root_path_map[root_name])
+        return cls._schematrons[root_name]
+
+    @classmethod
+    def clear(cls):
+        cls._schematrons.clear()
+        cls._stream_plans.clear()
+
+    @classmethod
+    def get_stream_plan(cls, root_name: str) -> StreamPlan:
+        if root_name not in cls._stream_plans:
+            cls._stream_plans[root_name] = StreamPlan(cls.get(root_name))
+        return cls._stream_plans[root_name]
+
+    @classmethod
+    def validate(
+        cls,
+        doc: _Element,
+        root_names: list[str],
+        fail_fast: bool = False,
+        order_by_failures: bool = False,
+        sink: Optional[ResultSink] = None,
+    ) -> dict[str, dict[str, list[str]]]:
+        """
+        Run the given schematrons on an already parsed document.
+        :param fail_fast: stop at the first failed fatal assertion (see `ElementSchematron.run`).
+                          The schematrons after the one rejecting the document are not run, and are missing from the result.
+        :param order_by_failures: see `ElementSchematron.run`
+        :param sink: where to send the failed assertions as they happen (see `ResultSink`), rather than to
+                     the `warning` and `fatal` lists of the result
+        :return: a dictionary of root_name -> {'warning': <list>, 'fatal': <list>, 'errors': <list>},
+                 where `errors` contains the XPath compile and evaluation errors.
+                 With a `sink`, `warning` and `fatal` are always empty, whether the document passes or not:
+                 only the sink gets the failed assertions (a `CountSink` counts them by flag).
+        """
+        results = {}
+        # Index the document once for all the schematrons
+        with indexed_document(doc):
+            for root_name in root_names:
+                schematron = cls.get(root_name)
+                schematron_vals = {"current": {"type": "", "key": ""}, "errors": [], "sink": sink}
+                if sink is not None:
+                    sink.start(root_name)
+                warning, fatal = schematron.run(
+                    doc,
+                    {},
+                    schematron_vals,
+                    fail_fast=fail_fast,
+                    order_by_failures=order_by_failures,
+                )
+                results[root_name] = {"warning": warning, "fatal": fatal, "errors": schematron_vals["errors"]}
+                if sink is not None:
+                    sink.end(root_name, schematron_vals["errors"])
+                if schematron_vals.get("fatal_count") and fail_fast:
+                    break
+        return results
+
+    @classmethod
+    def validate_stream(
+        cls, source_path: str, root_names: list[str], fail_fast: bool = False, sink: Optional[ResultSink] = None
+    ) -> dict[str, dict[str, list[str]]]:
+        """
+        Same as `validate` on the parsed file, but the document is parsed with `etree.iterparse`, and the lines
+        (see `STREAM_LINE_TAGS`) are validated as soon as they are parsed, by batches of `STREAM_BATCH_SIZE`, by the
+        rules reading only within a line, and then pruned down to what the other rules may read (see `StreamPlan`).
+        Those other rules are run at the end.
+        This only lowers the memory used, it doesn't bound it: the pruned lines stay in the tree, with the elements
+        the document level rules read of them (e.g. the amounts of the totals checks), so the memory still grows with
+        the number of lines (117MB instead of 151MB, above the loaded schematrons, for CEN and PEPPOL on an invoice
+        with 10000 lines). Bounding it would take the document level rules reading aggregates kept while parsing.
+        Documents with a line nested deeper, or with other elements after the lines, are parsed and validated in
+        full instead, with a warning.
+        :param fail_fast: see `validate`. The parsing stops at the first batch of lines with a failed fatal
+                          assertion, and only the first schematron rejecting those lines is in the result, with the
+                          results of its line rules.
+        :param sink: see `validate`. The failures of the line rules are buffered until the end of the document, to be
+                     sent in the same order as by `validate`, and the lines with a failure are not pruned, so that
+                     the sink finds the failed context nodes where they were.
+        """
+        plans = {root_name: cls.get_stream_plan(root_name) for root_name in root_names}
+        kept_steps: Optional[Tuple[set, set]] = (set(), set())
+        for plan in plans.values():
+            if kept_steps is None or plan.kept_steps is None:
+                kept_steps = None
+            else:
+                kept_steps = (kept_steps[0] | plan.kept_steps[0], kept_steps[1] | plan.kept_steps[1])
+
+        root: Optional[_Element] = None
+        header_values: dict[str, dict[Element, dict]] = {}
+        line_runs: dict[str, dict] = {root_name: {} for root_name in root_names}
+        lines: List[_Element] = []
+
+        def run_lines() -> Optional[str]:
+            """Run and prune a batch of lines, returning the first schematron rejecting them with `fail_fast`."""
+            failed_lines: set[_Element] = set()
+            for root_name, plan in plans.items():
+                failed_lines |= plan.run_lines(lines, header_values[root_name], line_runs[root_name], fail_fast, sink)
+                if fail_fast and any(line_run["vals"].get("fatal_count") for line_run in line_runs[root_name].values()):
+                    return root_name
+            for line in lines:
+                if line not in failed_lines:
+                    _prune_line(line, kept_steps)
+            lines.clear()
+            return None
+
+        rejected_by: Optional[str] = None
+        depth = 0
+        for event, node in etree.iterparse(source_path, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = node
+                elif node.tag in STREAM_LINE_TAGS and depth == 2:
+                    if not header_values:
+                        header_values = {root_name: plan.evaluate_header_variables(root) for root_name, plan in plans.items()}
+                elif node.tag in STREAM_LINE_TAGS or (depth == 2 and header_values):
+                    _logger.warning("%s can't be validated as a stream, because of its %s element: validating it in full", source_path, node.tag)
+                    return cls.validate(etree.parse(source_path).getroot(), root_names, fail_fast=fail_fast, sink=sink)
+                continue
+
+            depth -= 1
+            if depth == 1 and node.tag in STREAM_LINE_TAGS:
+                lines.append(node)
+                if len(lines) == STREAM_BATCH_SIZE:
+                    rejected_by = run_lines()
+                    if rejected_by is not None:
+                        break
+        if lines and rejected_by is None:
+            rejected_by = run_lines()
+
+        results = {}
+        with indexed_document(root):
+            for root_name, plan in plans.items():
+                if rejected_by is not None and root_name != rejected_by:
+                    continue
+                schematron_vals = {"current": {"type": "", "key": ""}, "errors": [], "fail_fast": fail_fast, "sink": sink}
+                if sink is not None:
+                    sink.start(root_name)
+                if rejected_by is None:
+                    warning, fatal = plan.run_document(root, line_runs[root_name], schematron_vals)
+                else:
+                    warning, fatal = plan.run_line_results(line_runs[root_name], schematron_vals)
+                results[root_name] = {"warning": warning, "fatal": fatal, "errors": schematron_vals["errors"]}
+                if sink is not None:
+                    sink.end(root_name, schematron_vals["errors"])
+                if schematron_vals.get("fatal_count") and fail_fast:
+                    break
+        return results
+
+
 ################################################################################
 # Script Logic (not to copy to odoo)
 ################################################################################
 
 
-def blaze(args: list[str]):
-    test_file_path, schematron_paths = get_file_and_schematron_paths(args)
+def _validate_file(file_path: str, root_names: list[str]) -> tuple[str, dict[str, dict[str, list[str]]]]:
+    """Parse and validate a single file, reporting a parse failure in the `errors` of every schematron."""
+    try:
+        doc = etree.parse(file_path).getroot()
+    except (OSError, etree.XMLSyntaxError) as err:
+        error_detail = f"Error: {err}\nFile: {file_path}"
+        return file_path, {root_name: {"warning": [], "fatal": [], "errors": [error_detail]} for root_name in root_names}
+    return file_path, SchematronRegistry.validate(doc, root_names)
+
+
+def _warm_registry(root_names: list[str]):
+    """Process pool initializer, so that each worker loads its Element trees once, before the first document."""
+    for root_name in root_names:
+        SchematronRegistry.get(root_name)
+
+
+def validate_many(
+    file_paths: Iterable[str], root_names: list[str], max_workers: Optional[int] = None
+) -> Iterator[tuple[str, dict[str, dict[str, list[str]]]]]:
+    """
+    Validate many files in parallel over a process pool, each worker holding its own warm `SchematronRegistry`.
+    The lxml evaluation holds the GIL (even more so inside the `u:` Python callbacks), so only processes scale.
+    Results are yielded as soon as each file is done, so in completion order rather than in `file_paths` order.
+    :return: an iterator of (file_path, <`SchematronRegistry.validate` result>)
+    """
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_warm_registry, initargs=(root_names,)) as executor:
+        futures = [executor.submit(_validate_file, file_path, root_names) for file_path in file_paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def print_results(file_path: str, results: dict[str, dict[str, list[str]]]):
     errors_to_email = {}
 
-    for schematron_path in schematron_paths:
-        root_name = PATH_ROOT_MAP[schematron_path]
-        print(f"Running {root_name} schematron on {test_file_path}")
-        schematron = ElementSchematron.from_sch(etree.parse(schematron_path).getroot(), root_name)
-        doc = etree.parse(test_file_path).getroot()
-        schematron_vals = {"current": {"type": "", "key": ""}, "errors": []}
-        warning, fatal = schematron.run(doc, {}, schematron_vals)
+    for root_name, result in results.items():
+        print(f"Running {root_name} schematron on {file_path}")
         print("Warning:")
-        pprint(sorted(set(warning)))
+        pprint(sorted(set(result["warning"])))
         print("Fatal:")
-        pprint(sorted(set(fatal)))
-        if schematron_vals["errors"]:
-            errors_to_email[schematron.root_name] = schematron_vals["errors"]
+        pprint(sorted(set(result["fatal"])))
+        if result["errors"]:
+            errors_to_email[root_name] = result["errors"]
 
     if errors_to_email:
         error_body = [
@@ -702,9 +2630,61 @@ def blaze(args: list[str]):
         print(email_str)
 
 
+def blaze(args: list[str]):
+    test_file_path, schematron_paths = get_file_and_schematron_paths(args)
+    doc = etree.parse(test_file_path).getroot()
+    results = SchematronRegistry.validate(doc, [PATH_ROOT_MAP[schematron_path] for schematron_path in schematron_paths])
+    print_results(test_file_path, results)
+
+
+def blaze_stream(args: list[str]):
+    """
+    Usage: STREAM <same arguments as without it>
+    Validate the file with `SchematronRegistry.validate_stream`, for documents with many lines.
+    """
+    test_file_path, schematron_paths = get_file_and_schematron_paths(args)
+    results = SchematronRegistry.validate_stream(test_file_path, [PATH_ROOT_MAP[schematron_path] for schematron_path in schematron_paths])
+    print_results(test_file_path, results)
+
+
+def blaze_jsonl(args: list[str]):
+    """
+    Usage: JSONL <same arguments as without it>
+    Print the failed assertions (and the XPath errors) as JSON lines as they happen, see `JsonLinesSink`.
+    """
+    test_file_path, schematron_paths = get_file_and_schematron_paths(args)
+    doc = etree.parse(test_file_path).getroot()
+    root_names = [PATH_ROOT_MAP[schematron_path] for schematron_path in schematron_paths]
+    SchematronRegistry.validate(doc, root_names, sink=JsonLinesSink(sys.stdout))
+
+
+def blaze_many(args: list[str]):
+    """
+    Usage: BATCH <SPECIAL_FILE_SCHEMATRON key> <file or folder inside test_files> [...]
+    Every .xml file given (or found in the given folders) is validated in parallel by `validate_many`.
+    """
+    schematron_paths = profile_schematron_paths(args[0])
+    file_paths = []
+    for arg in args[1:]:
+        path = f"test_files/{arg}"
+        if os.path.isdir(path):
+            file_paths.extend(os.path.join(path, file) for file in sorted(listdir(path)) if file.endswith(".xml"))
+        else:
+            file_paths.append(path)
+
+    for file_path, results in validate_many(file_paths, [PATH_ROOT_MAP[schematron_path] for schematron_path in schematron_paths]):
+        print_results(file_path, results)
+
+
 def main():
     tt = time()
-    if sys.argv[1].upper() == "CRAZY":
+    if sys.argv[1].upper() == "BATCH":
+        blaze_many(sys.argv[2:])
+    elif sys.argv[1].upper() == "STREAM":
+        blaze_stream(sys.argv[2:])
+    elif sys.argv[1].upper() == "JSONL":
+        blaze_jsonl(sys.argv[2:])
+    elif sys.argv[1].upper() == "CRAZY":
         # TEST EVERYTHING! You heard that... EVERYTHING!!!
         all_files = listdir("test_files")
         for file in all_files:
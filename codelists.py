@@ -0,0 +1,78 @@
+import re
+from glob import glob
+from pathlib import Path
+from typing import Optional
+
+from lxml import etree
+
+# Code lists of the schematrons and of the XSDs, loaded once into frozensets, so that the asserts check a code with a
+# hash lookup (``u:in_codelist('ISO4217', @currencyID)``) instead of a ``some $code in $ISO4217 satisfies ...``
+# (that XPath1 can't express) or a ``contains()`` over a space-padded string copied by hand from the .sch.
+# The code lists are:
+# - the ``let``s of the schematrons whose value is ``tokenize('<codes>', '\s')`` or a space-padded ``' <codes> '``
+# - the enumerations of the named ``xs:simpleType``s of the XSDs
+# Each code list is available qualified by the name of its file (``PEPPOL-EN16931-UBL.sch#ISO4217``), which is what
+# the rewritten asserts use. The bare name is only kept when no other file defines it with different codes (e.g.
+# ``cl_iso3166`` differs between the EUSR and TSR schematrons, so only the qualified names exist for it).
+
+# Relative to this module rather than to the working directory, since the code lists are loaded at import
+SCHEMATRON_FOLDER = Path(__file__).parent / "validation" / "schematron"
+XSD_FOLDER = Path(__file__).parent / "validation" / "xsd"
+
+_XS_NS = "http://www.w3.org/2001/XMLSchema"
+_TOKENIZED_RE = re.compile(r"tokenize\(\s*'([^']*)'\s*,\s*'\\s\+?'\s*\)")
+_PADDED_RE = re.compile(r"' ([^']*) '")
+
+
+def _let_codes(value: str) -> Optional[str]:
+    """Space-separated codes of a ``let`` value, or None if it isn't a code list."""
+    value = value.strip()
+    match = _TOKENIZED_RE.fullmatch(value) or _PADDED_RE.fullmatch(value)
+    return match and match.group(1)
+
+
+def _schematron_code_lists(path: str) -> dict[str, frozenset[str]]:
+    code_lists = {}
+    for let in etree.parse(path).iter("{*}let"):
+        codes = _let_codes(let.get("value", ""))
+        if codes is not None:
+            # tokenize() yields an empty token for a trailing space, that no code is equal to
+            code_lists[let.get("name")] = frozenset(codes.split())
+    return code_lists
+
+
+def _xsd_code_lists(path: str) -> dict[str, frozenset[str]]:
+    code_lists = {}
+    for simple_type in etree.parse(path).iterfind(f".//{{{_XS_NS}}}simpleType[@name]"):
+        enumerations = simple_type.iterfind(f"{{{_XS_NS}}}restriction/{{{_XS_NS}}}enumeration")
+        codes = frozenset(enumeration.get("value") for enumeration in enumerations)
+        if codes:
+            code_lists[simple_type.get("name")] = codes
+    return code_lists
+
+
+def load_code_lists(schematron_folder: str | Path = SCHEMATRON_FOLDER, xsd_folder: str | Path = XSD_FOLDER) -> dict[str, frozenset[str]]:
+    """
+    Code lists of the schematrons and of the XSDs of the given folders, by name.
+    :param schematron_folder: folder of the .sch (and .xml) schematrons
+    :param xsd_folder: folder searched recursively for .xsd files
+    :raises FileNotFoundError: if no code list is found in the folders
+    """
+    by_file = [(path, _schematron_code_lists(path)) for path in sorted(glob(f"{schematron_folder}/*.sch") + glob(f"{schematron_folder}/*.xml"))]
+    by_file += [(path, _xsd_code_lists(path)) for path in sorted(glob(f"{xsd_folder}/**/*.xsd", recursive=True))]
+
+    code_lists: dict[str, frozenset[str]] = {}
+    conflicting: set[str] = set()
+    for path, file_code_lists in by_file:
+        for name, codes in file_code_lists.items():
+            code_lists[f"{Path(path).name}#{name}"] = codes
+            if code_lists.setdefault(name, codes) != codes:
+                conflicting.add(name)
+    for name in conflicting:
+        del code_lists[name]
+    if not code_lists:
+        raise FileNotFoundError(f"No code list found in {schematron_folder} nor in {xsd_folder}")
+    return code_lists
+
+
+CODE_LISTS = load_code_lists()
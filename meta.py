@@ -1,5 +1,6 @@
 import re
 import sys
+from collections import Counter
 from decimal import Decimal
 from time import time
 from typing import Any, Generic, List, Optional, Tuple, TypeVar
@@ -484,6 +485,11 @@ def xpath_u_replace(_, value: XPathObject, pattern: str, replacement: str) -> st
 ################################################################################
 
 
+_eusr_per_euc_subsets = etree.XPath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
+_eusr_end_user_countries = etree.XPath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
+_xpath_normalized = etree.XPath("normalize-space(.)")
+
+
 @utils_ns("id_SCH_EUSR_40")
 def xpath_u_id_sch_eusr_40(ctx):
     """
@@ -495,30 +501,16 @@ def xpath_u_id_sch_eusr_40(ctx):
                 every $euc in (eusr:Key[normalize-space(@schemeID) = 'EndUserCountry'])
                 satisfies normalize-space($euc) = normalize-space($steuc)
             ]) = 1
+    Single pass over the subsets, see `blaze.xpath_u_id_sch_eusr_40`.
     """
-    subset_nodes = ctx.context_node.xpath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
-
-    if not subset_nodes:
-        return True
-
-    for subset_node in subset_nodes:
-        key_nodes = subset_node.xpath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
-        if not key_nodes:
-            continue
-
-        for key_node in key_nodes:
-            key_value = key_node.text
-            count = 0
-            other_subset_nodes = ctx.context_node.xpath("eusr:Subset[normalize-space(@type) = 'PerEUC']", namespaces=GNSMAP)
-            for other_subset_node in other_subset_nodes:
-                other_key_nodes = other_subset_node.xpath("eusr:Key[normalize-space(@schemeID) = 'EndUserCountry']", namespaces=GNSMAP)
-                for other_key_node in other_key_nodes:
-                    if other_key_node.text == key_value:
-                        count += 1
-            if count != 1:
-                return False
-
-    return True
+    subset_countries = [
+        {_xpath_normalized(key_node) for key_node in _eusr_end_user_countries(subset_node)}
+        for subset_node in _eusr_per_euc_subsets(ctx.context_node)
+    ]
+    matching_subsets = Counter(next(iter(countries)) for countries in subset_countries if len(countries) == 1)
+    keyless_subsets = sum(1 for countries in subset_countries if not countries)
+
+    return all(matching_subsets[country] + keyless_subsets == 1 for countries in subset_countries for country in countries)
 
 
 @utils_ns("xrechnung_verify_iban")
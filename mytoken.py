@@ -1,4 +1,15 @@
+# Kinds of the XPath 2.0 tokens produced by `Parser.parse`
+NAME = "name"
+QNAME = "qname"
+OPERATOR = "operator"
+STRING = "string"
+NUMBER = "number"
+VARIABLE = "variable"
+
+
 class AbstractToken:
+    kind = ""
+
     def __str__(self):
         # TO BE OVERRIDDEN
         return ""
@@ -25,3 +36,14 @@ class ClosingTagToken(AbstractToken):
 
     def __str__(self):
         return f"</{self.tag_name}>"
+
+
+class OperatorToken(AbstractToken):
+    kind = OPERATOR
+
+    def __init__(self, symbol):
+        super().__init__()
+        self.symbol = symbol
+
+    def __str__(self):
+        return self.symbol
@@ -0,0 +1,1622 @@
+import math
+import re
+import sys
+from datetime import date, time as time_of_day
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal, InvalidOperation
+from functools import lru_cache
+from time import time
+from typing import Callable, Optional
+
+from lxml import etree
+from lxml.etree import _Element, _ElementTree
+from rich.pretty import pprint
+
+from . import blaze
+from .mytoken import NAME, NUMBER, OPERATOR, QNAME, STRING, VARIABLE
+from .parser import Parser
+from .schematron_lxml_const import PATH_ROOT_MAP, get_file_and_schematron_paths
+
+# Native evaluator of the XPath 2.0 subset the schematrons use. The expressions are tokenized by `Parser` and
+# compiled once into Python closures over the lxml elements, so the asserts run as written in the .sch: neither the
+# hand-maintained XPath1 rewrites of `schematron_lxml_const.py` (see `blaze.py`) nor elementpath (see `old.py`).
+# Usage: python -m <package>.native <file> <SPECIAL_FILE_SCHEMATRON key>
+
+_XS_NS = "http://www.w3.org/2001/XMLSchema"
+
+
+class XPath2Error(Exception):
+    """Static or dynamic error of an XPath 2.0 expression, with its error code (e.g. FORG0001)."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(f"[{code}] {message}")
+        self.code = code
+
+
+################################################################################
+# Data Model
+################################################################################
+
+
+class Untyped(str):
+    """xs:untypedAtomic value of a node, compared and computed with as the type of the other operand."""
+
+
+class AttributeNode:
+    __slots__ = ("parent", "name", "value")
+
+    def __init__(self, parent: _Element, name: str, value: str):
+        self.parent = parent
+        self.name = name
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, AttributeNode) and self.parent is other.parent and self.name == other.name
+
+    def __hash__(self):
+        return hash((id(self.parent), self.name))
+
+
+class TextNode:
+    __slots__ = ("parent", "index", "value")
+
+    def __init__(self, parent: _Element, index: int, value: str):
+        """:param index: 0 for the text of `parent`, `i + 1` for the tail of its child `i`"""
+        self.parent = parent
+        self.index = index
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, TextNode) and self.parent is other.parent and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.parent), self.index))
+
+
+class Document:
+    """
+    Document node of an lxml tree, with what the evaluation computes once per document: the document order of its
+    elements (only when a node set must be sorted), its descendants by tag (for the absolute ``//`` steps), and the
+    values of the absolute paths which don't depend on variables.
+    """
+
+    def __init__(self, tree: _ElementTree):
+        self.tree = tree
+        self.root = tree.getroot()
+        self._order: Optional[dict[_Element, int]] = None
+        self._descendants: dict = {}
+        self.paths: dict[Callable, list] = {}
+
+    def descendants(self, tag) -> list[_Element]:
+        if tag not in self._descendants:
+            self._descendants[tag] = list(self.root.iter(tag))
+        return self._descendants[tag]
+
+    def order_key(self, node) -> tuple:
+        if self._order is None:
+            self._order = {element: index for index, element in enumerate(self.root.iter())}
+        if isinstance(node, _Element):
+            return (self._order[node], 0, 0)
+        if isinstance(node, AttributeNode):
+            return (self._order[node.parent], 1, list(node.parent.attrib).index(node.name))
+        if isinstance(node, TextNode):
+            if node.index == 0:
+                return (self._order[node.parent], 2, 0)
+            # A tail comes after the last descendant of its element
+            *_, last = node.parent[node.index - 1].iter()
+            return (self._order[last], 3, 0)
+        return (-1, 0, 0)
+
+
+_NODE_TYPES = (_Element, AttributeNode, TextNode, Document)
+Sequence = list
+# Compiled expression: (context item, context position, context size, Env) -> result sequence
+Expression = Callable[[object, int, int, "Env"], Sequence]
+
+
+class Env:
+    """Dynamic context shared by an evaluation: the variables in scope, and the document."""
+
+    __slots__ = ("variables", "document")
+
+    def __init__(self, variables: dict[str, Sequence], document: Document):
+        self.variables = variables
+        self.document = document
+
+    def scope(self) -> "Env":
+        """Copy of the environment, whose variables `for` and quantified expressions can bind."""
+        return Env(dict(self.variables), self.document)
+
+
+def _is_numeric(value) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def _string_value(node) -> str:
+    if isinstance(node, _Element):
+        return "".join(node.itertext()) if isinstance(node.tag, str) else node.text or ""
+    if isinstance(node, Document):
+        return "".join(node.root.itertext())
+    return node.value
+
+
+def _atomize(sequence: Sequence) -> Sequence:
+    return [Untyped(_string_value(item)) if isinstance(item, _NODE_TYPES) else item for item in sequence]
+
+
+def _single_atom(sequence: Sequence, what: str):
+    """The atomized value of a sequence of at most one item, `None` if it is empty."""
+    if not sequence:
+        return None
+    if len(sequence) > 1:
+        raise XPath2Error("XPTY0004", f"{what} expects at most one item, not {len(sequence)}")
+    item = sequence[0]
+    return Untyped(_string_value(item)) if isinstance(item, _NODE_TYPES) else item
+
+
+def _boolean(sequence: Sequence) -> bool:
+    """Effective boolean value of a sequence."""
+    if not sequence:
+        return False
+    first = sequence[0]
+    if isinstance(first, _NODE_TYPES):
+        return True
+    if len(sequence) > 1:
+        raise XPath2Error("FORG0006", "No effective boolean value for several atomic values")
+    if isinstance(first, bool):
+        return first
+    if isinstance(first, str):
+        return first != ""
+    if isinstance(first, float):
+        return not (first == 0 or math.isnan(first))
+    if isinstance(first, (int, Decimal)):
+        return first != 0
+    raise XPath2Error("FORG0006", f"No effective boolean value for {type(first).__name__}")
+
+
+def _string(value) -> str:
+    """Canonical string of an atomic value."""
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, Decimal):
+        if value == value.to_integral_value():
+            return str(int(value))
+        return format(value.normalize(), "f")
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "INF" if value > 0 else "-INF"
+        if 1e-6 <= abs(value) < 1e6 or value == 0:
+            return str(int(value)) if value == int(value) else repr(value)
+        mantissa, exponent = f"{value:.15E}".split("E")
+        mantissa = mantissa.rstrip("0")
+        return f"{mantissa}0E{int(exponent)}" if mantissa.endswith(".") else f"{mantissa}E{int(exponent)}"
+    if isinstance(value, (date, time_of_day)):
+        return value.isoformat()
+    return str(value)
+
+
+def _string_argument(sequence: Sequence) -> str:
+    """String of an optional argument, the empty string for the empty sequence."""
+    value = _single_atom(sequence, "A string argument")
+    return "" if value is None else _string(value)
+
+
+def _document_order(nodes: Sequence, document: Document) -> Sequence:
+    """The distinct nodes of a sequence, in document order."""
+    unique = list(dict.fromkeys(nodes))
+    if len(unique) > 1:
+        unique.sort(key=document.order_key)
+    return unique
+
+
+################################################################################
+# Casts and Operators
+################################################################################
+
+_DECIMAL_RE = re.compile(r"[ \t\r\n]*([+-]?(?:\d+(?:\.\d*)?|\.\d+))[ \t\r\n]*")
+_INTEGER_RE = re.compile(r"[ \t\r\n]*([+-]?\d+)[ \t\r\n]*")
+_DOUBLE_RE = re.compile(r"[ \t\r\n]*([+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?|-?INF|NaN)[ \t\r\n]*")
+_DATE_RE = re.compile(r"[ \t\r\n]*(-?\d{4,})-(\d{2})-(\d{2})(?:Z|[+-]\d{2}:\d{2})?[ \t\r\n]*")
+_BOOLEAN_STRINGS = {"true": True, "1": True, "false": False, "0": False}
+
+
+def _cast(value, type_name: str):
+    """
+    Cast an atomic value to `xs:<type_name>`, for the types of `CAST_TYPES`.
+    :raise XPath2Error: FORG0001 when the value can't be cast
+    """
+    try:
+        if type_name == "string":
+            return _string(value)
+        if isinstance(value, str):
+            match = _CAST_PATTERNS[type_name].fullmatch(value)
+            if match is None:
+                raise XPath2Error("FORG0001", f"Can't cast {str(value)!r} as xs:{type_name}")
+            if type_name == "decimal":
+                return Decimal(match.group(1))
+            if type_name == "integer":
+                return int(match.group(1))
+            if type_name == "double":
+                return float(match.group(1).replace("INF", "inf"))
+            if type_name == "boolean":
+                return _BOOLEAN_STRINGS[match.group(1)]
+            if type_name == "time":
+                seconds = Decimal(match.group(3))
+                return time_of_day(int(match.group(1)) % 24, int(match.group(2)), int(seconds), int(seconds % 1 * 1000000))
+            return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        if type_name in ("date", "time"):
+            if isinstance(value, (date, time_of_day)):
+                return value
+        elif type_name == "boolean":
+            return _boolean([value])
+        elif isinstance(value, bool) or _is_numeric(value):
+            if type_name == "double":
+                return float(value)
+            if isinstance(value, float) and not math.isfinite(value):
+                raise XPath2Error("FOCA0002", f"Can't cast {_string(value)} as xs:{type_name}")
+            if type_name == "decimal":
+                return Decimal(repr(value)) if isinstance(value, float) else Decimal(value)
+            return int(value)
+    except (ValueError, InvalidOperation) as err:
+        raise XPath2Error("FORG0001", f"Can't cast {_string(value)!r} as xs:{type_name}: {err}")
+    raise XPath2Error("XPTY0004", f"Can't cast {type(value).__name__} as xs:{type_name}")
+
+
+_CAST_PATTERNS = {
+    "decimal": _DECIMAL_RE,
+    "integer": _INTEGER_RE,
+    "double": _DOUBLE_RE,
+    "boolean": re.compile(r"[ \t\r\n]*(true|false|1|0)[ \t\r\n]*"),
+    "date": _DATE_RE,
+    "time": re.compile(r"[ \t\r\n]*(2[0-3]|[01]\d|24(?=:00:00(?:\.0+)?(?:Z|[+-]|[ \t\r\n]*$))):([0-5]\d):([0-5]\d(?:\.\d+)?)(?:Z|[+-]\d{2}:\d{2})?[ \t\r\n]*"),
+}
+CAST_TYPES = {"string", *_CAST_PATTERNS}
+
+
+def _comparable(left, right, general: bool) -> tuple:
+    """
+    Convert two atomic values to the type they are compared as: in a general comparison, an untyped value takes the
+    type of the other operand (a double for a number), and two untyped values (or any in a value comparison) are strings.
+    """
+    if isinstance(left, Untyped) or isinstance(right, Untyped):
+        if not general or (isinstance(left, Untyped) and isinstance(right, Untyped)):
+            left = str(left) if isinstance(left, Untyped) else left
+            right = str(right) if isinstance(right, Untyped) else right
+        elif isinstance(left, Untyped):
+            left = _cast(left, _untyped_cast_type(right))
+        else:
+            right = _cast(right, _untyped_cast_type(left))
+    if _is_numeric(left) and _is_numeric(right):
+        if isinstance(left, float) or isinstance(right, float):
+            return float(left), float(right)
+        return left, right
+    if type(left) is type(right) or (isinstance(left, str) and isinstance(right, str)):
+        return left, right
+    raise XPath2Error("XPTY0004", f"Can't compare {type(left).__name__} with {type(right).__name__}")
+
+
+def _untyped_cast_type(value) -> str:
+    if isinstance(value, bool):
+        return "boolean"
+    if _is_numeric(value):
+        return "double"
+    if isinstance(value, date):
+        return "date"
+    if isinstance(value, time_of_day):
+        return "time"
+    return "string"
+
+
+_COMPARISONS: dict[str, Callable] = {
+    "eq": lambda left, right: left == right,
+    "ne": lambda left, right: left != right,
+    "lt": lambda left, right: left < right,
+    "le": lambda left, right: left <= right,
+    "gt": lambda left, right: left > right,
+    "ge": lambda left, right: left >= right,
+}
+_GENERAL_COMPARISONS = {"=": "eq", "!=": "ne", "<": "lt", "<=": "le", ">": "gt", ">=": "ge"}
+
+
+def _numeric_operand(sequence: Sequence):
+    """Numeric value of an arithmetic operand (untyped values are doubles), `None` for the empty sequence."""
+    value = _single_atom(sequence, "An arithmetic operand")
+    if value is None:
+        return None
+    if isinstance(value, Untyped):
+        return _cast(value, "double")
+    if not _is_numeric(value):
+        raise XPath2Error("XPTY0004", f"Arithmetic on {type(value).__name__}")
+    return value
+
+
+def _arithmetic(operator: str, left, right):
+    """Result of a numeric operator, promoting integers to decimals and decimals to doubles like XPath 2.0 does."""
+    if isinstance(left, float) or isinstance(right, float):
+        left, right = float(left), float(right)
+        if operator in ("div", "mod", "idiv") and right == 0:
+            if operator == "idiv":
+                raise XPath2Error("FOAR0001", "Integer division by zero")
+            if operator == "mod" or left == 0 or math.isnan(left):
+                return math.nan
+            return math.copysign(math.inf, left) * math.copysign(1, right)
+        if operator == "idiv":
+            return math.trunc(left / right)
+        if operator == "mod":
+            return math.fmod(left, right)
+    elif operator in ("div", "mod", "idiv"):
+        if right == 0:
+            raise XPath2Error("FOAR0001", "Division by zero")
+        if isinstance(left, int) and isinstance(right, int) and operator != "div":
+            # Exact, whatever the size of the integers (e.g. the IBAN checks): the quotient is truncated towards zero
+            quotient = abs(left) // abs(right) * (1 if (left < 0) == (right < 0) else -1)
+            return quotient if operator == "idiv" else left - right * quotient
+        left, right = Decimal(left), Decimal(right)
+        if operator == "idiv":
+            return int(left // right)
+        if operator == "mod":
+            return left % right
+    if operator == "+":
+        return left + right
+    if operator == "-":
+        return left - right
+    if operator == "*":
+        return left * right
+    return left / right
+
+
+def _round(value, precision: int = 0):
+    """XPath round: halves are rounded towards positive infinity."""
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            return value
+        return float(_round(Decimal(repr(value)), precision))
+    if isinstance(value, int) and precision >= 0:
+        return value
+    scale = Decimal(1).scaleb(-precision)
+    rounded = (Decimal(value) / scale + Decimal("0.5")).to_integral_value(rounding=ROUND_FLOOR) * scale
+    return int(rounded) if isinstance(value, int) else rounded
+
+
+################################################################################
+# Functions
+################################################################################
+
+
+@lru_cache(maxsize=256)
+def _regex(pattern: str, flags: str = "") -> re.Pattern:
+    """Python regex of an XPath 2.0 regex, whose syntax is mostly the same."""
+    python_flags = 0
+    for flag in flags:
+        python_flags |= {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}[flag]
+    try:
+        return re.compile(pattern, python_flags)
+    except re.error as err:
+        raise XPath2Error("FORX0002", f"Invalid regular expression {pattern!r}: {err}")
+
+
+_REPLACEMENT_RE = re.compile(r"\\([\\$])|\$(\d+)|(\\)")
+
+
+def _replacement(replacement: str) -> Callable[[re.Match], str]:
+    """Python replacement function of an XPath 2.0 replacement, whose groups are ``$1`` and escapes ``\\$`` and ``\\\\``."""
+    parts = []
+    pos = 0
+    for match in _REPLACEMENT_RE.finditer(replacement):
+        if match.group(3):
+            raise XPath2Error("FORX0004", f"Invalid replacement string {replacement!r}")
+        parts.append((replacement[pos : match.start()], None))
+        parts.append((match.group(1), None) if match.group(1) else ("", int(match.group(2))))
+        pos = match.end()
+    parts.append((replacement[pos:], None))
+    return lambda match: "".join(text + ((match.group(group) or "") if group is not None else "") for text, group in parts)
+
+
+def _tokenize(value: str, pattern: str, flags: str = "") -> Sequence:
+    if not value:
+        return []
+    regex = _regex(pattern, flags)
+    if regex.match(""):
+        raise XPath2Error("FORX0003", f"The tokenize pattern {pattern!r} matches the empty string")
+    tokens, start = [], 0
+    for match in regex.finditer(value):
+        tokens.append(value[start : match.start()])
+        start = match.end()
+    tokens.append(value[start:])
+    return tokens
+
+
+def _substring(value: str, start, length=None) -> str:
+    """XPath substring, whose start and length are rounded doubles counting from 1."""
+    first = float(start)
+    if math.isnan(first):
+        return ""
+    first = math.floor(first + 0.5) if math.isfinite(first) else first
+    if length is None:
+        last = math.inf
+    else:
+        length = float(length)
+        if math.isnan(length):
+            return ""
+        last = first + (math.floor(length + 0.5) if math.isfinite(length) else length)
+    begin = max(first, 1)
+    if last <= begin or begin == math.inf:
+        return ""
+    return value[int(begin) - 1 : None if last == math.inf else int(last) - 1]
+
+
+def _numbers(sequence: Sequence, what: str) -> Sequence:
+    """Atomized values of an aggregate function, untyped values being doubles."""
+    values = []
+    for value in _atomize(sequence):
+        if isinstance(value, Untyped):
+            value = _cast(value, "double")
+        elif not _is_numeric(value):
+            raise XPath2Error("FORG0006", f"{what} of a {type(value).__name__}")
+        values.append(value)
+    return values
+
+
+def _sum(sequence: Sequence, zero: Optional[Sequence] = None) -> Sequence:
+    values = _numbers(sequence, "Sum")
+    if not values:
+        return [0] if zero is None else zero
+    if any(isinstance(value, float) for value in values):
+        return [math.fsum(float(value) for value in values)]
+    if any(isinstance(value, Decimal) for value in values):
+        return [sum((Decimal(value) for value in values), Decimal(0))]
+    return [sum(values)]
+
+
+def _max(sequence: Sequence, smallest: bool = False) -> Sequence:
+    values = []
+    for value in _atomize(sequence):
+        values.append(_cast(value, "double") if isinstance(value, Untyped) else value)
+    if not values:
+        return []
+    if any(isinstance(value, float) and math.isnan(value) for value in values):
+        return [math.nan]
+    if any(isinstance(value, float) for value in values) and all(_is_numeric(value) for value in values):
+        values = [float(value) for value in values]
+    try:
+        return [min(values) if smallest else max(values)]
+    except TypeError:
+        raise XPath2Error("FORG0006", "Max or min of values which can't be compared")
+
+
+def _numeric_function(function: Callable) -> Callable:
+    """Function of a single optional number, untyped values being doubles."""
+
+    def evaluate(sequence: Sequence) -> Sequence:
+        value = _numeric_operand(sequence)
+        return [] if value is None else [function(value)]
+
+    return evaluate
+
+
+def _node_name(sequence: Sequence, part: str) -> Sequence:
+    """name(), local-name() or namespace-uri() of an optional node."""
+    if not sequence:
+        return [""]
+    node = sequence[0]
+    if isinstance(node, AttributeNode):
+        qname = etree.QName(node.name)
+        namespace, localname, prefix = qname.namespace, qname.localname, None
+    elif isinstance(node, _Element) and isinstance(node.tag, str):
+        qname = etree.QName(node)
+        namespace, localname, prefix = qname.namespace, qname.localname, node.prefix
+    elif isinstance(node, _NODE_TYPES):
+        return [""]
+    else:
+        raise XPath2Error("XPTY0004", f"{part} of a {type(node).__name__}")
+    if part == "local-name":
+        return [localname]
+    if part == "namespace-uri":
+        return [namespace or ""]
+    return [f"{prefix}:{localname}" if prefix else localname]
+
+
+def _string_function(function: Callable) -> Callable:
+    """Function of strings, the empty sequence being the empty string."""
+    return lambda *sequences: [function(*(_string_argument(sequence) for sequence in sequences))]
+
+
+def _cast_function(type_name: str) -> Callable:
+    def evaluate(sequence: Sequence) -> Sequence:
+        value = _single_atom(sequence, f"xs:{type_name}()")
+        return [] if value is None else [_cast(value, type_name)]
+
+    return evaluate
+
+
+_SPACES_RE = re.compile(r"[ \t\r\n]+")
+
+
+def _slack(exp, val, slack) -> bool:
+    """u:slack of the Peppol schematrons, on decimals."""
+    exp, val, slack = (_cast(value, "decimal") for value in (exp, val, slack))
+    return exp + slack >= val and exp - slack <= val
+
+
+def _mod97_0208(val: str) -> bool:
+    """u:mod97-0208 of the Peppol schematron: the check digits 9 and 10 are 97 minus the first 8 digits modulo 97."""
+    calculated = 97 - _cast(Untyped(val[:8]), "integer") % 97
+    return _number([Untyped(val[8:10])]) == calculated
+
+
+# Name: (minimum arity, maximum arity, implementation on the argument sequences, whether it returns a boolean)
+_FUNCTIONS: dict[str, tuple[int, int, Callable[..., Sequence], bool]] = {
+    "true": (0, 0, lambda: [True], True),
+    "false": (0, 0, lambda: [False], True),
+    "not": (1, 1, lambda sequence: [not _boolean(sequence)], True),
+    "boolean": (1, 1, lambda sequence: [_boolean(sequence)], True),
+    "exists": (1, 1, lambda sequence: [bool(sequence)], True),
+    "empty": (1, 1, lambda sequence: [not sequence], True),
+    "count": (1, 1, lambda sequence: [len(sequence)], False),
+    "sum": (1, 2, _sum, False),
+    "avg": (1, 1, lambda sequence: _arithmetic_sequence("div", _sum(sequence), [len(sequence)]) if sequence else [], False),
+    "max": (1, 1, _max, False),
+    "min": (1, 1, lambda sequence: _max(sequence, smallest=True), False),
+    "abs": (1, 1, _numeric_function(abs), False),
+    "floor": (1, 1, _numeric_function(lambda value: value if isinstance(value, int) else type(value)(math.floor(value)) if isinstance(value, float) else value.to_integral_value(ROUND_FLOOR)), False),
+    "ceiling": (1, 1, _numeric_function(lambda value: value if isinstance(value, int) else type(value)(math.ceil(value)) if isinstance(value, float) else value.to_integral_value(ROUND_CEILING)), False),
+    "round": (1, 2, lambda sequence, precision=None: _numeric_function(lambda value: _round(value, int(_numeric_operand(precision) or 0) if precision else 0))(sequence), False),
+    "number": (1, 1, lambda sequence: [_number(sequence)], False),
+    "string": (1, 1, lambda sequence: [_string_argument(sequence)], False),
+    "string-length": (1, 1, lambda sequence: [len(_string_argument(sequence))], False),
+    "normalize-space": (1, 1, _string_function(lambda value: _SPACES_RE.sub(" ", value).strip(" ")), False),
+    "upper-case": (1, 1, _string_function(str.upper), False),
+    "lower-case": (1, 1, _string_function(str.lower), False),
+    "concat": (2, 99, _string_function(lambda *values: "".join(values)), False),
+    "contains": (2, 2, lambda value, part: [_string_argument(part) in _string_argument(value)], True),
+    "starts-with": (2, 2, lambda value, part: [_string_argument(value).startswith(_string_argument(part))], True),
+    "ends-with": (2, 2, lambda value, part: [_string_argument(value).endswith(_string_argument(part))], True),
+    "substring-before": (2, 2, _string_function(lambda value, part: value.partition(part)[0] if part in value else ""), False),
+    "substring-after": (2, 2, _string_function(lambda value, part: value.partition(part)[2]), False),
+    "substring": (2, 3, lambda value, *bounds: [_substring(_string_argument(value), *(_number(bound) for bound in bounds))], False),
+    "translate": (3, 3, _string_function(lambda value, source, target: value.translate({ord(c): (target[i] if i < len(target) else None) for i, c in reversed(list(enumerate(source)))})), False),
+    "matches": (2, 3, lambda value, pattern, flags=None: [bool(_regex(_string_argument(pattern), _string_argument(flags or [])).search(_string_argument(value)))], True),
+    "replace": (3, 4, lambda value, pattern, replacement, flags=None: [_regex(_string_argument(pattern), _string_argument(flags or [])).sub(_replacement(_string_argument(replacement)), _string_argument(value))], False),
+    "tokenize": (2, 3, lambda value, pattern, flags=None: _tokenize(_string_argument(value), _string_argument(pattern), _string_argument(flags or [])), False),
+    "string-join": (2, 2, lambda sequence, separator: [_string_argument(separator).join(_string(value) for value in _atomize(sequence))], False),
+    "string-to-codepoints": (1, 1, lambda sequence: [ord(c) for c in _string_argument(sequence)], False),
+    "codepoints-to-string": (1, 1, lambda sequence: ["".join(chr(int(value)) for value in _atomize(sequence))], False),
+    "distinct-values": (1, 1, lambda sequence: list(dict.fromkeys(str(value) if isinstance(value, Untyped) else value for value in _atomize(sequence))), False),
+    "reverse": (1, 1, lambda sequence: sequence[::-1], False),
+    "name": (1, 1, lambda sequence: _node_name(sequence, "name"), False),
+    "local-name": (1, 1, lambda sequence: _node_name(sequence, "local-name"), False),
+    "namespace-uri": (1, 1, lambda sequence: _node_name(sequence, "namespace-uri"), False),
+    **{f"xs:{type_name}": (1, 1, _cast_function(type_name), type_name == "boolean") for type_name in CAST_TYPES},
+    # The `u:` functions the schematrons define in XSLT, on the checksums of `blaze.py`
+    "u:gln": (1, 1, _string_function(blaze._gln_checksum), True),
+    "u:mod11": (1, 1, _string_function(blaze._mod11_checksum), True),
+    "u:mod97-0208": (1, 1, _string_function(_mod97_0208), True),
+    "u:abn": (1, 1, _string_function(blaze._abn_checksum), True),
+    "u:TinVerification": (1, 1, _string_function(blaze._tin_checksum), True),
+    "u:checkSEOrgnr": (1, 1, _string_function(blaze._se_orgnr_checksum), True),
+    "u:checkCodiceIPA": (1, 1, _string_function(lambda value: blaze.xpath_u_checkCodiceIPA(None, value)), True),
+    "u:checkCF": (1, 1, _string_function(lambda value: blaze.xpath_u_checkCF(None, value)), True),
+    "u:checkCF16": (1, 1, _string_function(lambda value: blaze.xpath_u_checkCF16(None, value)), True),
+    "u:checkPIVA": (1, 1, _string_function(lambda value: blaze.xpath_u_checkPIVA(None, value)), False),
+    "u:checkPIVAseIT": (1, 1, _string_function(lambda value: blaze.xpath_u_checkPIVAseIT(None, value)), True),
+    "u:addPIVA": (2, 2, lambda value, pari: [blaze._piva_sum(_string_argument(value), bool(_numeric_operand(pari)))], False),
+    "u:slack": (3, 3, lambda *sequences: [_slack(*(_single_atom(sequence, "u:slack") for sequence in sequences))], True),
+}
+# Functions whose argument defaults to the context item
+_CONTEXT_DEFAULT_FUNCTIONS = {"string", "string-length", "normalize-space", "number", "name", "local-name", "namespace-uri"}
+_KIND_TESTS = {"node", "text", "element", "attribute", "comment", "document-node", "processing-instruction"}
+
+
+def _number(sequence: Sequence) -> float:
+    """number(): a double, NaN if the value isn't a number."""
+    value = _single_atom(sequence, "number()")
+    if value is None:
+        return math.nan
+    try:
+        return _cast(value, "double")
+    except XPath2Error:
+        return math.nan
+
+
+def _arithmetic_sequence(operator: str, left: Sequence, right: Sequence) -> Sequence:
+    left_value, right_value = _numeric_operand(left), _numeric_operand(right)
+    if left_value is None or right_value is None:
+        return []
+    return [_arithmetic(operator, left_value, right_value)]
+
+
+################################################################################
+# Axes
+################################################################################
+
+# Node tests: (node kind, lxml tag filter) for elements, (node kind, attribute name or None) for attributes
+NodeTest = tuple[str, object]
+
+
+def _element_matches(element: _Element, tag) -> bool:
+    if not isinstance(element.tag, str):
+        return False
+    if tag is etree.Element:
+        return True
+    if tag.endswith("}*"):
+        return element.tag.startswith(tag[:-1])
+    return element.tag == tag
+
+
+def _node_matches(node, test: NodeTest) -> bool:
+    kind, tag = test
+    if kind == "node":
+        return True
+    if kind == "element":
+        return isinstance(node, _Element) and _element_matches(node, tag)
+    if kind == "text":
+        return isinstance(node, TextNode)
+    if kind == "attribute":
+        return isinstance(node, AttributeNode) and (tag is None or node.name == tag)
+    if kind == "comment":
+        return isinstance(node, _Element) and node.tag is etree.Comment
+    return kind == "document-node" and isinstance(node, Document)
+
+
+def _children(node, test: NodeTest, document: Document) -> Sequence:
+    if isinstance(node, Document):
+        return [document.root] if _node_matches(document.root, test) else []
+    if not isinstance(node, _Element):
+        return []
+    kind, tag = test
+    if kind == "element":
+        return list(node.iterchildren(tag))
+    if kind == "text" or kind == "node":
+        children: Sequence = [TextNode(node, 0, node.text)] if node.text else []
+        for index, child in enumerate(node, 1):
+            if kind == "node":
+                children.append(child)
+            if child.tail:
+                children.append(TextNode(node, index, child.tail))
+        return children
+    return [child for child in node if _node_matches(child, test)]
+
+
+def _descendants(node, test: NodeTest, document: Document, or_self: bool = False) -> Sequence:
+    """Descendants matching the test. Text nodes are only found by a ``text()`` test."""
+    kind, tag = test
+    if isinstance(node, Document):
+        self_nodes = [node] if or_self and _node_matches(node, test) else []
+        if kind == "element":
+            return self_nodes + document.descendants(tag)
+        node, self_nodes = document.root, self_nodes + ([document.root] if _node_matches(document.root, test) else [])
+    elif not isinstance(node, _Element):
+        return [node] if or_self and _node_matches(node, test) else []
+    else:
+        self_nodes = [node] if or_self and _node_matches(node, test) else []
+    if kind == "element":
+        return self_nodes + list(node.iterdescendants(tag))
+    if kind == "text":
+        return self_nodes + [text for element in node.iter(etree.Element) for text in _children(element, test, document)]
+    return self_nodes + [descendant for descendant in node.iterdescendants() if _node_matches(descendant, test)]
+
+
+def _parent(node, document: Document):
+    if isinstance(node, (AttributeNode, TextNode)):
+        return node.parent
+    if isinstance(node, _Element):
+        return node.getparent() if node is not document.root else document
+    return None
+
+
+def _ancestors(node, test: NodeTest, document: Document, or_self: bool = False) -> Sequence:
+    """Ancestors matching the test, nearest first (reverse document order)."""
+    ancestors = [node] if or_self and _node_matches(node, test) else []
+    node = _parent(node, document)
+    while node is not None:
+        if _node_matches(node, test):
+            ancestors.append(node)
+        node = _parent(node, document)
+    return ancestors
+
+
+def _siblings(node, test: NodeTest, preceding: bool) -> Sequence:
+    if not isinstance(node, _Element):
+        return []
+    kind, tag = test
+    return list(node.itersiblings(tag if kind == "element" else None, preceding=preceding))
+
+
+def _following(node, test: NodeTest, document: Document, preceding: bool) -> Sequence:
+    """following:: or preceding:: (nearest first) elements, without the ancestors."""
+    if isinstance(node, (AttributeNode, TextNode)):
+        node = node.parent
+    if not isinstance(node, _Element):
+        return []
+    tag = test[1] if test[0] == "element" else None
+    result = []
+    while node is not None and node is not document.root:
+        for sibling in node.itersiblings(preceding=preceding):
+            descendants = list(sibling.iter(tag))
+            result += descendants[::-1] if preceding else descendants
+        node = node.getparent()
+    return result
+
+
+def _axis(name: str) -> Callable[[object, NodeTest, Document], Sequence]:
+    """Nodes of an axis from a node, in the order its predicates count them."""
+    return {
+        "child": _children,
+        "descendant": _descendants,
+        "descendant-or-self": lambda node, test, document: _descendants(node, test, document, or_self=True),
+        "self": lambda node, test, document: [node] if _node_matches(node, test) else [],
+        "parent": lambda node, test, document: [parent] if (parent := _parent(node, document)) is not None and _node_matches(parent, test) else [],
+        "ancestor": _ancestors,
+        "ancestor-or-self": lambda node, test, document: _ancestors(node, test, document, or_self=True),
+        "following-sibling": lambda node, test, document: _siblings(node, test, preceding=False),
+        "preceding-sibling": lambda node, test, document: _siblings(node, test, preceding=True),
+        "following": lambda node, test, document: _following(node, test, document, preceding=False),
+        "preceding": lambda node, test, document: _following(node, test, document, preceding=True),
+        "attribute": lambda node, test, document: [
+            AttributeNode(node, name, value) for name, value in node.attrib.items() if test[1] is None or name == test[1]
+        ]
+        if isinstance(node, _Element) and isinstance(node.tag, str)
+        else [],
+    }[name]
+
+
+_REVERSE_AXES = {"parent", "ancestor", "ancestor-or-self", "preceding-sibling", "preceding"}
+# Axes whose nodes from distinct nodes in document order are still distinct and in document order
+_ORDERED_AXES = {"child", "attribute", "self"}
+
+
+################################################################################
+# Compiler
+################################################################################
+
+
+def _apply_predicates(items: Sequence, predicates: list[tuple[Expression, Optional[int]]], env: Env) -> Sequence:
+    """
+    Filter a sequence by predicates: a numeric value keeps the item at that position,
+    anything else keeps the items whose effective boolean value is true.
+    """
+    for predicate, position in predicates:
+        if position is not None:
+            items = items[position - 1 : position]
+            continue
+        size = len(items)
+        if getattr(predicate, "boolean", False):
+            items = [item for index, item in enumerate(items, 1) if _boolean(predicate(item, index, size, env))]
+            continue
+        kept = []
+        for index, item in enumerate(items, 1):
+            value = predicate(item, index, size, env)
+            if len(value) == 1 and _is_numeric(value[0]):
+                if value[0] == index:
+                    kept.append(item)
+            elif _boolean(value):
+                kept.append(item)
+        items = kept
+    return items
+
+
+def _subtrees(nodes: Sequence, env: Env) -> Sequence:
+    """
+    ``descendant-or-self::node()`` of the nodes before a ``//`` step, restricted to the nodes which have children:
+    the document and the elements.
+    """
+    result = []
+    for node in nodes:
+        if isinstance(node, Document):
+            result.append(node)
+            result += env.document.descendants(etree.Element)
+        elif isinstance(node, _Element):
+            result += node.iter(etree.Element)
+        elif not isinstance(node, _NODE_TYPES):
+            raise XPath2Error("XPTY0019", "A path step on a value which is not a node")
+    return _document_order(result, env.document) if len(nodes) > 1 else result
+
+
+class Compiler:
+    """
+    Recursive descent compiler of XPath 2.0 expressions into closures. Every closure takes the focus
+    (context item, position, size) and the `Env`, and returns a sequence (a list).
+    """
+
+    def __init__(self, namespaces: dict[str, str]):
+        self.namespaces = namespaces
+        self.lexer = Parser()
+        self._cache: dict[str, Expression] = {}
+        self.tokens: list = []
+        self.index = 0
+        # Number of position() and last() calls compiled so far, to know whether a predicate depends on them
+        self._focus_calls = 0
+        # Number of variable references compiled so far, to know whether an absolute path depends on them
+        self._variable_references = 0
+
+    def compile(self, query: str) -> Expression:
+        """:raise XPath2Error: on a syntax error or a construct outside of the supported subset"""
+        if query not in self._cache:
+            try:
+                self.tokens = self.lexer.parse(query)
+            except ValueError as err:
+                raise XPath2Error("XPST0003", str(err))
+            self.index = 0
+            expression = self.expr()
+            if self.index < len(self.tokens):
+                raise XPath2Error("XPST0003", f"Unexpected {self.peek()[1]!r} at offset {self.peek()[2]}")
+            self._cache[query] = expression
+        return self._cache[query]
+
+    # Tokens
+
+    def peek(self, offset: int = 0) -> tuple:
+        index = self.index + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None, -1)
+
+    def at(self, value: str, offset: int = 0) -> bool:
+        kind, token_value, _offset = self.peek(offset)
+        return token_value == value and kind in (OPERATOR, NAME)
+
+    def accept(self, value: str) -> bool:
+        if self.at(value):
+            self.index += 1
+            return True
+        return False
+
+    def expect(self, value: str):
+        if not self.accept(value):
+            kind, token_value, offset = self.peek()
+            raise XPath2Error("XPST0003", f"Expected {value!r} at offset {offset}, not {token_value!r}")
+
+    def qname(self, value: str, default_namespace: Optional[str] = None) -> str:
+        """Clark notation of a (prefixed) name."""
+        prefix, _sep, localname = value.rpartition(":")
+        if not prefix:
+            return f"{{{default_namespace}}}{localname}" if default_namespace else localname
+        if prefix not in self.namespaces:
+            raise XPath2Error("XPST0081", f"Unknown prefix {prefix!r}")
+        return f"{{{self.namespaces[prefix]}}}{localname}"
+
+    # Expressions
+
+    def expr(self) -> Expression:
+        parts = [self.expr_single()]
+        while self.accept(","):
+            parts.append(self.expr_single())
+        if len(parts) == 1:
+            return parts[0]
+
+        def sequence(item, position, size, env):
+            result = []
+            for part in parts:
+                result += part(item, position, size, env)
+            return result
+
+        return sequence
+
+    def expr_single(self) -> Expression:
+        kind, value, _offset = self.peek()
+        if kind == NAME and self.peek(1)[0] == VARIABLE and value in ("some", "every", "for"):
+            return self.for_expr() if value == "for" else self.quantified_expr()
+        if kind == NAME and value == "if" and self.at("(", 1):
+            return self.if_expr()
+        return self.or_expr()
+
+    def bindings(self) -> list[tuple[str, Expression]]:
+        """The ``$name in <expr>, ...`` clauses of a `for` or quantified expression."""
+        self.index += 1
+        bindings = []
+        while True:
+            kind, value, offset = self.peek()
+            if kind != VARIABLE:
+                raise XPath2Error("XPST0003", f"Expected a variable at offset {offset}")
+            self.index += 1
+            self.expect("in")
+            bindings.append((value[1:], self.expr_single()))
+            if not self.accept(","):
+                return bindings
+
+    def quantified_expr(self) -> Expression:
+        every = self.peek()[1] == "every"
+        bindings = self.bindings()
+        self.expect("satisfies")
+        condition = self.expr_single()
+
+        def quantify(index, item, position, size, scope):
+            if index == len(bindings):
+                return _boolean(condition(item, position, size, scope))
+            name, domain = bindings[index]
+            for value in domain(item, position, size, scope):
+                scope.variables[name] = [value]
+                if quantify(index + 1, item, position, size, scope) != every:
+                    return not every
+            return every
+
+        def quantified(item, position, size, env):
+            return [quantify(0, item, position, size, env.scope())]
+
+        quantified.boolean = True
+        return quantified
+
+    def for_expr(self) -> Expression:
+        bindings = self.bindings()
+        self.expect("return")
+        body = self.expr_single()
+
+        def iterate(index, item, position, size, scope, result):
+            if index == len(bindings):
+                result += body(item, position, size, scope)
+                return
+            name, domain = bindings[index]
+            for value in domain(item, position, size, scope):
+                scope.variables[name] = [value]
+                iterate(index + 1, item, position, size, scope, result)
+
+        def for_loop(item, position, size, env):
+            result: Sequence = []
+            iterate(0, item, position, size, env.scope(), result)
+            return result
+
+        return for_loop
+
+    def if_expr(self) -> Expression:
+        self.index += 1
+        self.expect("(")
+        condition = self.expr()
+        self.expect(")")
+        self.expect("then")
+        then_branch = self.expr_single()
+        self.expect("else")
+        else_branch = self.expr_single()
+
+        def if_else(item, position, size, env):
+            branch = then_branch if _boolean(condition(item, position, size, env)) else else_branch
+            return branch(item, position, size, env)
+
+        return if_else
+
+    def or_expr(self) -> Expression:
+        operands = [self.and_expr()]
+        while self.accept("or"):
+            operands.append(self.and_expr())
+        if len(operands) == 1:
+            return operands[0]
+
+        def or_(item, position, size, env):
+            return [any(_boolean(operand(item, position, size, env)) for operand in operands)]
+
+        or_.boolean = True
+        return or_
+
+    def and_expr(self) -> Expression:
+        operands = [self.comparison_expr()]
+        while self.accept("and"):
+            operands.append(self.comparison_expr())
+        if len(operands) == 1:
+            return operands[0]
+
+        def and_(item, position, size, env):
+            return [all(_boolean(operand(item, position, size, env)) for operand in operands)]
+
+        and_.boolean = True
+        return and_
+
+    def comparison_expr(self) -> Expression:
+        left = self.range_expr()
+        kind, value, offset = self.peek()
+        if kind == OPERATOR and value in _GENERAL_COMPARISONS:
+            self.index += 1
+            return self.general_comparison(_COMPARISONS[_GENERAL_COMPARISONS[value]], left, self.range_expr())
+        if kind == NAME and value in _COMPARISONS:
+            self.index += 1
+            return self.value_comparison(_COMPARISONS[value], left, self.range_expr())
+        if value in ("is", "<<", ">>"):
+            raise XPath2Error("XPST0003", f"Node comparison {value!r} at offset {offset} is not supported")
+        return left
+
+    @staticmethod
+    def general_comparison(compare: Callable, left: Expression, right: Expression) -> Expression:
+        def general(item, position, size, env):
+            left_values = _atomize(left(item, position, size, env))
+            if not left_values:
+                return [False]
+            right_values = _atomize(right(item, position, size, env))
+            for left_value in left_values:
+                for right_value in right_values:
+                    if compare(*_comparable(left_value, right_value, general=True)):
+                        return [True]
+            return [False]
+
+        general.boolean = True
+        return general
+
+    @staticmethod
+    def value_comparison(compare: Callable, left: Expression, right: Expression) -> Expression:
+        def value_(item, position, size, env):
+            left_value = _single_atom(left(item, position, size, env), "A value comparison")
+            right_value = _single_atom(right(item, position, size, env), "A value comparison")
+            if left_value is None or right_value is None:
+                return []
+            return [compare(*_comparable(left_value, right_value, general=False))]
+
+        value_.boolean = True
+        return value_
+
+    def range_expr(self) -> Expression:
+        start = self.additive_expr()
+        if not self.accept("to"):
+            return start
+        end = self.additive_expr()
+
+        def range_(item, position, size, env):
+            first, last = _numeric_operand(start(item, position, size, env)), _numeric_operand(end(item, position, size, env))
+            if first is None or last is None:
+                return []
+            return list(range(_cast(first, "integer"), _cast(last, "integer") + 1))
+
+        return range_
+
+    def arithmetic(self, operand: Callable[[], Expression], operators: tuple[str, ...]) -> Expression:
+        left = operand()
+        while True:
+            kind, value, _offset = self.peek()
+            if value not in operators or kind not in (OPERATOR, NAME):
+                return left
+            self.index += 1
+            left = self.binary_arithmetic(value, left, operand())
+
+    @staticmethod
+    def binary_arithmetic(operator: str, left: Expression, right: Expression) -> Expression:
+        def arithmetic(item, position, size, env):
+            return _arithmetic_sequence(operator, left(item, position, size, env), right(item, position, size, env))
+
+        return arithmetic
+
+    def additive_expr(self) -> Expression:
+        return self.arithmetic(self.multiplicative_expr, ("+", "-"))
+
+    def multiplicative_expr(self) -> Expression:
+        return self.arithmetic(self.union_expr, ("*", "div", "idiv", "mod"))
+
+    def union_expr(self) -> Expression:
+        operands = [self.cast_expr()]
+        while self.accept("|") or self.accept("union"):
+            operands.append(self.cast_expr())
+        if len(operands) == 1:
+            return operands[0]
+
+        def union(item, position, size, env):
+            nodes = []
+            for operand in operands:
+                nodes += operand(item, position, size, env)
+            if not all(isinstance(node, _NODE_TYPES) for node in nodes):
+                raise XPath2Error("XPTY0004", "Union of values which are not nodes")
+            return _document_order(nodes, env.document)
+
+        return union
+
+    def single_type(self) -> tuple[str, bool]:
+        """``xs:<type>[?]`` of a cast or castable expression: the type name, and whether the empty sequence is allowed."""
+        kind, value, offset = self.peek()
+        if kind != QNAME or self.qname(value) not in {f"{{{_XS_NS}}}{type_name}" for type_name in CAST_TYPES}:
+            raise XPath2Error("XPST0051", f"Unsupported cast type {value!r} at offset {offset}")
+        self.index += 1
+        return value.partition(":")[2], self.accept("?")
+
+    def cast_expr(self) -> Expression:
+        operand = self.unary_expr()
+        if self.at("castable") and self.at("as", 1):
+            self.index += 2
+            type_name, optional = self.single_type()
+
+            def castable(item, position, size, env):
+                sequence = _atomize(operand(item, position, size, env))
+                if len(sequence) != 1:
+                    return [optional and not sequence]
+                try:
+                    _cast(sequence[0], type_name)
+                except XPath2Error:
+                    return [False]
+                return [True]
+
+            castable.boolean = True
+            return castable
+        if self.at("cast") and self.at("as", 1):
+            self.index += 2
+            type_name, optional = self.single_type()
+
+            def cast(item, position, size, env):
+                value = _single_atom(operand(item, position, size, env), "A cast")
+                if value is None:
+                    if optional:
+                        return []
+                    raise XPath2Error("XPTY0004", "Cast of an empty sequence")
+                return [_cast(value, type_name)]
+
+            return cast
+        return operand
+
+    def unary_expr(self) -> Expression:
+        negative = False
+        while self.at("-") or self.at("+"):
+            negative ^= self.peek()[1] == "-"
+            self.index += 1
+        operand = self.path_expr()
+        if not negative:
+            return operand
+
+        def negate(item, position, size, env):
+            value = _numeric_operand(operand(item, position, size, env))
+            return [] if value is None else [-value]
+
+        return negate
+
+    # Paths
+
+    def starts_step(self) -> bool:
+        kind, value, _offset = self.peek()
+        if kind in (NAME, QNAME, STRING, NUMBER, VARIABLE):
+            return True
+        return kind == OPERATOR and value in ("@", "*", ".", "..", "(")
+
+    def path_expr(self) -> Expression:
+        variable_references = self._variable_references
+        if self.accept("/"):
+            if not self.starts_step():
+                return lambda item, position, size, env: [env.document]
+            steps = [lambda nodes, env: [env.document]] + self.relative_path()
+        elif self.accept("//"):
+            steps = [lambda nodes, env: [env.document]] + self.relative_path(descendant=True)
+        else:
+            first = self.step_expr()
+            if not (self.at("/") or self.at("//")):
+                return first if callable(first) else self.path(first, [])
+            return self.path(None, self.relative_path(first=first))
+        path = self.path(None, steps)
+        if self._variable_references != variable_references:
+            return path
+
+        # Only depends on the document: evaluated once per document, like `blaze.indexed_document` does for lxml
+        def absolute_path(item, position, size, env):
+            paths = env.document.paths
+            if path not in paths:
+                paths[path] = path(item, position, size, env)
+            return paths[path]
+
+        return absolute_path
+
+    @staticmethod
+    def path(first, steps: list) -> Expression:
+        """The expression of a path, whose first step is an expression of the focus or a step of the context item."""
+
+        def path(item, position, size, env):
+            if first is None or not callable(first):
+                sequence = [item]
+                if first is not None:
+                    if not isinstance(item, _NODE_TYPES):
+                        raise XPath2Error("XPTY0020", "The context item of an axis step is not a node")
+                    sequence = first[0](sequence, env)
+            else:
+                sequence = first(item, position, size, env)
+            for step in steps:
+                sequence = step(sequence, env)
+            return sequence
+
+        return path
+
+    def relative_path(self, first=None, descendant: bool = False) -> list:
+        """
+        Steps of a relative path, as functions of the context sequence. `first` is the already compiled first step:
+        an expression of the focus (a filter expression) or a 1-tuple of an axis step.
+        """
+        steps = []
+        if first is not None:
+            steps.append(first[0] if isinstance(first, tuple) else self.filter_step(first))
+        else:
+            steps.append(self.next_step(descendant))
+        while True:
+            if self.accept("/"):
+                steps.append(self.next_step(False))
+            elif self.accept("//"):
+                steps.append(self.next_step(True))
+            else:
+                return steps
+
+    def next_step(self, descendant: bool):
+        """A step after ``/`` (or ``//`` when `descendant`), as a function of the context sequence."""
+        step = self.step_expr(descendant=descendant)
+        if isinstance(step, tuple):
+            return step[0]
+        if descendant:
+            filter_step = self.filter_step(step)
+            return lambda nodes, env: filter_step(_subtrees(nodes, env), env)
+        return self.filter_step(step)
+
+    @staticmethod
+    def filter_step(expression: Expression):
+        """A step which is not an axis step: the expression is evaluated on each node of the context sequence."""
+
+        def filter_step(nodes, env):
+            result = []
+            size = len(nodes)
+            for index, node in enumerate(nodes, 1):
+                if not isinstance(node, _NODE_TYPES):
+                    raise XPath2Error("XPTY0019", "A path step on a value which is not a node")
+                result += expression(node, index, size, env)
+            if size > 1 and result and isinstance(result[0], _NODE_TYPES):
+                return _document_order(result, env.document)
+            return result
+
+        return filter_step
+
+    def step_expr(self, descendant: bool = False):
+        """
+        A filter expression (an `Expression`) or an axis step (a 1-tuple of a function of the context sequence).
+        With `descendant`, the step follows ``//``: it is turned into a descendant step when its predicates don't
+        depend on positions, otherwise ``descendant-or-self::node()`` is inserted before it.
+        """
+        kind, value, offset = self.peek()
+        if kind == OPERATOR and value == "..":
+            self.index += 1
+            return (self.axis_step_function("parent", ("node", None), self.predicates(), descendant),)
+        if kind == OPERATOR and value == "@":
+            self.index += 1
+            return self.axis_step("attribute", descendant)
+        if kind == NAME and self.at("::", 1):
+            self.index += 2
+            return self.axis_step(value, descendant)
+        if kind in (NAME, QNAME) and self.at("(", 1) and value not in _KIND_TESTS:
+            return self.filter_expr()
+        if kind in (NAME, QNAME) or (kind == OPERATOR and value == "*"):
+            return self.axis_step("child", descendant)
+        return self.filter_expr()
+
+    def node_test(self, axis: str) -> NodeTest:
+        kind, value, offset = self.peek()
+        if kind in (NAME, QNAME) and value in _KIND_TESTS and self.at("(", 1):
+            self.index += 2
+            # element(name) or attribute(name) only, without type
+            test_name = None
+            if not self.at(")"):
+                test_name = self.peek()[1]
+                self.index += 1
+            self.expect(")")
+            if value == "element":
+                return ("element", self.qname(test_name) if test_name and test_name != "*" else etree.Element)
+            if value == "attribute":
+                return ("attribute", self.qname(test_name) if test_name and test_name != "*" else None)
+            return (value, None)
+        self.index += 1
+        if axis == "attribute":
+            return ("attribute", None if value == "*" else self.qname(value))
+        if kind == OPERATOR and value == "*":
+            return ("element", etree.Element)
+        if kind == QNAME and value.endswith(":*"):
+            return ("element", self.qname(value)[:-1] + "*")
+        if kind in (NAME, QNAME):
+            return ("element", self.qname(value))
+        raise XPath2Error("XPST0003", f"Expected a node test at offset {offset}, not {value!r}")
+
+    def axis_step(self, axis: str, descendant: bool):
+        test = self.node_test(axis)
+        return (self.axis_step_function(axis, test, self.predicates(), descendant),)
+
+    def predicates(self) -> list[tuple[Expression, Optional[int]]]:
+        """Predicates: (expression, constant position if it is a positive integer literal)."""
+        predicates = []
+        while self.accept("["):
+            kind, value, _offset = self.peek()
+            if kind == NUMBER and value.isdigit() and int(value) > 0 and self.at("]", 1):
+                self.index += 2
+                predicates.append((None, int(value)))
+                continue
+            focus_calls = self._focus_calls
+            predicate = self.expr()
+            self.expect("]")
+            # Whether the predicate can't depend on positions
+            predicate.boolean_only = getattr(predicate, "boolean", False) and focus_calls == self._focus_calls
+            predicates.append((predicate, None))
+        return predicates
+
+    def axis_step_function(self, axis: str, test: NodeTest, predicates: list, descendant: bool = False):
+        if axis not in _AXES:
+            raise XPath2Error("XPST0003", f"Unknown axis {axis!r}")
+        if descendant:
+            if axis == "child" and all(predicate is not None and predicate.boolean_only for predicate, _position in predicates):
+                axis = "descendant"
+            else:
+                inner = self.axis_step_function(axis, test, predicates)
+                return lambda nodes, env: inner(_subtrees(nodes, env), env)
+        nodes_of = _AXES[axis]
+        if axis == "child" and test[0] == "element":
+            tag = test[1]
+
+            def nodes_of(node, test, document):
+                if node.__class__ is _Element:
+                    return list(node.iterchildren(tag))
+                return _children(node, test, document)
+
+        reverse = axis in _REVERSE_AXES
+        ordered = axis in _ORDERED_AXES
+
+        def step(nodes, env):
+            document = env.document
+            if len(nodes) == 1:
+                node = nodes[0]
+                if not isinstance(node, _NODE_TYPES):
+                    raise XPath2Error("XPTY0019", "A path step on a value which is not a node")
+                result = nodes_of(node, test, document)
+                if predicates:
+                    result = _apply_predicates(result, predicates, env)
+                return result[::-1] if reverse and len(result) > 1 else result
+            result = []
+            for node in nodes:
+                if not isinstance(node, _NODE_TYPES):
+                    raise XPath2Error("XPTY0019", "A path step on a value which is not a node")
+                candidates = nodes_of(node, test, document)
+                result += _apply_predicates(candidates, predicates, env) if predicates else candidates
+            return result if ordered else _document_order(result, document)
+
+        return step
+
+    def filter_expr(self) -> Expression:
+        primary = self.primary_expr()
+        predicates = self.predicates()
+        if not predicates:
+            return primary
+
+        def filtered(item, position, size, env):
+            return _apply_predicates(primary(item, position, size, env), predicates, env)
+
+        return filtered
+
+    def primary_expr(self) -> Expression:
+        kind, value, offset = self.peek()
+        self.index += 1
+        if kind == STRING:
+            literal = [value[1:-1].replace(value[0] * 2, value[0])]
+            return lambda item, position, size, env: literal
+        if kind == NUMBER:
+            number = [float(value) if "e" in value.lower() else Decimal(value) if "." in value else int(value)]
+            return lambda item, position, size, env: number
+        if kind == VARIABLE:
+            name = value[1:]
+            self._variable_references += 1
+
+            def variable(item, position, size, env):
+                try:
+                    return env.variables[name]
+                except KeyError:
+                    raise XPath2Error("XPST0008", f"Undefined variable ${name}")
+
+            return variable
+        if kind == OPERATOR and value == ".":
+            return lambda item, position, size, env: [item]
+        if kind == OPERATOR and value == "(":
+            if self.accept(")"):
+                return lambda item, position, size, env: []
+            expression = self.expr()
+            self.expect(")")
+            return expression
+        if kind in (NAME, QNAME) and self.at("("):
+            return self.function_call(value)
+        raise XPath2Error("XPST0003", f"Unexpected {value!r} at offset {offset}")
+
+    def function_call(self, name: str) -> Expression:
+        self.expect("(")
+        arguments = []
+        if not self.accept(")"):
+            arguments.append(self.expr_single())
+            while self.accept(","):
+                arguments.append(self.expr_single())
+            self.expect(")")
+        name = name[3:] if name.startswith("fn:") else name
+
+        if name in ("position", "last") and not arguments:
+            self._focus_calls += 1
+            if name == "position":
+                return lambda item, position, size, env: [position]
+            return lambda item, position, size, env: [size]
+        if name not in _FUNCTIONS:
+            raise XPath2Error("XPST0017", f"Unknown function {name}()")
+        min_arity, max_arity, function, boolean = _FUNCTIONS[name]
+        if not arguments and name in _CONTEXT_DEFAULT_FUNCTIONS:
+            arguments = [lambda item, position, size, env: [item]]
+        if not min_arity <= len(arguments) <= max_arity:
+            raise XPath2Error("XPST0017", f"{name}() doesn't take {len(arguments)} arguments")
+
+        if len(arguments) == 1:
+            (argument,) = arguments
+
+            def call(item, position, size, env):
+                return function(argument(item, position, size, env))
+
+        else:
+
+            def call(item, position, size, env):
+                return function(*[argument(item, position, size, env) for argument in arguments])
+
+        call.boolean = boolean
+        return call
+
+
+_AXES = {
+    name: _axis(name)
+    for name in (
+        "child", "descendant", "descendant-or-self", "self", "parent", "ancestor", "ancestor-or-self",
+        "following-sibling", "preceding-sibling", "following", "preceding", "attribute",
+    )
+}  # fmt: skip
+
+
+################################################################################
+# Schematron
+################################################################################
+
+
+class NativeRule:
+    def __init__(self, context: str, compiler: Compiler, compile_errors: list[str]):
+        self.context = context
+        self.context_expression = _compile(compiler, context, compile_errors, "rule context", "<context>")
+        # (name, query, compiled query)
+        self.variables: list[tuple[str, str, Optional[Expression]]] = []
+        # (assert_id, flag, query, compiled query, message)
+        self.assertions: list[tuple[str, str, str, Optional[Expression], str]] = []
+
+
+def _compile(compiler: Compiler, query: str, compile_errors: list[str], error_type: str, key: str) -> Optional[Expression]:
+    """Compile a query, or report why it can't be and return `None`, which evaluates as `False` like in `blaze.py`."""
+    try:
+        return compiler.compile(query)
+    except XPath2Error as err:
+        compile_errors.append(blaze._xpath_error_detail(err, error_type, key, query))
+        return None
+
+
+def _context_query(context: str, lexer: Parser) -> str:
+    """
+    Query selecting the nodes a rule context matches. Like `blaze._xpath_context_query`, the relative alternatives of
+    the context match anywhere in the document, but only the top-level ``|`` separate alternatives here.
+    """
+    try:
+        tokens = lexer.parse(context)
+    except ValueError:
+        return context
+    alternatives, start, depth = [], 0, 0
+    for kind, value, offset in tokens + [(OPERATOR, "|", len(context))]:
+        if kind != OPERATOR:
+            continue
+        if value in ("(", "["):
+            depth += 1
+        elif value in (")", "]"):
+            depth -= 1
+        elif value == "|" and depth == 0:
+            alternatives.append(context[start:offset].strip())
+            start = offset + 1
+    return " | ".join(
+        alternative if alternative.lstrip("(").startswith("/") else f"//{alternative}" for alternative in alternatives
+    )
+
+
+class NativeSchematron:
+    """
+    A schematron whose queries are compiled by `Compiler`, run like `blaze.ElementSchematron` runs:
+    every rule on every node its context selects, with the same failed assertion messages.
+    """
+
+    def __init__(self, root_name: str, namespaces: dict[str, str]):
+        self.root_name = root_name
+        self.compiler = Compiler(namespaces)
+        self.compile_errors: list[str] = []
+        self.variables: list[tuple[str, str, Optional[Expression]]] = []
+        # (pattern_id, variables, rules)
+        self.patterns: list[tuple[str, list[tuple[str, str, Optional[Expression]]], list[NativeRule]]] = []
+
+    @classmethod
+    def from_sch(cls, sch: _Element, root_name: str) -> "NativeSchematron":
+        sch_namespace = {"": "http://purl.oclc.org/dsdl/schematron"}
+        namespaces = {"xs": _XS_NS, "u": "utils"}
+        for ns in sch.findall("./ns", namespaces=sch_namespace):
+            namespaces[ns.get("prefix") or ""] = ns.get("uri") or ""
+        schematron = cls(root_name, namespaces)
+
+        def variables(node: _Element, variable_type: str) -> list[tuple[str, str, Optional[Expression]]]:
+            return [
+                (name, query, schematron.compile(query, variable_type, name))
+                for var in node.findall("./let", namespaces=sch_namespace)
+                for name, query in [(var.get("name") or "", var.get("value") or "")]
+            ]
+
+        schematron.variables = variables(sch, "element variable")
+        for pattern_node in sch.findall("./pattern", namespaces=sch_namespace):
+            rules = []
+            for rule_node in pattern_node.findall("./rule", namespaces=sch_namespace):
+                context = _context_query(rule_node.get("context") or "", schematron.compiler.lexer)
+                rule = NativeRule(context, schematron.compiler, schematron.compile_errors)
+                rule.variables = variables(rule_node, "rule variable")
+                for assertion in rule_node.findall("./assert", namespaces=sch_namespace):
+                    assert_id = assertion.get("id") or ""
+                    query = assertion.get("test") or ""
+                    rule.assertions.append(
+                        (assert_id, assertion.get("flag") or "", query, schematron.compile(query, "rule assertion", assert_id), assertion.text or "")
+                    )
+                rules.append(rule)
+            schematron.patterns.append((pattern_node.get("id") or "", variables(pattern_node, "element variable"), rules))
+        return schematron
+
+    def compile(self, query: str, error_type: str, key: str) -> Optional[Expression]:
+        return _compile(self.compiler, query, self.compile_errors, error_type, key)
+
+    def assert_message(self, assert_id: str, message: str) -> str:
+        """Message reported for a failed assertion, as `blaze.ElementRule.assert_message` reports it."""
+        return f"[{assert_id}]-{message}" if self.root_name == "PEPPOL" else message
+
+    @staticmethod
+    def evaluate(expression: Optional[Expression], item, env: Env, errors: list[str], error_type: str, key: str, query: str) -> Sequence:
+        """Evaluate a compiled query, reporting an error (or a query which didn't compile) as `[False]`."""
+        if expression is None:
+            return [False]
+        try:
+            return expression(item, 1, 1, env)
+        except Exception as err:
+            errors.append(blaze._xpath_error_detail(err, error_type, key, query))
+            return [False]
+
+    def evaluate_variables(self, variables, item, env: Env, errors: list[str], variable_type: str) -> Env:
+        env = env.scope()
+        for name, query, expression in variables:
+            env.variables[name] = self.evaluate(expression, item, env, errors, variable_type, name, query)
+        return env
+
+    def run(self, doc: _Element) -> tuple[list[str], list[str], list[str]]:
+        """:return: the warning and fatal messages of the failed assertions, and the evaluation errors"""
+        document = Document(doc.getroottree())
+        warning, fatal, errors = [], [], []
+        env = self.evaluate_variables(self.variables, document, Env({}, document), errors, "element variable")
+        for _pattern_id, pattern_variables, rules in self.patterns:
+            pattern_env = self.evaluate_variables(pattern_variables, document, env, errors, "element variable")
+            for rule in rules:
+                context_nodes = self.evaluate(rule.context_expression, document, pattern_env, errors, "rule context", "<context>", rule.context)
+                for context_node in context_nodes:
+                    if not isinstance(context_node, _NODE_TYPES):
+                        continue
+                    rule_env = self.evaluate_variables(rule.variables, context_node, pattern_env, errors, "rule variable")
+                    for assert_id, flag, query, expression, message in rule.assertions:
+                        try:
+                            result = _boolean(self.evaluate(expression, context_node, rule_env, errors, "rule assertion", assert_id, query))
+                        except XPath2Error as err:
+                            errors.append(blaze._xpath_error_detail(err, "rule assertion", assert_id, query))
+                            result = False
+                        if result:
+                            continue
+                        if flag == "warning":
+                            warning.append(self.assert_message(assert_id, message))
+                        elif flag == "fatal":
+                            fatal.append(self.assert_message(assert_id, message))
+        return warning, fatal, errors
+
+
+def load_native_schematron(schematron_path: str) -> NativeSchematron:
+    return NativeSchematron.from_sch(etree.parse(schematron_path).getroot(), PATH_ROOT_MAP[schematron_path])
+
+
+def main():
+    tta = time()
+    test_file_path, schematron_paths = get_file_and_schematron_paths(sys.argv[1:])
+    doc = etree.parse(test_file_path).getroot()
+
+    for schematron_path in schematron_paths:
+        print(f"Running {schematron_path}")
+        schematron = load_native_schematron(schematron_path)
+        warning, fatal, errors = schematron.run(doc)
+        for title, messages in (("Compile errors:", schematron.compile_errors), ("Errors:", errors), ("Warning:", warning), ("Fatal:", fatal)):
+            if messages:
+                print(title)
+                pprint(messages)
+
+    pprint(time() - tta)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,101 @@
-from parser_tree import ParserTree
+import re
+
+from .mytoken import NAME, NUMBER, QNAME, STRING, VARIABLE, OperatorToken
+from .parser_tree import ParserTree
+from .pattern import Pattern
+
+# Lexer of XPath 2.0 expressions, the first stage of a native evaluator of the schematron asserts.
+# Tokens are (kind, value, offset) tuples, the kinds being defined in `mytoken.py`:
+# - the keywords (`and`, `every`, `satisfies`, `castable`, ...) are names: only the parser can tell them apart
+#   from element names, since XPath 2.0 does not reserve them
+# - the value of a string literal is its source text, quotes and doubled quotes included
+# - the value of a variable is its source text, `$` included
+# - comments ``(: ... :)`` are skipped
+
+XPATH2_OPERATORS = Pattern(
+    [
+        OperatorToken(symbol)
+        for symbol in (
+            "(", ")", "[", "]", ",", ".", "..", "/", "//", "@", "::", "?", "|",
+            "=", "!=", "<", "<=", ">", ">=", "<<", ">>", "+", "-", "*", "(:",
+        )
+    ]
+)  # fmt: skip
+
+_NCNAME = r"[^\W\d][\w.\-]*"
+# A name, with its prefix if it has one (but not an axis, followed by ``::``), or a ``prefix:*`` wildcard
+_NAME_RE = re.compile(rf"{_NCNAME}(?::(?:{_NCNAME}|\*))?")
+_VARIABLE_RE = re.compile(rf"\${_NCNAME}(?::{_NCNAME})?")
+_NUMBER_RE = re.compile(r"(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")
+_STRING_RE = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*\"""")
+_SPACES = " \t\r\n"
 
 
 class Parser:
-    def __init__(self, patterns):
-        self.patterns = patterns
-        self.tokenTree = ParserTree(patterns)
+    def __init__(self, patterns=None):
+        """
+        :param patterns: the `Pattern`s whose tokens are matched (longest first) where no name, literal nor variable
+                         starts, `XPATH2_OPERATORS` by default
+        """
+        self.patterns = patterns or [XPATH2_OPERATORS]
+        self.tokenTree = ParserTree(self.patterns)
 
     def parse(self, text):
-        pass
+        """
+        Split an XPath 2.0 expression into (kind, value, offset) tokens.
+        :raise ValueError: on a character no token starts with, or on an unterminated literal or comment
+        """
+        tokens = []
+        append = tokens.append
+        pos, end = 0, len(text)
+        while pos < end:
+            c = text[pos]
+            if c in _SPACES:
+                pos += 1
+                continue
+            if c == "'" or c == '"':
+                match = _STRING_RE.match(text, pos)
+                if match is None:
+                    raise ValueError(f"Unterminated string literal at offset {pos}: {text!r}")
+                append((STRING, match.group(), pos))
+            elif c.isdigit() or (c == "." and text[pos + 1 : pos + 2].isdigit()):
+                match = _NUMBER_RE.match(text, pos)
+                append((NUMBER, match.group(), pos))
+            elif c == "$":
+                match = _VARIABLE_RE.match(text, pos)
+                if match is None:
+                    raise ValueError(f"Missing variable name at offset {pos}: {text!r}")
+                append((VARIABLE, match.group(), pos))
+            elif c.isalpha() or c == "_":
+                match = _NAME_RE.match(text, pos)
+                value = match.group()
+                append((QNAME if ":" in value else NAME, value, pos))
+            else:
+                token, token_end = self.tokenTree.match(text, pos)
+                if token is None:
+                    raise ValueError(f"Unexpected character {c!r} at offset {pos}: {text!r}")
+                if token.symbol == "(:":
+                    pos = _comment_end(text, pos)
+                    continue
+                append((token.kind, token.symbol, pos))
+                pos = token_end
+                continue
+            pos = match.end()
+        return tokens
+
+
+def _comment_end(text, pos):
+    """Offset right after the (possibly nested) comment starting at `pos`."""
+    depth = 0
+    while True:
+        opening, closing = text.find("(:", pos), text.find(":)", pos)
+        if closing == -1:
+            raise ValueError(f"Unterminated comment at offset {pos}: {text!r}")
+        if opening != -1 and opening < closing:
+            depth += 1
+            pos = opening + 2
+        else:
+            depth -= 1
+            pos = closing + 2
+            if depth == 0:
+                return pos
@@ -2,23 +2,35 @@ class ParserTreeLeaf:
     def __init__(self, parent=None):
         self.parent = parent
         self.values = {}
+        # Token whose text ends on this leaf, if any
+        self.token = None
 
     def add_in_chain(self, c):
-        return self.values.setdefault(c, ParserTreeLeaf())
+        return self.values.setdefault(c, ParserTreeLeaf(self))
 
-    def add_token(self, c, token):
-        self.values[c] = token
+    def add_token(self, token):
+        self.token = token
 
 
 class ParserTree:
+    """Character trie of the tokens of the patterns, to find the longest token at a position of a text."""
+
     def __init__(self, patterns):
         self.root = ParserTreeLeaf()
         for pattern in patterns:
             for token in pattern.tokens:
                 node = self.root
-                token_str = str(token)
-                for i, c in enumerate(token_str):
-                    if i == len(token_str) - 1:
-                        node.add_token(token)
-                    else:
-                        node = node.add_in_chain(c)
+                for c in str(token):
+                    node = node.add_in_chain(c)
+                node.add_token(token)
+
+    def match(self, text, pos):
+        """Longest token starting at `pos` in `text`, as (token, end offset), or (None, pos) if there is none."""
+        node, token, end = self.root, None, pos
+        for i in range(pos, len(text)):
+            node = node.values.get(text[i])
+            if node is None:
+                break
+            if node.token is not None:
+                token, end = node.token, i + 1
+        return token, end
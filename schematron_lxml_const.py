@@ -1,4 +1,8 @@
-from typing import TypedDict
+from contextlib import nullcontext
+from functools import lru_cache
+from typing import BinaryIO, TypedDict
+
+from lxml import etree
 
 SCHEMATRON_CEN_PATH = "validation/schematron/CEN-EN16931-UBL.sch"
 SCHEMATRON_PEPPOL_PATH = "validation/schematron/PEPPOL-EN16931-UBL.sch"
@@ -30,6 +34,7 @@ SPECIAL_FILE_SCHEMATRON: dict[str, list[str]] = {
     "justnlcius": [SCHEMATRON_NLCIUS_PATH],
     "justxrechnung": [SCHEMATRON_XRECHNUNG_PATH],
     "justoioublinv": [SCHEMATRON_OIOUBL_INV_PATH],
+    "justoioublcn": [SCHEMATRON_OIOUBL_CN_PATH],
 }
 
 FOLDER_SCHEMATRON: dict[str, list[str]] = {
@@ -47,16 +52,24 @@ def get_file_and_schematron_paths(args: list[str]) -> tuple[str, list[str]]:
     file_path = f"test_files/{file_path}"
 
     if len(args) >= 2:
-        schematron_paths = SPECIAL_FILE_SCHEMATRON[args[1]]
+        schematron_paths = profile_schematron_paths(args[1])
     else:
-        test_folder_name = file_path.split("/")[0]
-        raise NotImplementedError("TODO: detect what schematron to run by the folder name")
-        # assert test_folder_name in
-        # schematron_paths = SPECIAL_FILE_SCHEMATRON.get(file_path, [SCHEMATRON_CEN_PATH])
+        schematron_paths = SPECIAL_FILE_SCHEMATRON[detect_profile(*sniff_document(file_path))]
 
     return file_path, schematron_paths
 
 
+def profile_schematron_paths(profile: str) -> list[str]:
+    """
+    Schematrons of a `SPECIAL_FILE_SCHEMATRON` key.
+    :raise KeyError: for an unknown profile
+    :raise ValueError: for a profile in `UNSUPPORTED_PROFILES`
+    """
+    if profile in UNSUPPORTED_PROFILES:
+        raise ValueError(f"Unsupported profile {profile!r}: {UNSUPPORTED_PROFILES[profile]}")
+    return SPECIAL_FILE_SCHEMATRON[profile]
+
+
 PATH_ROOT_MAP = {
     SCHEMATRON_CEN_PATH: "CEN",
     SCHEMATRON_PEPPOL_PATH: "PEPPOL",
@@ -69,6 +82,93 @@ PATH_ROOT_MAP = {
 }
 
 
+################################################################################
+# Profile Detection
+################################################################################
+
+# Bytes read at a time while sniffing a document, and at most: the identifiers are at the very start of the header
+SNIFF_CHUNK_SIZE = 4096
+SNIFF_MAX_SIZE = 65536
+# Children of the root which may come before (or are) the identifiers
+_SNIFF_PROLOG = {"UBLExtensions", "UBLVersionID", "CustomizationID", "ProfileID"}
+
+_UBL_INVOICE_TAG = "{urn:oasis:names:specification:ubl:schema:xsd:Invoice-2}Invoice"
+_UBL_CREDIT_NOTE_TAG = "{urn:oasis:names:specification:ubl:schema:xsd:CreditNote-2}CreditNote"
+# (root tag, or `None` for any, part of the CustomizationID, or of the ProfileID) -> `SPECIAL_FILE_SCHEMATRON` key
+# (or `UNSUPPORTED_PROFILES` key), the first match winning
+PROFILE_DETECTION: list[tuple[str | None, str, str]] = [
+    ("{urn:fdc:peppol:end-user-statistics-report:1.1}EndUserStatisticsReport", "", "eusr"),
+    ("{urn:fdc:peppol:transaction-statistics-report:1.0}TransactionStatisticsReport", "", "tsr"),
+    (_UBL_INVOICE_TAG, "OIOUBL-", "justoioublinv"),
+    (_UBL_CREDIT_NOTE_TAG, "OIOUBL-", "justoioublcn"),
+    (None, "urn:peppol:pint:selfbilling-1", "pintselfbilling"),
+    (None, "urn:peppol:pint:billing-1@aunz", "aunz"),
+    (None, ":xrechnung_", "xrechnung"),
+    (None, "urn:fdc:nen.nl:nlcius:", "nlcius"),
+    (None, "urn:fdc:peppol.eu:2017:poacc:", "peppol"),
+    (None, "urn:cen.eu:en16931:2017", "justcen"),
+]
+
+# Profiles that are detected, but whose schematrons can't be run (they aren't in `PATH_ROOT_MAP`): the reason, by key
+UNSUPPORTED_PROFILES: dict[str, str] = {
+    "justoioublinv": "the OIOUBL schematrons use XPath 2.0 functions (format-number, xs:double, ...) with no XPath 1.0 rewrite",
+    "justoioublcn": "the OIOUBL schematrons use XPath 2.0 functions (format-number, xs:double, ...) with no XPath 1.0 rewrite",
+    "pintselfbilling": "there is no PINT self-billing schematron, and the A-NZ rules require the billing CustomizationID",
+}
+
+
+def sniff_document(source: str | BinaryIO) -> tuple[str, str, str]:
+    """
+    Read a document (a path or a binary file) only up to its CustomizationID and ProfileID, by chunks of
+    `SNIFF_CHUNK_SIZE`, and return (root tag, CustomizationID, ProfileID), with '' for what isn't there.
+    """
+    parser = etree.XMLPullParser(events=("start", "end"), resolve_entities=False, no_network=True)
+    root_tag, identifiers = "", {"CustomizationID": "", "ProfileID": ""}
+    depth = 0
+    with open(source, "rb") if isinstance(source, str) else nullcontext(source) as file:
+        for _ in range(SNIFF_MAX_SIZE // SNIFF_CHUNK_SIZE):
+            chunk = file.read(SNIFF_CHUNK_SIZE)
+            if not chunk:
+                break
+            try:
+                parser.feed(chunk)
+                events = list(parser.read_events())
+            except etree.XMLSyntaxError:
+                # Reported by the validation itself
+                break
+            for event, node in events:
+                if not isinstance(node.tag, str):
+                    continue
+                localname = etree.QName(node).localname
+                if event == "start":
+                    depth += 1
+                    if depth == 1:
+                        root_tag = node.tag
+                    elif depth == 2 and localname not in _SNIFF_PROLOG:
+                        return root_tag, identifiers["CustomizationID"], identifiers["ProfileID"]
+                else:
+                    if depth == 2 and localname in identifiers:
+                        identifiers[localname] = (node.text or "").strip()
+                    depth -= 1
+    return root_tag, identifiers["CustomizationID"], identifiers["ProfileID"]
+
+
+@lru_cache(maxsize=1024)
+def detect_profile(root_tag: str, customization_id: str, profile_id: str) -> str:
+    """
+    `SPECIAL_FILE_SCHEMATRON` key of the schematrons to run on a document (see `sniff_document` and `PROFILE_DETECTION`),
+    cached as the same few CustomizationIDs come back over and over.
+    :raise ValueError: for a document of no known profile, or of one in `UNSUPPORTED_PROFILES`
+    """
+    for identifier in (customization_id, profile_id):
+        for tag, part, profile in PROFILE_DETECTION:
+            if (tag is None or tag == root_tag) and part in identifier:
+                if profile in UNSUPPORTED_PROFILES:
+                    raise ValueError(f"Unsupported profile {profile!r} for CustomizationID {customization_id!r}: {UNSUPPORTED_PROFILES[profile]}")
+                return profile
+    raise ValueError(f"Can't detect the schematrons to run on a {root_tag or 'non XML'} document with CustomizationID {customization_id!r}")
+
+
 ################################################################################
 # Sync everything from this point below with `schematron_lxml_const.py`
 ################################################################################
@@ -90,19 +190,9 @@ GNSMAP = {
     "re": "http://exslt.org/regular-expressions",
 }
 
-PEPPOL_CONST_ISO3166 = " AD AE AF AG AI AL AM AO AQ AR AS AT AU AW AX AZ BA BB BD BE BF BG BH BI BJ BL BM BN BO BQ BR BS BT BV BW BY BZ CA CC CD CF CG CH CI CK CL CM CN CO CR CU CV CW CX CY CZ DE DJ DK DM DO DZ EC EE EG EH ER ES ET FI FJ FK FM FO FR GA GB GD GE GF GG GH GI GL GM GN GP GQ GR GS GT GU GW GY HK HM HN HR HT HU ID IE IL IM IN IO IQ IR IS IT JE JM JO JP KE KG KH KI KM KN KP KR KW KY KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MF MG MH MK ML MM MN MO MP MQ MR MS MT MU MV MW MX MY MZ NA NC NE NF NG NI NL NO NP NR NU NZ OM PA PE PF PG PH PK PL PM PN PR PS PT PW PY QA RE RO RS RU RW SA SB SC SD SE SG SH SI SJ SK SL SM SN SO SR SS ST SV SX SY SZ TC TD TF TG TH TJ TK TL TM TN TO TR TT TV TW TZ UA UG UM US UY UZ VA VC VE VG VI VN VU WF WS YE YT ZA ZM ZW 1A XI "
-PEPPOL_CONST_ISO4217 = " AED AFN ALL AMD ANG AOA ARS AUD AWG AZN BAM BBD BDT BGN BHD BIF BMD BND BOB BOV BRL BSD BTN BWP BYN BZD CAD CDF CHE CHF CHW CLF CLP CNY COP COU CRC CUC CUP CVE CZK DJF DKK DOP DZD EGP ERN ETB EUR FJD FKP GBP GEL GHS GIP GMD GNF GTQ GYD HKD HNL HRK HTG HUF IDR ILS INR IQD IRR ISK JMD JOD JPY KES KGS KHR KMF KPW KRW KWD KYD KZT LAK LBP LKR LRD LSL LYD MAD MDL MGA MKD MMK MNT MOP MRO MUR MVR MWK MXN MXV MYR MZN NAD NGN NIO NOK NPR NZD OMR PAB PEN PGK PHP PKR PLN PYG QAR RON RSD RUB RWF SAR SBD SCR SDG SEK SGD SHP SLL SOS SRD SSP STN SVC SYP SZL THB TJS TMT TND TOP TRY TTD TWD TZS UAH UGX USD USN UYI UYU UZS VEF VND VUV WST XAF XAG XAU XBA XBB XBC XBD XCD XDR XOF XPD XPF XPT XSU XTS XUA XXX YER ZAR ZMW ZWL "
-PEPPOL_CONST_MIMECODE = " application/pdf image/png image/jpeg text/csv application/vnd.openxmlformats-officedocument.spreadsheetml.sheet application/vnd.oasis.opendocument.spreadsheet "
-PEPPOL_CONST_UNCL2005 = " 3 35 432 "
-PEPPOL_CONST_UNCL5189 = " 41 42 60 62 63 64 65 66 67 68 70 71 88 95 100 102 103 104 105 "
-PEPPOL_CONST_UNCL7161 = " AA AAA AAC AAD AAE AAF AAH AAI AAS AAT AAV AAY AAZ ABA ABB ABC ABD ABF ABK ABL ABN ABR ABS ABT ABU ACF ACG ACH ACI ACJ ACK ACL ACM ACS ADC ADE ADJ ADK ADL ADM ADN ADO ADP ADQ ADR ADT ADW ADY ADZ AEA AEB AEC AED AEF AEH AEI AEJ AEK AEL AEM AEN AEO AEP AES AET AEU AEV AEW AEX AEY AEZ AJ AU CA CAB CAD CAE CAF CAI CAJ CAK CAL CAM CAN CAO CAP CAQ CAR CAS CAT CAU CAV CAW CAX CAY CAZ CD CG CS CT DAB DAC DAD DAF DAG DAH DAI DAJ DAK DAL DAM DAN DAO DAP DAQ DL EG EP ER FAA FAB FAC FC FH FI GAA HAA HD HH IAA IAB ID IF IR IS KO L1 LA LAA LAB LF MAE MI ML NAA OA PA PAA PC PL RAB RAC RAD RAF RE RF RH RV SA SAA SAD SAE SAI SG SH SM SU TAB TAC TT TV V1 V2 WH XAA YY ZZZ "
-PEPPOL_CONST_UNCL5305 = " AE E S Z G O K L M "
-PEPPOL_CONST_EAID = " 0002 0007 0009 0037 0060 0088 0096 0097 0106 0130 0135 0142 0151 0183 0184 0188 0190 0191 0192 0193 0195 0196 0198 0199 0200 0201 0202 0204 0208 0209 0210 0211 0212 0213 0215 0216 0218 0221 0230 9901 9910 9913 9914 9915 9918 9919 9920 9922 9923 9924 9925 9926 9927 9928 9929 9930 9931 9932 9933 9934 9935 9936 9937 9938 9939 9940 9941 9942 9943 9944 9945 9946 9947 9948 9949 9950 9951 9952 9953 9957 9959 "
-PEPPOL_CONST_GREEK_GDT = " 1.1 1.6 2.1 2.4 5.1 5.2 "
-TSR_CONST_CL_SPIDTYPE = " CertSubjectCN "
-
 
-# IMPORTANT: replace all asserts that uses these variables
+# IMPORTANT: replace all asserts that uses these variables. The code lists among them are checked with
+# u:in_codelist (see `codelists.py`), instead of being evaluated as variables.
 VARIABLE_TO_IGNORE = {
     "greekDocumentType",
     "tokenizedUblIssueDate",
@@ -142,36 +232,13 @@ SLACK_SUM_EXISTS_ASSERT_KEY_TO_CODE_MAP = {
 
 
 def _get_br_code_08_sum_str(is_invoice: bool, code: str, with_percent: bool):
-    line_element = "InvoiceLine" if is_invoice else "CreditNoteLine"
-    if with_percent:
-        line_percent_condition = " and number(cac:Item/cac:ClassifiedTaxCategory/cbc:Percent) = number($VAR)"
-        allowance_percent_condition = " and cac:TaxCategory/cbc:Percent = $VAR"
-    else:
-        line_percent_condition = ""
-        allowance_percent_condition = ""
-
-    return f"""
-    (
-        sum(../../../cac:{line_element}[
-            cac:Item/cac:ClassifiedTaxCategory
-            and normalize-space(cac:Item/cac:ClassifiedTaxCategory/cbc:ID) = '{code}'
-            {line_percent_condition}
-        ]/cbc:LineExtensionAmount)
-        +
-        sum(../../../cac:AllowanceCharge[
-            cbc:ChargeIndicator = 'true'
-            and cac:TaxCategory and normalize-space(cac:TaxCategory/cbc:ID) = '{code}'
-            {allowance_percent_condition}
-        ]/cbc:Amount)
-        -
-        sum(../../../cac:AllowanceCharge[
-            cbc:ChargeIndicator = 'false'
-            and cac:TaxCategory
-            and normalize-space(cac:TaxCategory/cbc:ID) = '{code}'
-            {allowance_percent_condition}
-        ]/cbc:Amount)
-    )
     """
+    The line extension amounts plus the charges minus the allowances of the tax category `code` (and of the percent
+    `$VAR`, when `with_percent`), all totalled once per document by the `u:tax_category_total` extension function.
+    """
+    line_element = "InvoiceLine" if is_invoice else "CreditNoteLine"
+    percent_arg = ", $VAR" if with_percent else ""
+    return f"u:tax_category_total(../../.., '{line_element}', '{code}'{percent_arg})"
 
 
 BR_CODE_08_ROUND_SUM_ASSERT_MAP = {
@@ -193,12 +260,12 @@ BR_CODE_08_WITHIN_ONE_SUM_ASSERT_MAP = {
         cbc:Percent,
         "(
             //cac:InvoiceLine
-            and ../number(cbc:TaxableAmount) - 1 < {_get_br_code_08_sum_str(True, code, True)}
-            and ../number(cbc:TaxableAmount) + 1 > {_get_br_code_08_sum_str(True, code, True)}
+            and number(../cbc:TaxableAmount) - 1 < {_get_br_code_08_sum_str(True, code, True)}
+            and number(../cbc:TaxableAmount) + 1 > {_get_br_code_08_sum_str(True, code, True)}
         ) or (
             //cac:CreditNoteLine
-            and ../number(cbc:TaxableAmount) - 1 < {_get_br_code_08_sum_str(False, code, True)}
-            and ../number(cbc:TaxableAmount) + 1 > {_get_br_code_08_sum_str(False, code, True)}
+            and number(../cbc:TaxableAmount) - 1 < {_get_br_code_08_sum_str(False, code, True)}
+            and number(../cbc:TaxableAmount) + 1 > {_get_br_code_08_sum_str(False, code, True)}
         )"
     )
     """
@@ -276,19 +343,19 @@ DUPLICATE_ASSERT_MAP: dict[tuple[str, ...], str] = {
     (
         "BR-CO-10",
         "ibr-co-10",
-    ): "u:round(number(cbc:LineExtensionAmount), 2) = u:if_else(//cac:InvoiceLine, u:round(sum(//cac:InvoiceLine/cbc:LineExtensionAmount), 2), u:round(sum(//cac:CreditNoteLine/cbc:LineExtensionAmount), 2))",
+    ): "u:round(number(cbc:LineExtensionAmount), 2) = u:if_else(//cac:InvoiceLine, u:round(u:amount_sum(//cac:InvoiceLine/cbc:LineExtensionAmount), 2), u:round(u:amount_sum(//cac:CreditNoteLine/cbc:LineExtensionAmount), 2))",
     (
         "BR-CO-11",
         "ibr-co-11",
-    ): "u:round(number(cbc:AllowanceTotalAmount), 2) = u:round(sum(../cac:AllowanceCharge[cbc:ChargeIndicator='false']/cbc:Amount), 2) or (not(cbc:AllowanceTotalAmount) and not(../cac:AllowanceCharge[cbc:ChargeIndicator='false']))",
+    ): "u:round(number(cbc:AllowanceTotalAmount), 2) = u:round(u:amount_sum(../cac:AllowanceCharge[cbc:ChargeIndicator='false']/cbc:Amount), 2) or (not(cbc:AllowanceTotalAmount) and not(../cac:AllowanceCharge[cbc:ChargeIndicator='false']))",
     (
         "BR-CO-12",
         "ibr-co-12",
-    ): "u:round(number(cbc:ChargeTotalAmount), 2) = u:round(sum(../cac:AllowanceCharge[cbc:ChargeIndicator='true']/cbc:Amount), 2) or (not(cbc:ChargeTotalAmount) and not(../cac:AllowanceCharge[cbc:ChargeIndicator='true']))",
+    ): "u:round(number(cbc:ChargeTotalAmount), 2) = u:round(u:amount_sum(../cac:AllowanceCharge[cbc:ChargeIndicator='true']/cbc:Amount), 2) or (not(cbc:ChargeTotalAmount) and not(../cac:AllowanceCharge[cbc:ChargeIndicator='true']))",
     (
         "BR-CO-14",
         "ibr-co-14",
-    ): "(u:round(number(cbc:TaxAmount), 2) = u:round(sum(cac:TaxSubtotal/cbc:TaxAmount), 2)) or not(boolean(cac:TaxSubtotal))",
+    ): "(u:round(number(cbc:TaxAmount), 2) = u:round(u:amount_sum(cac:TaxSubtotal/cbc:TaxAmount), 2)) or not(boolean(cac:TaxSubtotal))",
     ################################################################################
     # Duplicate origin: PEPPOL
     ################################################################################
@@ -398,14 +465,14 @@ VARIABLE_REPLACE_MAP = {
     "allowancesTotal": """
         u:if_else(
             cac:AllowanceCharge[cbc:ChargeIndicator = 'false'],
-            u:round(sum(cac:AllowanceCharge[cbc:ChargeIndicator = 'false']/cbc:Amount), 2),
+            u:round(u:amount_sum(cac:AllowanceCharge[cbc:ChargeIndicator = 'false']/cbc:Amount), 2),
             0
         )
     """,
     "chargesTotal": """
         u:if_else(
             cac:AllowanceCharge[cbc:ChargeIndicator = 'true'],
-            u:round(sum(cac:AllowanceCharge[cbc:ChargeIndicator = 'true']/cbc:Amount), 2),
+            u:round(u:amount_sum(cac:AllowanceCharge[cbc:ChargeIndicator = 'true']/cbc:Amount), 2),
             0
         )
     """,
@@ -1503,15 +1570,15 @@ ASSERT_REPLACE_MAP = {
     ################################################################################
     # FIXME: [PEPPOL-COMMON-R043] find out why u:mod97-0208(...) fails when validating Belgian company number
     "PEPPOL-COMMON-R043": "u:exists(re:match(normalize-space(), '^[0-9]{10}$'))",
-    "PEPPOL-EN16931-CL002": f"contains('{PEPPOL_CONST_UNCL5189}', concat(' ', text(), ' '))",
-    "PEPPOL-EN16931-CL003": f"contains('{PEPPOL_CONST_UNCL7161}', concat(' ', text(), ' '))",
-    "PEPPOL-EN16931-CL006": f"contains('{PEPPOL_CONST_UNCL2005}', concat(' ', text(), ' '))",
+    "PEPPOL-EN16931-CL002": "u:in_codelist('PEPPOL-EN16931-UBL.sch#UNCL5189', normalize-space(text()))",
+    "PEPPOL-EN16931-CL003": "u:in_codelist('PEPPOL-EN16931-UBL.sch#UNCL7161', normalize-space(text()))",
+    "PEPPOL-EN16931-CL006": "u:in_codelist('PEPPOL-EN16931-UBL.sch#UNCL2005', normalize-space(text()))",
     "PEPPOL-EN16931-P0101": "$profile != '01' or (contains(' 381 396 81 83 532 ', concat(' ', text(), ' ')))",
     "PEPPOL-EN16931-R054": "count(cac:TaxTotal[not(cac:TaxSubtotal)]) = u:if_else(//cbc:TaxCurrencyCode, 1, 0)",
-    "PEPPOL-EN16931-CL001": f"contains('{PEPPOL_CONST_MIMECODE}', concat(' ', @mimeCode, ' '))",
-    "PEPPOL-EN16931-CL007": f"contains('{PEPPOL_CONST_ISO4217}', concat(' ', @currencyID, ' '))",
+    "PEPPOL-EN16931-CL001": "u:in_codelist('PEPPOL-EN16931-UBL.sch#MIMECODE', @mimeCode)",
+    "PEPPOL-EN16931-CL007": "u:in_codelist('PEPPOL-EN16931-UBL.sch#ISO4217', @currencyID)",
     "PEPPOL-EN16931-P0100": "$profile != '01' or contains(' 71 80 82 84 102 218 219 331 380 382 383 386 388 393 395 553 575 623 780 817 870 875 876 877 ', concat(' ', normalize-space(text()), ' '))",
-    "PEPPOL-EN16931-CL008": f"contains('{PEPPOL_CONST_EAID}', concat(' ', @schemeID, ' '))",
+    "PEPPOL-EN16931-CL008": "u:in_codelist('PEPPOL-EN16931-UBL.sch#eaid', @schemeID)",
     "PEPPOL-EN16931-R040": "not(cbc:MultiplierFactorNumeric and cbc:BaseAmount) or u:slack(u:if_else(cbc:Amount, number(cbc:Amount), 0), (number(cbc:BaseAmount) * number(cbc:MultiplierFactorNumeric)) div 100, 0.02)",
     "PEPPOL-EN16931-R110": "u:compare_date(text(), '>=' ,../../../cac:InvoicePeriod/cbc:StartDate)",
     "PEPPOL-EN16931-R111": "u:compare_date(text(), '<=' ,../../../cac:InvoicePeriod/cbc:EndDate)",
@@ -1540,7 +1607,7 @@ ASSERT_REPLACE_MAP = {
             $IdSegments[1] = substring(string(/*/cac:TaxRepresentativeParty/cac:PartyTaxScheme[cac:TaxScheme/cbc:ID = 'VAT']/cbc:CompanyID), 3, 9)
         )
     """,
-    "GR-R-001-5": f"string-length(normalize-space($IdSegments[4]))>0 and contains('{PEPPOL_CONST_GREEK_GDT}', concat(' ', $IdSegments[4], ' '))",
+    "GR-R-001-5": "string-length(normalize-space($IdSegments[4]))>0 and u:in_codelist('PEPPOL-EN16931-UBL.sch#greekDocumentType', $IdSegments[4])",
     "IS-R-008": """
     (
         cac:AdditionalDocumentReference[cbc:DocumentDescription = 'EINDAGI' and string-length(cbc:ID) = 10] and
@@ -1645,8 +1712,8 @@ ASSERT_REPLACE_MAP = {
     )
     """,
     "SCH-TSR-19": "u:exists(re:match(normalize-space(.), $re_seatid))",
-    "SCH-TSR-28": f"u:for_every(tsr:Key[normalize-space(@metaSchemeID) = 'SP'], \"not(contains(normalize-space($VAR/@schemeID), ' ')) and contains('{TSR_CONST_CL_SPIDTYPE}', concat(' ', normalize-space($VAR/@schemeID), ' '))\")",
-    "SCH-TSR-34": f"u:for_every(tsr:Key[normalize-space(@metaSchemeID) = 'SP'], \"not(contains(normalize-space($VAR/@schemeID), ' ')) and contains('{TSR_CONST_CL_SPIDTYPE}', concat(' ', normalize-space($VAR/@schemeID), ''))\")",
+    "SCH-TSR-28": "u:for_every(tsr:Key[normalize-space(@metaSchemeID) = 'SP'], \"not(contains(normalize-space($VAR/@schemeID), ' ')) and u:in_codelist('peppol-transaction-statistics-reporting-1.0.4.sch#cl_spidtype', normalize-space($VAR/@schemeID))\")",
+    "SCH-TSR-34": "u:for_every(tsr:Key[normalize-space(@metaSchemeID) = 'SP'], \"not(contains(normalize-space($VAR/@schemeID), ' ')) and u:in_codelist('peppol-transaction-statistics-reporting-1.0.4.sch#cl_spidtype', normalize-space($VAR/@schemeID))\")",
     "SCH-TSR-40": "u:exists(re:match(normalize-space(tsr:ReportPeriod/tsr:StartDate), '^[0-9]{4}\\-[0-9]{2}\\-[0-9]{2}$'))",
     "SCH-TSR-41": "u:exists(re:match(normalize-space(tsr:ReportPeriod/tsr:EndDate), '^[0-9]{4}\\-[0-9]{2}\\-[0-9]{2}$'))",
     "SCH-TSR-42": "u:compare_date(tsr:ReportPeriod/tsr:EndDate, '>=', tsr:ReportPeriod/tsr:StartDate)",
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+
+from .blaze import SchematronRegistry, _warm_registry
+from .schematron_lxml_const import PATH_ROOT_MAP, SPECIAL_FILE_SCHEMATRON, profile_schematron_paths
+
+# Asyncio front end of `blaze.py`, for pipelines which must not block their event loop while documents are validated,
+# and a small HTTP server on top of it to try it locally.
+# Usage: python -m <package>.service [<port> [<SPECIAL_FILE_SCHEMATRON key> ...]]
+#        curl --data-binary @<file.xml> 'http://localhost:<port>/validate?profile=peppol'
+
+# root_name -> {'warning': <list>, 'fatal': <list>, 'errors': <list>}, as returned by `SchematronRegistry.validate`
+Result = dict[str, dict[str, list[str]]]
+
+_logger = logging.getLogger(__name__)
+
+# Documents come from the outside: no DTD entities nor network access while parsing them
+_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+def profile_root_names(profile: str) -> list[str]:
+    """
+    Schematrons of a `SPECIAL_FILE_SCHEMATRON` key, by their `PATH_ROOT_MAP` names.
+    :raise KeyError: for an unknown profile
+    :raise ValueError: for a profile in `UNSUPPORTED_PROFILES`
+    """
+    if profile not in SPECIAL_FILE_SCHEMATRON:
+        raise KeyError(f"Unknown profile {profile!r}, expected one of {sorted(SPECIAL_FILE_SCHEMATRON)}")
+    return [PATH_ROOT_MAP[schematron_path] for schematron_path in profile_schematron_paths(profile)]
+
+
+def _validate_bytes(document_bytes: bytes, root_names: list[str]) -> Result:
+    """Parse and validate a document in a pool worker, reporting a parse failure in the `errors` of every schematron."""
+    try:
+        doc = etree.fromstring(document_bytes, _PARSER)
+    except etree.XMLSyntaxError as err:
+        return {root_name: {"warning": [], "fatal": [], "errors": [f"Error: {err}"]} for root_name in root_names}
+    return SchematronRegistry.validate(doc, root_names)
+
+
+################################################################################
+# Validation Service
+################################################################################
+
+
+class ValidationService:
+    """
+    Validate documents from an event loop, the evaluation running in a process pool whose workers keep their
+    `SchematronRegistry` warm (see `blaze.validate_many`), so the loop is never blocked:
+    - at most `max_workers` documents are evaluated at once, and at most `max_pending` more wait in a queue.
+      When the queue is full, `validate` waits for a free slot, which pushes back on the callers.
+    - a request which times out, or whose task is cancelled, is dropped from the queue. A document already being
+      evaluated can't be interrupted: its worker finishes it, and the result is thrown away.
+    Use it as ``async with ValidationService(...) as service: result = await service.validate(data, "peppol")``.
+    """
+
+    def __init__(
+        self,
+        profiles: Optional[list[str]] = None,
+        max_workers: int = 2,
+        max_pending: int = 16,
+        timeout: Optional[float] = 60,
+    ):
+        """
+        :param profiles: `SPECIAL_FILE_SCHEMATRON` keys whose schematrons are loaded by the workers when they start,
+                         rather than on their first document (the other profiles can still be validated)
+        :param timeout: default timeout of `validate`, in seconds (`None` to wait as long as it takes)
+        """
+        self.root_names = sorted({root_name for profile in profiles or [] for root_name in profile_root_names(profile)})
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._queue: asyncio.Queue[tuple[bytes, list[str], asyncio.Future]] = asyncio.Queue(max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._dispatchers: list[asyncio.Task] = []
+
+    async def start(self):
+        self._executor = ProcessPoolExecutor(self.max_workers, initializer=_warm_registry, initargs=(self.root_names,))
+        self._dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.max_workers)]
+
+    async def close(self):
+        for dispatcher in self._dispatchers:
+            dispatcher.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def __aenter__(self) -> "ValidationService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _dispatch(self):
+        """Hand the queued documents one at a time to the pool, until cancelled by `close`."""
+        loop = asyncio.get_running_loop()
+        while True:
+            document_bytes, root_names, future = await self._queue.get()
+            try:
+                if future.done():
+                    # Timed out or cancelled while waiting in the queue
+                    continue
+                result = await loop.run_in_executor(self._executor, _validate_bytes, document_bytes, root_names)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as err:
+                if not future.done():
+                    future.set_exception(err)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
+
+    async def validate(self, document_bytes: bytes, profile: str, timeout: Optional[float] = -1) -> Result:
+        """
+        Validate a document with the schematrons of a `SPECIAL_FILE_SCHEMATRON` key.
+        :param timeout: in seconds, from the call (so including the time waiting in the queue),
+                        the service's default if not given, `None` to wait as long as it takes
+        :raise KeyError: for an unknown profile
+        :raise ValueError: for a profile in `UNSUPPORTED_PROFILES`
+        :raise asyncio.TimeoutError: past the timeout, the request being dropped
+        """
+        if self._executor is None:
+            raise RuntimeError("The validation service is not started")
+        root_names = profile_root_names(profile)
+        timeout = self.timeout if timeout == -1 else timeout
+        future = asyncio.get_running_loop().create_future()
+        # Cancelling the caller cancels the future too, so the dispatchers skip it
+        return await asyncio.wait_for(self._submit(document_bytes, root_names, future), timeout)
+
+    async def _submit(self, document_bytes: bytes, root_names: list[str], future: asyncio.Future) -> Result:
+        try:
+            await self._queue.put((document_bytes, root_names, future))
+            return await future
+        finally:
+            future.cancel()
+
+
+################################################################################
+# HTTP Server
+################################################################################
+
+_HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    504: "Gateway Timeout",
+}
+
+
+async def _write_response(writer: asyncio.StreamWriter, status: int, body: dict):
+    content = json.dumps(body).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {_HTTP_REASONS[status]}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(content)}\r\nConnection: close\r\n\r\n".encode()
+        + content
+    )
+    await writer.drain()
+
+
+async def _handle_request(service: ValidationService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Answer a single ``POST /validate?profile=<key>[&timeout=<seconds>]`` request, the document being the body,
+    with the `Result` as JSON. Only what this needs of HTTP/1.1 is understood, and the connection is then closed.
+    """
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while (line := (await reader.readline()).decode("latin-1").strip()):
+            name, _sep, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        if len(request_line) != 3:
+            return await _write_response(writer, 400, {"error": "Malformed request line"})
+        method, target, _version = request_line
+        url = urlsplit(target)
+        if url.path != "/validate":
+            return await _write_response(writer, 404, {"error": f"Unknown path {url.path!r}"})
+        if method != "POST":
+            return await _write_response(writer, 405, {"error": "Only POST is supported"})
+        query = parse_qs(url.query)
+        timeout = float(query["timeout"][0]) if "timeout" in query else -1
+        try:
+            result = await service.validate(body, query.get("profile", [""])[0], timeout=timeout)
+        except KeyError as err:
+            return await _write_response(writer, 400, {"error": err.args[0]})
+        except asyncio.TimeoutError:
+            return await _write_response(writer, 504, {"error": "Validation timed out"})
+        await _write_response(writer, 200, result)
+    except (ValueError, asyncio.IncompleteReadError) as err:
+        await _write_response(writer, 400, {"error": str(err)})
+    except Exception as err:
+        _logger.exception("Validation request failed.")
+        await _write_response(writer, 500, {"error": f"{type(err).__name__}: {err}"})
+    finally:
+        writer.close()
+
+
+async def serve(port: int, profiles: list[str]):
+    async with ValidationService(profiles) as service:
+        server = await asyncio.start_server(lambda reader, writer: _handle_request(service, reader, writer), "localhost", port)
+        print(f"Validating on http://localhost:{port}/validate?profile=<{'|'.join(SPECIAL_FILE_SCHEMATRON)}>")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    asyncio.run(serve(port, sys.argv[2:]))
+
+
+if __name__ == "__main__":
+    main()